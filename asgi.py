@@ -0,0 +1,205 @@
+"""ASGI entry point, for serving many waiting clients on one event loop:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8080
+
+Needs an ASGI server such as uvicorn. The waiting routes, /messages/wait
+and /stream, are coroutines here fed by an AsyncHub, so an idle client costs
+a few small objects instead of a thread. Everything else (including the
+errors of those two routes) runs the Flask app in the loop's worker threads;
+those responses are short and sent once complete.
+"""
+
+import asyncio
+import io
+import sys
+from urllib.parse import urlencode
+
+from flask import request, session
+
+import main
+from hub import AsyncHub
+
+
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if key in environ:
+            value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+        environ[key] = value
+    return environ
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def empty_request():
+    # Stands in for receive once wait_for_disconnect has read the (empty) GET body
+    return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+
+class ChatApp:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.hub = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        if self.hub is None:
+            self.hub = AsyncHub(main.hub, asyncio.get_running_loop())
+
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            if scope['path'] == '/messages/wait':
+                return await self.wait_for_messages(scope, receive, send)
+            if scope['path'] == '/stream':
+                return await self.stream(scope, receive, send)
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        # The store is closed by main's atexit hook
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def wsgi(self, scope, receive, send):
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+
+        status, headers, chunks = await asyncio.to_thread(self.run_wsgi, wsgi_environ(scope, b''.join(body)))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b''.join(chunks)})
+
+    def run_wsgi(self, environ):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+
+        result = self.flask_app(environ, start_response)
+        try:
+            chunks = list(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], chunks
+
+    def request_context(self, scope):
+        return self.flask_app.request_context(wsgi_environ(scope, b''))
+
+    async def wait_for_messages(self, scope, receive, send):
+        with self.request_context(scope):
+            username = session.get('username')
+            room_id = request.args.get('room_id', session.get('current_chatroom', 'general'))
+            since = request.args.get('since', type=int)
+            timeout = max(1, min(request.args.get('timeout', 25, type=int), 60))
+
+        if username is None or room_id not in main.chatrooms:
+            return await self.wsgi(scope, receive, send)
+
+        subscriber = self.hub.subscribe([f"room:{room_id}"])
+        try:
+            if since is None:
+                since = main.store.changes.version(room_id)
+            if main.store.changes.version(room_id) == since:
+                waiting = asyncio.ensure_future(subscriber.get(timeout))
+                disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+                done, _ = await asyncio.wait((waiting, disconnect), return_when=asyncio.FIRST_COMPLETED)
+                waiting.cancel()
+                disconnect.cancel()
+                if disconnect in done:
+                    return
+                receive = empty_request
+        finally:
+            self.hub.unsubscribe(subscriber)
+
+        if room_id not in main.chatrooms:
+            return await self.wsgi(scope, receive, send)
+        # Answer like a delta poll
+        query = urlencode({'room_id': room_id, 'since': since}).encode()
+        await self.wsgi(dict(scope, path='/messages', raw_path=b'/messages', query_string=query),
+                        receive, send)
+
+    async def stream(self, scope, receive, send):
+        with self.request_context(scope):
+            username = session.get('username')
+
+        if username is None:
+            return await self.wsgi(scope, receive, send)
+
+        subscriber = self.hub.subscribe(main.stream_topics(username))
+        keepalive = self.flask_app.config['STREAM_KEEPALIVE']
+        disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                            (b'cache-control', b'no-cache'),
+                            (b'x-accel-buffering', b'no')]
+            })
+            await send({'type': 'http.response.body', 'body': b"retry: 3000\n\n", 'more_body': True})
+            while True:
+                waiting = asyncio.ensure_future(subscriber.get(keepalive))
+                done, _ = await asyncio.wait((waiting, disconnect), return_when=asyncio.FIRST_COMPLETED)
+                if disconnect in done:
+                    waiting.cancel()
+                    return
+                batch = waiting.result()
+                if batch is None:
+                    # Fell too far behind and was dropped
+                    break
+                if main.rooms_changed(batch):
+                    self.hub.update(subscriber, main.stream_topics(username))
+                chunk = ''.join(batch) if batch else ": keep-alive\n\n"
+                await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnect.cancel()
+            self.hub.unsubscribe(subscriber)
+
+
+app = ChatApp(main.app)
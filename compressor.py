@@ -0,0 +1,147 @@
+"""Compression of JSON responses, negotiated with Accept-Encoding.
+
+Message lists repeat the same keys and picture names in every entry and
+shrink to a fraction of their size, which counts on slow networks. A JSON
+response of at least min_size bytes is sent with the best encoding the
+client takes: brotli or zstd when their packages (brotli, zstandard) are
+installed, gzip otherwise.
+
+Many clients get the very same body (the same room's messages, the same
+poll results), so compressed bodies are kept by a hash of the body and
+encoding, within a byte budget, and compressed once.
+
+Compressing changes the bytes sent, so a strong ETag becomes weak, as
+nginx does; If-None-Match compares weakly, so 304s keep working.
+"""
+
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+ZSTD_LEVEL = 3
+
+
+def _encoders():
+    # Encodings we can produce, best first
+    encoders = []
+    if brotli is not None:
+        encoders.append(('br', lambda data: brotli.compress(data, quality=BROTLI_QUALITY)))
+    if zstandard is not None:
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        lock = threading.Lock()
+
+        def zstd(data):
+            # A ZstdCompressor isn't safe to use from several threads at once
+            with lock:
+                return compressor.compress(data)
+        encoders.append(('zstd', zstd))
+    encoders.append(('gzip', lambda data: gzip.compress(data, GZIP_LEVEL, mtime=0)))
+    return encoders
+
+
+class Compressor:
+    def __init__(self, min_size=1024, cache_bytes=4 * 1024 * 1024):
+        self.min_size = min_size
+        self.cache_bytes = cache_bytes
+        self.encoders = _encoders()
+        self._encode = dict(self.encoders)
+        self._lock = threading.Lock()
+        # (encoding, hash of body) -> compressed body, least recently used first
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        # route -> counters
+        self._routes = {}
+
+    def negotiate(self, accept_encodings):
+        """Return the encoding to use for a request's Accept-Encoding
+        (werkzeug Accept), or None to send the body as it is."""
+        best, best_quality = None, 0
+        for encoding, _ in self.encoders:
+            quality = accept_encodings[encoding]
+            # Ties go to the encoding listed first
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def compress(self, body, encoding):
+        """Return (compressed body, whether it came from the cache)."""
+        key = (encoding, hashlib.blake2b(body, digest_size=16).digest())
+        with self._lock:
+            data = self._cache.get(key)
+            if data is not None:
+                self._cache.move_to_end(key)
+                return data, True
+
+        data = self._encode[encoding](body)
+
+        if len(data) <= self.cache_bytes:
+            with self._lock:
+                if key not in self._cache:
+                    self._cache[key] = data
+                    self._cached_bytes += len(data)
+                    while self._cached_bytes > self.cache_bytes:
+                        _, dropped = self._cache.popitem(last=False)
+                        self._cached_bytes -= len(dropped)
+        return data, False
+
+    def apply(self, response, route, accept_encodings):
+        """Compress a JSON response in place if it is worth it; returns it."""
+        if (response.status_code != 200 or response.mimetype != 'application/json'
+                or response.direct_passthrough or response.is_streamed
+                or 'Content-Encoding' in response.headers):
+            return response
+        response.vary.add('Accept-Encoding')
+        body = response.get_data()
+        encoding = self.negotiate(accept_encodings) if len(body) >= self.min_size else None
+        data, hit = body, False
+        if encoding is not None:
+            data, hit = self.compress(body, encoding)
+            response.set_data(data)
+            response.content_encoding = encoding
+            etag, weak = response.get_etag()
+            if etag and not weak:
+                response.set_etag(etag, weak=True)
+        self._count(route, len(body), len(data), encoding, hit)
+        return response
+
+    def _count(self, route, size, sent, encoding, hit):
+        with self._lock:
+            counters = self._routes.get(route)
+            if counters is None:
+                counters = self._routes[route] = {'responses': 0, 'compressed': 0, 'cache_hits': 0,
+                                                  'bytes_in': 0, 'bytes_out': 0}
+            counters['responses'] += 1
+            counters['bytes_in'] += size
+            counters['bytes_out'] += sent
+            if encoding is not None:
+                counters['compressed'] += 1
+                counters[f"{encoding}_responses"] = counters.get(f"{encoding}_responses", 0) + 1
+            if hit:
+                counters['cache_hits'] += 1
+
+    def stats(self):
+        """Counters per route, with the ratio of bytes sent to JSON bytes."""
+        with self._lock:
+            routes = {route: dict(counters, ratio=round(counters['bytes_out'] / counters['bytes_in'], 3)
+                                  if counters['bytes_in'] else 1.0)
+                      for route, counters in self._routes.items()}
+            return {
+                'encodings': [encoding for encoding, _ in self.encoders],
+                'min_size': self.min_size,
+                'cache_entries': len(self._cache),
+                'cache_bytes': self._cached_bytes,
+                'routes': routes
+            }
@@ -0,0 +1,189 @@
+"""In-process fan-out of live events to /stream (Server-Sent Events) clients.
+
+Routes publish events to topics ('room:<id>', 'user:<name>', 'presence',
+'polls') and every subscriber of a topic gets a copy; update() changes the
+topics of a subscriber, e.g. when its user joins a room. Each event is encoded once, whatever the
+number of subscribers. Subscribers have a bounded buffer: one that falls
+behind by more than that is dropped rather than slowing down publishers or
+growing without limit, and its client reconnects and catches up with
+/messages?since=<version>.
+
+AsyncHub relays a Hub's events to asyncio subscribers on an event loop, for
+the ASGI entry point (asgi.py).
+"""
+
+import asyncio
+import json
+import threading
+
+
+class Subscriber:
+    def __init__(self, topics, buffer):
+        self.topics = topics
+        self.buffer = buffer
+        self.events = []
+        self.dropped = False
+        self._ready = threading.Condition()
+
+    def get(self, timeout):
+        """Wait for events; returns the pending ones ([] on timeout) or None once dropped."""
+        with self._ready:
+            if not self.events and not self.dropped:
+                self._ready.wait(timeout)
+            if self.dropped:
+                return None
+            events, self.events = self.events, []
+            return events
+
+    def _put(self, event):
+        with self._ready:
+            if self.dropped:
+                return False
+            if len(self.events) >= self.buffer:
+                self.dropped = True
+                self.events = []
+            else:
+                self.events.append(event)
+            self._ready.notify()
+            return not self.dropped
+
+
+class Hub:
+    def __init__(self, buffer=256):
+        self.buffer = buffer
+        self._lock = threading.Lock()
+        # topic -> set of subscribers
+        self._topics = {}
+        self._stats = {'published': 0, 'delivered': 0, 'dropped_subscribers': 0}
+        # Called as relay(topic, payload) for every event
+        self.relays = []
+
+    def subscribe(self, topics):
+        subscriber = Subscriber(tuple(topics), self.buffer)
+        with self._lock:
+            for topic in subscriber.topics:
+                self._topics.setdefault(topic, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._remove(subscriber, subscriber.topics)
+
+    def update(self, subscriber, topics):
+        """Change the topics of a subscriber (not one already dropped)."""
+        topics = tuple(topics)
+        with self._lock:
+            if subscriber.dropped:
+                return
+            self._remove(subscriber, set(subscriber.topics) - set(topics))
+            for topic in topics:
+                self._topics.setdefault(topic, set()).add(subscriber)
+            subscriber.topics = topics
+
+    def _remove(self, subscriber, topics):
+        for topic in topics:
+            subscribers = self._topics.get(topic)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._topics[topic]
+
+    def publish(self, topic, event, data):
+        with self._lock:
+            subscribers = list(self._topics.get(topic, ()))
+            self._stats['published'] += 1
+        if not subscribers and not self.relays:
+            return
+
+        payload = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        for relay in self.relays:
+            relay(topic, payload)
+        dropped = [subscriber for subscriber in subscribers if not subscriber._put(payload)]
+        with self._lock:
+            self._stats['delivered'] += len(subscribers) - len(dropped)
+            self._stats['dropped_subscribers'] += len(dropped)
+        for subscriber in dropped:
+            self.unsubscribe(subscriber)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['subscribers'] = len({s for subscribers in self._topics.values() for s in subscribers})
+            return stats
+
+
+class AsyncSubscriber:
+    def __init__(self, topics, buffer):
+        self.topics = topics
+        self.buffer = buffer
+        self.events = []
+        self.dropped = False
+        self._ready = asyncio.Event()
+
+    async def get(self, timeout):
+        """Wait for events; returns the pending ones ([] on timeout) or None once dropped."""
+        if not self.events and not self.dropped:
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self._ready.clear()
+        if self.dropped:
+            return None
+        events, self.events = self.events, []
+        return events
+
+    def _put(self, event):
+        if len(self.events) >= self.buffer:
+            self.dropped = True
+            self.events = []
+        else:
+            self.events.append(event)
+        self._ready.set()
+        return not self.dropped
+
+
+class AsyncHub:
+    def __init__(self, hub, loop):
+        self.buffer = hub.buffer
+        self.loop = loop
+        # topic -> set of subscribers; only touched on the loop
+        self._topics = {}
+        hub.relays.append(self._relay)
+
+    def _relay(self, topic, payload):
+        # Publishers run in worker threads
+        if topic in self._topics:
+            self.loop.call_soon_threadsafe(self._deliver, topic, payload)
+
+    def _deliver(self, topic, payload):
+        for subscriber in list(self._topics.get(topic, ())):
+            if not subscriber._put(payload):
+                self.unsubscribe(subscriber)
+
+    def subscribe(self, topics):
+        subscriber = AsyncSubscriber(tuple(topics), self.buffer)
+        for topic in subscriber.topics:
+            self._topics.setdefault(topic, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self._remove(subscriber, subscriber.topics)
+
+    def update(self, subscriber, topics):
+        """Change the topics of a subscriber (not one already dropped)."""
+        topics = tuple(topics)
+        if subscriber.dropped:
+            return
+        self._remove(subscriber, set(subscriber.topics) - set(topics))
+        for topic in topics:
+            self._topics.setdefault(topic, set()).add(subscriber)
+        subscriber.topics = topics
+
+    def _remove(self, subscriber, topics):
+        for topic in topics:
+            subscribers = self._topics.get(topic)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._topics[topic]
@@ -0,0 +1,156 @@
+"""Smaller copies of profile pictures and sent images, made off the request thread.
+
+Pictures are stored as they were uploaded, up to the upload limit, but are
+shown far smaller: profile pictures next to every message, sent images in
+the message list. ImagePipeline makes fixed-size variants of them in a pool
+of worker processes, so a large picture doesn't hold up requests (not all
+of Pillow's work lets other threads run), each as WebP and as JPEG for
+browsers without WebP. Variant names carry a hash of the source picture, so a new
+picture always gets a new URL and a variant never changes once written.
+
+Animated pictures are left as they are.
+"""
+
+import concurrent.futures
+import hashlib
+import multiprocessing
+import os
+import threading
+
+AVATAR_SIZE = 128
+THUMBNAIL_SIZE = 320
+WEBP_QUALITY = 80
+JPEG_QUALITY = 85
+
+
+def _save(img, path, format, **options):
+    # Written to a temporary file first, so a variant is complete once it exists
+    tmp = f"{path}.tmp{os.getpid()}"
+    img.save(tmp, format, **options)
+    os.replace(tmp, path)
+
+
+def make_variant(source, target_base, size, crop):
+    """Write target_base.webp and target_base.jpg: source cropped to a
+    size x size square (crop) or fitted into one. Runs in a worker process;
+    returns False for animated pictures."""
+    from PIL import Image, ImageOps
+
+    with Image.open(source) as img:
+        if getattr(img, 'is_animated', False):
+            return False
+        img = ImageOps.exif_transpose(img)
+        img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+        if crop:
+            img = ImageOps.fit(img, (size, size), Image.LANCZOS)
+        else:
+            img.thumbnail((size, size), Image.LANCZOS)
+
+    _save(img, f"{target_base}.webp", 'WEBP', quality=WEBP_QUALITY, method=4)
+    if img.mode == 'RGBA':
+        # JPEG has no transparency: put the picture on white
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        img = background
+    _save(img, f"{target_base}.jpg", 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return True
+
+
+def file_digest(path, chunk_size=256 * 1024):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def make_avatar(source, pfp_dir):
+    """Make the avatar variants of a profile picture, named after its hash;
+    returns the .webp file name, or None for an animated picture. Runs in a
+    worker process."""
+    stem = os.path.splitext(os.path.basename(source))[0]
+    variant = f"{stem}.{file_digest(source)[:12]}.{AVATAR_SIZE}"
+    base = os.path.join(pfp_dir, variant)
+    # Made before, for the same picture
+    if not os.path.exists(f"{base}.jpg") and not make_variant(source, base, AVATAR_SIZE, True):
+        return None
+    return f"{variant}.webp"
+
+
+class ImagePipeline:
+    def __init__(self, pfp_dir, thumbnail_dir, workers=2):
+        self.pfp_dir = pfp_dir
+        self.thumbnail_dir = thumbnail_dir
+        self.workers = workers
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+        os.makedirs(thumbnail_dir, exist_ok=True)
+
+    def start(self):
+        """Start the worker processes, before the app starts its threads.
+
+        They are forked, since a spawned worker would run main.py again, and
+        a fork copies the locks other threads hold at that moment. A process
+        forked from this one (a web worker) starts its own."""
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('fork'))
+                self._pool_pid = os.getpid()
+                # Forks all the workers now rather than on the first picture
+                self._pool.submit(int)
+            return self._pool
+
+    def _submit(self, callback, function, *args):
+        # callback(result) runs once function(*args) returned something
+        future = self.start().submit(function, *args)
+
+        def done(future):
+            try:
+                result = future.result()
+            except FileNotFoundError:
+                # The picture was deleted before its turn came
+                return
+            except Exception as e:
+                print(f"Could not resize {args[0]}: {e}")
+                return
+            if result:
+                callback(result)
+
+        future.add_done_callback(done)
+
+    def avatar(self, filename, callback):
+        """Make the variants of a profile picture in pfp_dir; calls
+        callback(variant) with the variant's .webp file name when done."""
+        self._submit(callback, make_avatar, os.path.join(self.pfp_dir, filename), self.pfp_dir)
+
+    def thumbnail_name(self, digest):
+        return f"{digest[:2]}/{digest}.{THUMBNAIL_SIZE}.webp"
+
+    def existing_thumbnail(self, digest):
+        """Return the name (under thumbnail_dir) of the thumbnail of a sent
+        picture with content hash digest, or None if it isn't made yet."""
+        name = self.thumbnail_name(digest)
+        if os.path.exists(os.path.join(self.thumbnail_dir, name[:-len('.webp')] + '.jpg')):
+            return name
+        return None
+
+    def thumbnail(self, source, digest, callback):
+        """Make the thumbnail of a sent picture; calls callback(name) when done."""
+        name = self.thumbnail_name(digest)
+        base = os.path.join(self.thumbnail_dir, name[:-len('.webp')])
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+        self._submit(lambda made: callback(name), make_variant, source, base, THUMBNAIL_SIZE, False)
+
+    def remove_thumbnail(self, digest):
+        base = os.path.join(self.thumbnail_dir, self.thumbnail_name(digest)[:-len('.webp')])
+        for path in (f"{base}.webp", f"{base}.jpg"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def shutdown(self):
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,108 @@
+"""Locks for sharing the store between request threads (see Storage.lock).
+
+RWLock lets any number of threads read (here: make ordinary changes) at once
+while a writer (a change to the structure of the store, or a checkpoint)
+waits for them to finish and then runs alone. KeyedLocks hands out one lock
+per key, so changes to different rooms don't wait for each other.
+"""
+
+import threading
+from contextlib import contextmanager
+
+
+class RWLock:
+    """Shared/exclusive lock that prefers writers.
+
+    Once a writer waits, new readers wait behind it, so a steady stream of
+    readers can't starve it. Both sides are reentrant, and the writer can
+    take the read side too, so locked methods can call each other. A reader
+    can't become the writer: two readers doing that at once would wait for
+    each other forever, so it raises instead.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        self._waiting_writers = 0
+        # How many times the current thread holds the read side
+        self._local = threading.local()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+    def acquire_read(self):
+        depth = getattr(self._local, 'reads', 0)
+        if depth or self._writer == threading.get_ident():
+            self._local.reads = depth + 1
+            return
+        with self._cond:
+            while self._writer is not None or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        self._local.reads = 1
+
+    def release_read(self):
+        self._local.reads -= 1
+        if self._local.reads or self._writer == threading.get_ident():
+            return
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        if self._writer == me:
+            self._writer_depth += 1
+            return
+        if getattr(self._local, 'reads', 0):
+            raise RuntimeError("Can't take the write lock while holding the read lock")
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = me
+            self._writer_depth = 1
+
+    def release_write(self):
+        self._writer_depth -= 1
+        if self._writer_depth:
+            return
+        with self._cond:
+            self._writer = None
+            self._cond.notify_all()
+
+
+class KeyedLocks:
+    """A reentrant lock per key, made on first use."""
+
+    def __init__(self):
+        self._locks = {}
+
+    def __call__(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            # setdefault is atomic, so racing threads end up with the same lock
+            lock = self._locks.setdefault(key, threading.RLock())
+        return lock
+
+    def discard(self, key):
+        """Forget a key's lock; only when no thread can be holding or about
+        to take it (e.g. with the write side of an RWLock guarding them)."""
+        self._locks.pop(key, None)
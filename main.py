@@ -1,25 +1,65 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session, flash, send_from_directory
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, session, flash
+import hashlib
 import json
 import os
 import time
 import random
+import re
 import string
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-import pickle
-
-app = Flask(__name__, static_url_path='/static')
+import atexit
+import threading
+from collections import OrderedDict
+from compressor import Compressor
+from hub import Hub
+from images import ImagePipeline
+from presence import Presence
+from static_files import send_cached, static_url_hash
+from storage import RETENTION_LIMITS, open_storage
+from uploads import UploadStore
+
+# Static files are served by send_static below, with caching headers
+app = Flask(__name__, static_folder=None)
 app.config['APP_NAME'] = 'Not Discord'  # Set application name
 app.secret_key = os.urandom(24).hex()  # Create a random secret key for session
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # 5MB max upload
+# Journal writer: flush at most every N ms or after M pending changes, and never
+# let more than JOURNAL_MAX_LOSS_MS of changes sit unwritten
+app.config['JOURNAL_FLUSH_MS'] = int(os.environ.get('JOURNAL_FLUSH_MS', 50))
+app.config['JOURNAL_FLUSH_RECORDS'] = int(os.environ.get('JOURNAL_FLUSH_RECORDS', 256))
+app.config['JOURNAL_MAX_LOSS_MS'] = int(os.environ.get('JOURNAL_MAX_LOSS_MS', 1000))
+# /stream: events buffered per client before a slow client is dropped, and
+# seconds between keep-alive comments on an idle stream
+app.config['STREAM_BUFFER'] = int(os.environ.get('STREAM_BUFFER', 256))
+app.config['STREAM_KEEPALIVE'] = int(os.environ.get('STREAM_KEEPALIVE', 15))
+# Worker processes that make the small copies of profile pictures and of
+# images sent in chat
+app.config['IMAGE_WORKERS'] = int(os.environ.get('IMAGE_WORKERS', 2))
+# JSON responses of at least COMPRESS_MIN_BYTES are compressed for clients
+# that take it; COMPRESS_CACHE_BYTES of compressed bodies are kept for reuse
+app.config['COMPRESS_MIN_BYTES'] = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+app.config['COMPRESS_CACHE_BYTES'] = int(os.environ.get('COMPRESS_CACHE_BYTES', 4 * 1024 * 1024))
+# Bytes of classroom pages kept in memory
+app.config['CLASSROOM_CACHE_BYTES'] = int(os.environ.get('CLASSROOM_CACHE_BYTES', 8 * 1024 * 1024))
 
 # Create uploads directory if it doesn't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'pfp'), exist_ok=True)
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'music'), exist_ok=True)
 
+# Files sent in chat, stored once per distinct content (see uploads.py)
+upload_store = UploadStore(app.config['UPLOAD_FOLDER'])
+
+# Avatar sized profile pictures and thumbnails of sent images (see images.py)
+images = ImagePipeline(os.path.join(app.config['UPLOAD_FOLDER'], 'pfp'),
+                       os.path.join(app.config['UPLOAD_FOLDER'], 'thumbs'),
+                       workers=app.config['IMAGE_WORKERS'])
+images.start()
+atexit.register(images.shutdown)
+
 # Copy the Opera GX music file as default music if it doesn't exist
 default_music_path = os.path.join(app.config['UPLOAD_FOLDER'], 'music', 'default.mp3')
 if not os.path.exists(default_music_path):
@@ -34,83 +74,184 @@ ADMIN_USERNAME = "robozo"
 # Data storage
 data_file = 'chat_data.pkl'
 
-# Initialize data structures
-if os.path.exists(data_file):
-    with open(data_file, 'rb') as f:
-        data = pickle.load(f)
-    users = data.get('users', {})
-    chatrooms = data.get('chatrooms', {})
-    invites = data.get('invites', {})
-    pending_users = data.get('pending_users', {})
-    feedback = data.get('feedback', [])
-    real_names_set = data.get('real_names_set', set())
-    polls = data.get('polls', {})
-
-    # Initialize real_names_set if not in saved data
-    if real_names_set is None:
-        real_names_set = set()
-        # Add users who already have real names set
-        for username, user_data in users.items():
-            if user_data.get('real_name', ''):
-                real_names_set.add(username)
-else:
-    # Store users in memory (in a real app, you'd use a database)
-    users = {}
-    # Chatrooms data structure
-    chatrooms = {
-        'general': {
-            'name': 'General',
-            'messages': [],
-            'members': []
-        },
-        'changelog': {
-            'name': 'Changelog',
-            'messages': [],
-            'members': [],
-            'is_permanent': True
-        }
-    }
-    # Track users who have set their real name
-    real_names_set = set()
-    # Store invites
-    invites = {}
-    # Store pending users (awaiting approval)
-    pending_users = {}
-    # Store user feedback
-    feedback = []
-    # Store polls
-    polls = {}
+# Storage backend: 'memory' (snapshot + journal, see persistence.py) or 'sqlite'
+app.config['STORAGE_BACKEND'] = os.environ.get('CHAT_STORAGE', 'memory')
+app.config['SQLITE_FILE'] = os.environ.get('CHAT_SQLITE_FILE', 'chat_data.db')
+# Default message retention of rooms (0 keeps everything); older messages are
+# moved to a compressed archive. Admins can set other limits per room.
+app.config['RETENTION_MAX_MESSAGES'] = int(os.environ.get('RETENTION_MAX_MESSAGES', 0))
+app.config['RETENTION_MAX_AGE_DAYS'] = int(os.environ.get('RETENTION_MAX_AGE_DAYS', 0))
+app.config['RETENTION_MAX_BYTES'] = int(os.environ.get('RETENTION_MAX_BYTES', 0))
+# Several worker processes can serve the app together with the sqlite backend
+# and CHAT_SHARED=1, e.g. CHAT_STORAGE=sqlite CHAT_SHARED=1 gunicorn --preload -w 4 main:app
+# (--preload, so the setup below runs once). Each worker passes its changes
+# and live events on to the others through the database.
+app.config['SHARED_WORKERS'] = os.environ.get('CHAT_SHARED') == '1'
+
+# With the memory backend, changes are written by a background thread;
+# close() does a final flush on exit.
+store = open_storage(app.config['STORAGE_BACKEND'],
+                     data_file=data_file,
+                     db_file=app.config['SQLITE_FILE'],
+                     retention={'max_messages': app.config['RETENTION_MAX_MESSAGES'],
+                                'max_age_days': app.config['RETENTION_MAX_AGE_DAYS'],
+                                'max_bytes': app.config['RETENTION_MAX_BYTES']},
+                     shared=app.config['SHARED_WORKERS'],
+                     flush_interval=app.config['JOURNAL_FLUSH_MS'] / 1000,
+                     flush_records=app.config['JOURNAL_FLUSH_RECORDS'],
+                     max_loss=app.config['JOURNAL_MAX_LOSS_MS'] / 1000)
+store.load()
+atexit.register(store.close)
+
+# Routes read these through the store; after changing one, call store.save_*
+users = store.users
+chatrooms = store.chatrooms
+invites = store.invites
+pending_users = store.pending_users
+feedback = store.feedback
+real_names_set = store.real_names_set
+polls = store.polls
+
+# Live events for /stream clients
+hub = Hub(buffer=app.config['STREAM_BUFFER'])
+
+def publish_message_change(room_id, version, kind, seq, message):
+    hub.publish(f"room:{room_id}", 'message', {
+        'room_id': room_id,
+        'version': version,
+        'kind': kind,
+        'seq': seq,
+        'message': message
+    })
+
+store.changes.listeners.append(publish_message_change)
+
+# Who is online; users are shown offline after this many seconds without a heartbeat
+ONLINE_TIMEOUT = 20
+presence = Presence(timeout=ONLINE_TIMEOUT)
+
+def publish_presence_change(username, status, version):
+    hub.publish('presence', 'presence', {'user': username, 'status': status, 'version': version})
+
+presence.listeners.append(publish_presence_change)
+
+def broadcast(topic, event, data):
+    """Publish a live event to the /stream clients of every worker."""
+    hub.publish(topic, event, data)
+    if store.shared:
+        store.publish('hub', {'topic': topic, 'event': event, 'data': data})
+
+# Users who sent a heartbeat since the last batch went to the other workers.
+# Only coming online is published right away; the rest go out every
+# HEARTBEAT_BATCH_SECONDS, well within the timeout, so the other workers
+# keep them online without a write per heartbeat.
+HEARTBEAT_BATCH_SECONDS = ONLINE_TIMEOUT / 4
+pending_heartbeats = set()
+pending_heartbeats_lock = threading.Lock()
+
+def heartbeat(username):
+    came_online = presence.heartbeat(username)
+    if store.shared:
+        if came_online:
+            store.publish('heartbeat', [username])
+        else:
+            with pending_heartbeats_lock:
+                pending_heartbeats.add(username)
+
+def publish_heartbeats():
+    while True:
+        time.sleep(HEARTBEAT_BATCH_SECONDS)
+        with pending_heartbeats_lock:
+            batch = sorted(pending_heartbeats)
+            pending_heartbeats.clear()
+        if batch:
+            try:
+                store.publish('heartbeat', batch)
+            except Exception as e:
+                print(f"Could not publish heartbeats: {e}")
+
+def leave(username):
+    presence.leave(username)
+    if store.shared:
+        store.publish('leave', username)
+
+def on_worker_event(topic, data):
+    # What the other workers publish (changes to the store are applied by the store)
+    if topic == 'hub':
+        hub.publish(data['topic'], data['event'], data['data'])
+    elif topic == 'heartbeat':
+        for username in data:
+            presence.heartbeat(username)
+    elif topic == 'leave':
+        presence.leave(data)
+
+store.listeners.append(on_worker_event)
+
+def publish_membership_change(room_id, username, joined):
+    # The user's streams follow the rooms they join or leave (see /stream)
+    broadcast(f"user:{username}", 'rooms', {'room_id': room_id, 'joined': joined})
+
+store.member_listeners.append(publish_membership_change)
+
+# JSON responses go out compressed (see compressor.py)
+compressor = Compressor(min_size=app.config['COMPRESS_MIN_BYTES'],
+                        cache_bytes=app.config['COMPRESS_CACHE_BYTES'])
+
+@app.after_request
+def compress_json(response):
+    return compressor.apply(response, request.endpoint, request.accept_encodings)
+
+# Background threads start with the first request of each process: with
+# gunicorn --preload the app is loaded once and then forked into the
+# workers, and threads don't survive a fork
+background_started = {'pid': None}
+background_lock = threading.Lock()
+
+@app.before_request
+def start_background_threads():
+    if background_started['pid'] != os.getpid():
+        with background_lock:
+            if background_started['pid'] != os.getpid():
+                # Before the threads: image workers are forked from here
+                images.start()
+                presence.start()
+                store.follow()
+                if store.shared:
+                    threading.Thread(target=publish_heartbeats, name='heartbeats', daemon=True).start()
+                background_started['pid'] = os.getpid()
+
+# Default chatrooms for a fresh install
+if store.is_new:
+    store.create_room('general', {
+        'name': 'General',
+        'members': []
+    })
+    store.create_room('changelog', {
+        'name': 'Changelog',
+        'members': [],
+        'is_permanent': True
+    })
+
+# Function to save data (full checkpoint; safe while requests are running)
+def save_data():
+    store.checkpoint()
 
 # Ensure polls chatroom exists
 if 'polls' not in chatrooms:
-    chatrooms['polls'] = {
+    store.create_room('polls', {
         'name': '📊 Polls',
-        'messages': [],
         'members': [],
         'is_polls_room': True,
         'polls': []
-    }
+    })
 
 # Make sure all users are members of the polls and changelog chatrooms
 for username in users:
     if 'joined_chatrooms' not in users[username]:
-        users[username]['joined_chatrooms'] = ['general']
-
-    # Add polls room
-    if 'polls' not in users[username]['joined_chatrooms']:
-        users[username]['joined_chatrooms'].append('polls')
+        store.add_member('general', username)
 
-    # Add changelog room
-    if 'changelog' not in users[username]['joined_chatrooms']:
-        users[username]['joined_chatrooms'].append('changelog')
-
-    # Make sure users are in the members list of the polls chatroom
-    if username not in chatrooms['polls']['members']:
-        chatrooms['polls']['members'].append(username)
-
-    # Make sure users are in the members list of the changelog chatroom
-    if username not in chatrooms['changelog']['members']:
-        chatrooms['changelog']['members'].append(username)
+    store.add_member('polls', username)
+    store.add_member('changelog', username)
 
 # Ensure admin account exists
 if ADMIN_USERNAME not in users:
@@ -128,25 +269,10 @@ if ADMIN_USERNAME not in users:
         'online_status': 'offline',
         'last_active': datetime.now().timestamp()
     }
+    store.save_user(ADMIN_USERNAME)
     print(f"Admin account created with password: {admin_password}")
     # Add admin to general chatroom if not already there
-    if ADMIN_USERNAME not in chatrooms['general']['members']:
-        chatrooms['general']['members'].append(ADMIN_USERNAME)
-
-
-# Function to save data
-def save_data():
-    data = {
-        'users': users,
-        'chatrooms': chatrooms,
-        'invites': invites,
-        'pending_users': pending_users,
-        'feedback': feedback,
-        'real_names_set': real_names_set,
-        'polls': polls
-    }
-    with open(data_file, 'wb') as f:
-        pickle.dump(data, f)
+    store.add_member('general', ADMIN_USERNAME)
 
 # Function to send email invite (placeholder)
 def send_invite_email(email, invite_code, sender_name):
@@ -163,6 +289,57 @@ def send_invite_email(email, invite_code, sender_name):
 def allowed_file(filename):
     return '.' in filename  # Just check that the filename has an extension
 
+def release_files(messages):
+    # Drop the uploaded files of deleted messages (shared files stay while
+    # other messages link to them)
+    for message in messages:
+        file_path = message.get('file_path', '')
+        if file_path.startswith('/static/uploads/'):
+            if upload_store.release(file_path[len('/static/uploads/'):], message.get('file_hash')):
+                images.remove_thumbnail(message['file_hash'])
+
+def add_thumbnail(room_id, message_id, digest, name):
+    # Runs when the thumbnail of a sent image is ready
+    with store.room(room_id):
+        if room_id not in chatrooms:
+            return
+        position, message = store.find_message(room_id, message_id)
+        if message is None or message.get('file_hash') != digest:
+            return
+        message['thumb_path'] = f"/uploads/thumbs/{name}"
+        store.replace_message(room_id, position, message)
+
+# What chat.html gets to see of other users, and of rooms (the page loads
+# messages from /messages)
+USER_DISPLAY_FIELDS = ('display_name', 'real_name', 'profile_pic', 'name_color', 'name_font',
+                       'is_admin', 'online_status', 'show_in_room', 'show_in_chat', 'show_in_profile')
+ROOM_HIDDEN_FIELDS = ('messages', 'last_seq', 'segments', 'patches', 'archive', 'files', 'retention')
+
+def chat_view(username):
+    """Return (rooms, users) for chat.html: the rooms username has joined,
+    without their messages, and the display fields of the users in them."""
+    rooms = {}
+    visible = {username}
+    for room_id in users[username].get('joined_chatrooms', []):
+        if room_id in chatrooms:
+            room = chatrooms[room_id]
+            rooms[room_id] = {key: value for key, value in room.items() if key not in ROOM_HIDDEN_FIELDS}
+            visible.update(room['members'])
+
+    user_views = {}
+    for name in visible:
+        if name in users:
+            user = users[name]
+            user_views[name] = {field: user[field] for field in USER_DISPLAY_FIELDS if field in user}
+    # The user's own settings are on the page too
+    user_views[username] = {key: value for key, value in users[username].items() if key != 'password'}
+    return rooms, user_views
+
+# Rendered chat pages by username, with the versions they were rendered at
+chat_page_cache = OrderedDict()
+chat_page_lock = threading.Lock()
+CHAT_PAGE_CACHE_SIZE = 256
+
 
 @app.route('/')
 def home():
@@ -190,20 +367,37 @@ def home():
             current_room = 'general'
 
         # Ensure user is a member of the current room
-        if username not in chatrooms[current_room]['members']:
-            chatrooms[current_room]['members'].append(username)
-            save_data()
+        store.add_member(current_room, username)
 
         # Check if user needs to set their real name
         needs_real_name = session.get('needs_real_name', False)
 
-        return render_template('chat.html', 
-                              username=username, 
-                              chatrooms=chatrooms,
-                              current_room=current_room,
-                              users=users,
-                              is_admin=users.get(username, {}).get('is_admin', False),
-                              needs_real_name=needs_real_name)
+        # The page only changes with the rooms and users it shows. Pages
+        # carrying flashed messages aren't cached.
+        key = (store.rooms_version, store.users_version, current_room, needs_real_name)
+        flashed = bool(session.get('_flashes'))
+        with chat_page_lock:
+            cached = chat_page_cache.get(username)
+            if cached is not None and cached[0] == key and not flashed:
+                chat_page_cache.move_to_end(username)
+                return cached[1]
+
+        room_views, user_views = chat_view(username)
+        page = render_template('chat.html',
+                               username=username,
+                               chatrooms=room_views,
+                               current_room=current_room,
+                               users=user_views,
+                               is_admin=users.get(username, {}).get('is_admin', False),
+                               needs_real_name=needs_real_name)
+
+        if not flashed:
+            with chat_page_lock:
+                chat_page_cache[username] = (key, page)
+                chat_page_cache.move_to_end(username)
+                while len(chat_page_cache) > CHAT_PAGE_CACHE_SIZE:
+                    chat_page_cache.popitem(last=False)
+        return page
     else:
         return redirect(url_for('login'))
 
@@ -268,7 +462,7 @@ def register():
                     'profile_pic': 'default.png',
                     'is_admin': is_admin,
                     'email': email,
-                    'joined_chatrooms': ['general', 'polls', 'changelog'],
+                    'joined_chatrooms': [],
                     'name_color': '#000000',  # Default black color
                     'name_font': 'Arial, sans-serif', # Default font
                     'is_rickrolled': False, # Added is_rickrolled field
@@ -278,12 +472,12 @@ def register():
                     'name': 'ask'  # Default to ask for name
                 }
 
-                # Add admin to general chatroom
-                if username not in chatrooms['general']['members']:
-                    chatrooms['general']['members'].append(username)
-
                 # Save data
-                save_data()
+                store.save_user(username)
+
+                # Add admin to general, polls, and changelog chatrooms
+                for room_id in ['general', 'polls', 'changelog']:
+                    store.add_member(room_id, username)
 
                 # Log the admin in
                 session['username'] = username
@@ -309,7 +503,7 @@ def register():
                 }
 
                 # Save data
-                save_data()
+                store.save_pending_user(username)
 
                 flash('Your account has been created and is pending approval from an administrator')
                 return render_template('registration_pending.html')
@@ -321,9 +515,75 @@ def register():
 
 @app.route('/logout')
 def logout():
+    if 'username' in session:
+        leave(session['username'])
     session.clear()
     return redirect(url_for('login'))
 
+# Classroom pages, as sent: the HTML file with a base tag for its relative
+# paths. By file path, with the modification time and size they were made
+# from: path -> ((mtime, size), page, etag, mtime)
+classroom_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'classroom')
+default_classroom_file = os.path.join(classroom_dir, 'default.html')
+classroom_cache = OrderedDict()
+classroom_cache_lock = threading.Lock()
+# Total size of the cached pages
+classroom_cache_size = {'bytes': 0}
+CLASSROOM_BASE_TAG = '<base href="/static/uploads/classroom/">'
+
+def copy_default_classroom():
+    with open('attached_assets/dis.html', 'r', encoding='utf-8') as src:
+        with open(default_classroom_file, 'w', encoding='utf-8') as dst:
+            dst.write(src.read())
+
+os.makedirs(classroom_dir, exist_ok=True)
+if not os.path.exists(default_classroom_file) and os.path.exists('attached_assets/dis.html'):
+    copy_default_classroom()
+
+def classroom_page(path):
+    """Return (page, etag, mtime) for a classroom file; reads it only when
+    it changed since it was cached."""
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size)
+    with classroom_cache_lock:
+        cached = classroom_cache.get(path)
+        if cached is not None and cached[0] == key:
+            classroom_cache.move_to_end(path)
+            return cached[1:]
+
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    # Add base tag to fix relative paths
+    if '<head>' in content:
+        content = content.replace('<head>', f'<head>{CLASSROOM_BASE_TAG}')
+    page = content.encode('utf-8')
+    entry = (key, page, hashlib.sha1(page).hexdigest()[:16], st.st_mtime)
+
+    budget = app.config['CLASSROOM_CACHE_BYTES']
+    if len(page) <= budget:
+        with classroom_cache_lock:
+            replaced = classroom_cache.pop(path, None)
+            if replaced is not None:
+                classroom_cache_size['bytes'] -= len(replaced[1])
+            classroom_cache[path] = entry
+            classroom_cache_size['bytes'] += len(page)
+            # Least recently used pages go first
+            while classroom_cache_size['bytes'] > budget:
+                _, dropped = classroom_cache.popitem(last=False)
+                classroom_cache_size['bytes'] -= len(dropped[1])
+    return entry[1:]
+
+def send_classroom_page(path):
+    page, etag, mtime = classroom_page(path)
+    response = Response(page, mimetype='text/html')
+    response.set_etag(etag)
+    response.last_modified = mtime
+    # Which file it is depends on the user
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
 @app.route('/classroom')
 def classroom():
     if 'username' not in session:
@@ -332,40 +592,23 @@ def classroom():
     username = session.get('username')
     user_data = users.get(username, {})
     
-    # Create classroom directory if it doesn't exist
-    classroom_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'classroom')
-    os.makedirs(classroom_dir, exist_ok=True)
-    
-    # Set default file if none exists
-    default_file = os.path.join(classroom_dir, 'default.html')
-    if not os.path.exists(default_file):
-        with open('attached_assets/dis.html', 'r', encoding='utf-8') as src:
-            with open(default_file, 'w', encoding='utf-8') as dst:
-                dst.write(src.read())
-    
     # If user has custom classroom file and isn't using default
     if not user_data.get('use_default_classroom', True) and user_data.get('classroom_html_file'):
         try:
             file_path = os.path.join(classroom_dir, user_data['classroom_html_file'])
-            if os.path.exists(file_path):
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    # Add base tag to fix relative paths
-                    if '<head>' in content:
-                        base_tag = '<base href="/static/uploads/classroom/">'
-                        content = content.replace('<head>', f'<head>{base_tag}')
-                    return content
+            return send_classroom_page(file_path)
+        except FileNotFoundError:
+            pass
         except Exception as e:
             print(f"Error loading custom classroom file: {e}")
     
     # Otherwise use default template file
     try:
-        with open(default_file, 'r', encoding='utf-8') as f:
-            content = f.read()
-            if '<head>' in content:
-                base_tag = '<base href="/static/uploads/classroom/">'
-                content = content.replace('<head>', f'<head>{base_tag}')
-            return content
+        try:
+            return send_classroom_page(default_classroom_file)
+        except FileNotFoundError:
+            copy_default_classroom()
+            return send_classroom_page(default_classroom_file)
     except Exception as e:
         print(f"Error loading default classroom file: {e}")
         return render_template('dis.html', username=username, is_admin=user_data.get('is_admin', False))
@@ -373,7 +616,8 @@ def classroom():
 @app.route('/static/uploads/classroom/<path:filename>')
 def serve_classroom_file(filename):
     """Serve files from the classroom upload directory"""
-    return send_from_directory(os.path.join(app.config['UPLOAD_FOLDER'], 'classroom'), filename)
+    # Classroom pages refer to these by fixed names, so they are revalidated
+    return send_cached(os.path.join(app.config['UPLOAD_FOLDER'], 'classroom'), filename)
 
 @app.route('/admin/pending_users')
 def pending_users_list():
@@ -400,6 +644,31 @@ def api_pending_users():
 
     return jsonify(pending_users)
 
+@app.route('/api/persistence_stats')
+def api_persistence_stats():
+    if 'username' not in session:
+        return jsonify({"error": "Not logged in"}), 401
+
+    username = session['username']
+    if not users.get(username, {}).get('is_admin', False):
+        return jsonify({"error": "Not authorized"}), 403
+
+    # Storage counters, e.g. journal queue depth and flush latency, and
+    # how much the stored uploads take
+    return jsonify({**store.stats(), **upload_store.stats()})
+
+@app.route('/api/compression_stats')
+def api_compression_stats():
+    if 'username' not in session:
+        return jsonify({"error": "Not logged in"}), 401
+
+    username = session['username']
+    if not users.get(username, {}).get('is_admin', False):
+        return jsonify({"error": "Not authorized"}), 403
+
+    # Per route: JSON bytes, bytes sent and their ratio
+    return jsonify(compressor.stats())
+
 @app.route('/admin/approve_user/<username>', methods=['POST'])
 def approve_user(username):
     if 'username' not in session:
@@ -415,26 +684,23 @@ def approve_user(username):
     # Move user from pending to approved
     user_data = pending_users[username]
     users[username] = user_data
+    store.save_user(username)
 
     # Add user to general, polls, and changelog chatrooms if not already there
     for room_id in ['general', 'polls', 'changelog']:
-        if username not in chatrooms[room_id]['members']:
-            chatrooms[room_id]['members'].append(username)
+        store.add_member(room_id, username)
 
     # If registering with invite, add to the specific chatroom
     invite_code = user_data.get('invite_code')
     if invite_code and invite_code in invites:
         chatroom_id = invites[invite_code]['chatroom']
-        if chatroom_id in chatrooms and username not in chatrooms[chatroom_id]['members']:
-            chatrooms[chatroom_id]['members'].append(username)
-            users[username]['joined_chatrooms'].append(chatroom_id)
+        if chatroom_id in chatrooms:
+            store.add_member(chatroom_id, username)
         # Remove the used invite
-        del invites[invite_code]
+        store.delete_invite(invite_code)
 
     # Remove from pending users
-    del pending_users[username]
-
-    save_data()
+    store.delete_pending_user(username)
 
     return jsonify({"success": True})
 
@@ -451,8 +717,7 @@ def reject_user(username):
         return jsonify({"error": "User not found in pending list"}), 404
 
     # Simply remove from pending users
-    del pending_users[username]
-    save_data()
+    store.delete_pending_user(username)
 
     return jsonify({"success": True})
 
@@ -480,7 +745,7 @@ def profile():
                     file.save(filepath)
                     users[username]['bg_music_file'] = filename
                     flash('Music updated successfully')
-            save_data()
+            store.save_user(username)
             return redirect(url_for('profile'))
 
         # Handle profile picture upload
@@ -491,9 +756,13 @@ def profile():
                 filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'pfp', filename)
                 file.save(filepath)
 
-                # Update user profile pic
+                # Update user profile pic; it is swapped for its avatar sized
+                # copy once that is made
                 users[username]['profile_pic'] = filename
-                save_data()
+                users[username]['profile_pic_original'] = filename
+                store.save_user(username, 'profile_pic', 'profile_pic_original')
+                images.avatar(filename, lambda variant, username=username, filename=filename:
+                              use_avatar(username, filename, variant))
                 flash('Profile picture updated successfully')
             elif file.filename:
                 flash('Invalid file type. Please upload a PNG, JPG, JPEG, or GIF.')
@@ -512,33 +781,31 @@ def profile():
                     file.save(filepath)
                     users[username]['classroom_html_file'] = filename
                     flash('Classroom template updated successfully')
-            save_data()
+            store.save_user(username)
             return redirect(url_for('profile'))
 
         # Handle name color update
         name_color = request.form.get('name_color')
         if name_color:
             users[username]['name_color'] = name_color
-            save_data()
+            store.save_user(username, 'name_color')
             flash('Name color updated successfully')
 
         # Handle name font update
         name_font = request.form.get('name_font')
         if name_font:
             users[username]['name_font'] = name_font
-            save_data()
+            store.save_user(username, 'name_font')
             flash('Name font updated successfully')
 
         return redirect(url_for('profile'))
 
     # Initialize real name display settings if they don't exist
-    if 'show_in_room' not in users[username]:
-        users[username]['show_in_room'] = True
-    if 'show_in_chat' not in users[username]:
-        users[username]['show_in_chat'] = False
-    if 'show_in_profile' not in users[username]:
-        users[username]['show_in_profile'] = False
-    save_data()
+    defaults = {'show_in_room': True, 'show_in_chat': False, 'show_in_profile': False}
+    for key, value in defaults.items():
+        if key not in users[username]:
+            users[username][key] = value
+            store.save_user(username, key)
 
     return render_template('profile.html', 
                           username=username, 
@@ -558,13 +825,38 @@ def update_name_settings():
     users[username]['show_in_chat'] = request.form.get('show_in_chat') == 'on'
     users[username]['show_in_profile'] = request.form.get('show_in_profile') == 'on'
 
-    save_data()
+    store.save_user(username, 'show_in_room', 'show_in_chat', 'show_in_profile')
     flash('Name display settings updated successfully')
     return redirect(url_for('profile'))
 
+def use_avatar(username, original, variant):
+    # Runs when the avatar of a new profile picture is ready, unless the
+    # user has changed pictures again since
+    user = users.get(username)
+    if user is not None and user.get('profile_pic') == original:
+        user['profile_pic'] = variant
+        store.save_user(username, 'profile_pic')
+
+def image_file(folder, filename):
+    """Send an image, as the JPEG made alongside a WebP variant to browsers
+    that don't take WebP."""
+    vary = False
+    if filename.endswith('.webp') and os.path.exists(os.path.join(folder, filename[:-5] + '.jpg')):
+        vary = True
+        if 'image/webp' not in request.headers.get('Accept', ''):
+            filename = filename[:-5] + '.jpg'
+    response = send_cached(folder, filename, immutable=has_unique_name(filename))
+    if vary:
+        response.vary.add('Accept')
+    return response
+
 @app.route('/uploads/pfp/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(os.path.join(app.config['UPLOAD_FOLDER'], 'pfp'), filename)
+    return image_file(os.path.join(app.config['UPLOAD_FOLDER'], 'pfp'), filename)
+
+@app.route('/uploads/thumbs/<shard>/<filename>')
+def thumbnail_file(shard, filename):
+    return image_file(os.path.join(app.config['UPLOAD_FOLDER'], 'thumbs', secure_filename(shard)), filename)
 
 @app.route('/create_chatroom', methods=['POST'])
 def create_chatroom():
@@ -582,26 +874,21 @@ def create_chatroom():
 
     # Generate a join code for the chatroom
     join_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+    while store.room_by_join_code(join_code):
+        join_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
 
     # Create the chatroom
-    chatrooms[room_id] = {
+    store.create_room(room_id, {
         'name': room_name,
-        'messages': [],
-        'members': [username],
+        'members': [],
         'created_by': username,
         'join_code': join_code,
         'is_private': request.form.get('is_private') == 'true',
         'is_permanent': request.form.get('is_permanent') == 'true'
-    }
-
-    # Add this chatroom to the user's joined rooms
-    if 'joined_chatrooms' not in users[username]:
-        users[username]['joined_chatrooms'] = []
-
-    users[username]['joined_chatrooms'].append(room_id)
+    })
 
-    # Save data
-    save_data()
+    # The creator is the first member
+    store.add_member(room_id, username)
 
     return jsonify({"success": True, "room_id": room_id})
 
@@ -617,22 +904,12 @@ def join_chatroom(room_id):
     username = session['username']
 
     # Check if room is private and user is not a member
-    if chatrooms[room_id].get('is_private', False) and username not in chatrooms[room_id]['members']:
+    if chatrooms[room_id].get('is_private', False) and not store.is_member(room_id, username):
         flash('This room is private. Please use a join code to access it.')
         return redirect(url_for('home'))
 
     # Add user to the chatroom if not already a member
-    if username not in chatrooms[room_id]['members']:
-        chatrooms[room_id]['members'].append(username)
-
-        # Update user's joined chatrooms
-        if 'joined_chatrooms' not in users[username]:
-            users[username]['joined_chatrooms'] = []
-
-        if room_id not in users[username]['joined_chatrooms']:
-            users[username]['joined_chatrooms'].append(room_id)
-
-        save_data()
+    store.add_member(room_id, username)
 
     # Set current chatroom
     session['current_chatroom'] = room_id
@@ -651,27 +928,13 @@ def join_by_code():
         return jsonify({"error": "Join code is required"}), 400
 
     # Find room with matching join code
-    room_id = None
-    for rid, room in chatrooms.items():
-        if room.get('join_code') == join_code:
-            room_id = rid
-            break
+    room_id = store.room_by_join_code(join_code)
 
     if not room_id:
         return jsonify({"error": "Invalid join code"}), 404
 
     # Add user to the chatroom
-    if username not in chatrooms[room_id]['members']:
-        chatrooms[room_id]['members'].append(username)
-
-        # Update user's joined chatrooms
-        if 'joined_chatrooms' not in users[username]:
-            users[username]['joined_chatrooms'] = []
-
-        if room_id not in users[username]['joined_chatrooms']:
-            users[username]['joined_chatrooms'].append(room_id)
-
-        save_data()
+    store.add_member(room_id, username)
 
     return jsonify({"success": True, "room_id": room_id})
 
@@ -687,7 +950,7 @@ def switch_chatroom(room_id):
     username = session['username']
 
     # Ensure user is a member of the chatroom
-    if username not in chatrooms[room_id]['members']:
+    if not store.is_member(room_id, username):
         flash('You are not a member of this chatroom')
         return redirect(url_for('home'))
 
@@ -725,7 +988,7 @@ def invite_user():
     # Send the invite email
     invite_url = url_for('register', _external=True)
     if send_invite_email(email, invite_code, username):
-        save_data()
+        store.save_invite(invite_code)
         return jsonify({"success": True, "invite_code": invite_code})
     else:
         # If email sending fails, remove the invite
@@ -759,7 +1022,7 @@ def update_user_style():
     if name_font:
         users[target_user]['name_font'] = name_font
 
-    save_data()
+    store.save_user(target_user, 'name_color', 'name_font')
 
     return jsonify({"success": True})
 
@@ -785,28 +1048,16 @@ def move_user():
         return jsonify({"error": "Invalid destination room"}), 400
 
     # Add the user to the destination room if not already a member
-    if target_user not in chatrooms[destination_room]['members']:
-        chatrooms[destination_room]['members'].append(target_user)
-
-    # Update user's joined chatrooms list
-    if 'joined_chatrooms' not in users[target_user]:
-        users[target_user]['joined_chatrooms'] = []
-
-    if destination_room not in users[target_user]['joined_chatrooms']:
-        users[target_user]['joined_chatrooms'].append(destination_room)
+    store.add_member(destination_room, target_user)
 
     # Create a notification message in the destination room
-    message_id = f"{int(time.time())}-{random.randint(1000, 9999)}"
     message = {
-        'id': message_id,
         'user': 'robozo',
         'content': f"{target_user} has been moved to this room by {username}",
         'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'profile_pic': usersget('robozo', {}).get('profile_pic', 'default.png'),
     }
 
-    chatrooms[destination_room]['messages'].append(message)
-    save_data()
+    store.append_message(destination_room, message)
 
     return jsonify({"success": True})
 
@@ -827,16 +1078,14 @@ def create_rickroll_room():
     room_id = 'rickroll_' + ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
 
     # Create the rickroll room
-    chatrooms[room_id] = {
+    store.create_room(room_id, {
         'name': '🎵 Never Gonna Give You Up 🎵',
-        'messages': [],
         'members': [],
         'created_by': username,
         'is_private': True,
         'is_rickroll_room': True  # Special flag for rickroll rooms
-    }
+    })
 
-    save_data()
     return jsonify({"success": True, "room_id": room_id})
 
 @app.route('/check_rickroll_status')
@@ -867,11 +1116,8 @@ def rickroll_user():
         return jsonify({"error": "Invalid user"}), 400
 
     # First, find or create a rickroll room
-    rickroll_room_id = None
-    for room_id, room in chatrooms.items():
-        if room.get('is_rickroll_room'):
-            rickroll_room_id = room_id
-            break
+    rickroll_rooms = store.rooms_with_flag('is_rickroll_room')
+    rickroll_room_id = rickroll_rooms[0] if rickroll_rooms else None
 
     # Create a new rickroll room if none exists
     if not rickroll_room_id:
@@ -879,32 +1125,23 @@ def rickroll_user():
         rickroll_room_id = 'rickroll_' + ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
 
         # Create the special rickroll chatroom
-        chatrooms[rickroll_room_id] = {
+        store.create_room(rickroll_room_id, {
             'name': '🎵 Never Gonna Give You Up 🎵',
-            'messages': [],
-            'members': [target_user],
+            'members': [],
             'created_by': username,
             'is_private': True,
             'is_rickroll_room': True  # Special flag for rickroll rooms
-        }
-    else:
-                # Add the user to the existing rickroll room
-        if target_user not in chatrooms[rickroll_room_id]['members']:
-            chatrooms[rickroll_room_id]['members'].append(target_user)
+        })
 
-    # Add rickroll room to user's joined rooms and make it their current room
-    if 'joined_chatrooms' not in users[target_user]:
-        users[target_user]['joined_chatrooms'] = []
-
-    if rickroll_room_id not in users[target_user]['joined_chatrooms']:
-        users[target_user]['joined_chatrooms'].append(rickroll_room_id)
+    # Add the user to the rickroll room and make it their current room
+    store.add_member(rickroll_room_id, target_user)
 
     # Flag the user as rickrolled
     users[target_user]['is_rickrolled'] = True
     users[target_user]['current_room'] = rickroll_room_id
 
     # No message in general chat - stealth rickroll
-    save_data()
+    store.save_user(target_user, 'is_rickrolled', 'current_room')
 
     return jsonify({"success": True, "room_id": rickroll_room_id})
 
@@ -933,29 +1170,18 @@ def add_user_to_room():
         return jsonify({"error": "User does not exist"}), 404
 
     # Add user to chatroom if not already a member
-    if target_user not in chatrooms[chatroom_id]['members']:
-        chatrooms[chatroom_id]['members'].append(target_user)
-
-        # Update user's joined chatrooms
-        if 'joined_chatrooms' not in users[target_user]:
-            users[target_user]['joined_chatrooms'] = []
-
-        if chatroom_id not in users[target_user]['joined_chatrooms']:
-            users[target_user]['joined_chatrooms'].append(chatroom_id)
+    if not store.is_member(chatroom_id, target_user):
+        store.add_member(chatroom_id, target_user)
 
         # Create a notification message in the chatroom
-        message_id = f"{int(time.time())}-{random.randint(1000, 9999)}"
         message = {
-            'id': message_id,
             'user': 'SYSTEM',
             'content': f"{target_user} has been added to this room by {username}",
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'profile_pic': 'default.png',
             'is_system': True
         }
 
-        chatrooms[chatroom_id]['messages'].append(message)
-        save_data()
+        store.append_message(chatroom_id, message)
 
         return jsonify({"success": True})
     else:
@@ -983,18 +1209,11 @@ def kick_user():
     if chatroom_id not in chatrooms:
         return jsonify({"error": "Chatroom does not exist"}), 404
 
-    if target_user not in chatrooms[chatroom_id]['members']:
+    if not store.is_member(chatroom_id, target_user):
         return jsonify({"error": "User is not in this chatroom"}), 404
 
-    # Remove user from chatroom
-    chatrooms[chatroom_id]['members'].remove(target_user)
-
-    # Remove chatroom from user's joined chatrooms
-    if target_user in users and 'joined_chatrooms' in users[target_user]:
-        if chatroom_id in users[target_user]['joined_chatrooms']:
-            users[target_user]['joined_chatrooms'].remove(chatroom_id)
-
-    save_data()
+    # Remove user from chatroom (and the chatroom from their joined chatrooms)
+    store.remove_member(chatroom_id, target_user)
 
     return jsonify({"success": True})
 
@@ -1021,15 +1240,8 @@ def delete_user():
     if target_user not in users:
         return jsonify({"error": "User does not exist"}), 404
 
-    # Remove user from all chatrooms
-    for room_id in list(chatrooms.keys()):
-        if target_user in chatrooms[room_id]['members']:
-            chatrooms[room_id]['members'].remove(target_user)
-
-    # Delete user
-    del users[target_user]
-
-    save_data()
+    # Delete user (this also removes them from all chatrooms)
+    store.delete_user(target_user)
 
     return jsonify({"success": True})
 
@@ -1060,15 +1272,14 @@ def delete_chatroom():
     if chatrooms[chatroom_id].get('is_permanent', False):
         return jsonify({"error": "Cannot delete a permanent chatroom"}), 403
 
-    # Remove chatroom from all users' joined_chatrooms
-    for user_id in users:
-        if 'joined_chatrooms' in users[user_id] and chatroom_id in users[user_id]['joined_chatrooms']:
-            users[user_id]['joined_chatrooms'].remove(chatroom_id)
-
-    # Delete chatroom
-    del chatrooms[chatroom_id]
-
-    save_data()
+    # Delete chatroom (this also removes it from its members' joined_chatrooms),
+    # with no message sent in between, and then the files sent in it
+    with store.lock.write():
+        if chatroom_id not in chatrooms:
+            return jsonify({"error": "Chatroom does not exist"}), 404
+        files = store.room_files(chatroom_id)
+        store.delete_room(chatroom_id)
+    release_files(files)
 
     # If current chatroom was deleted, switch to general
     if session.get('current_chatroom') == chatroom_id:
@@ -1076,9 +1287,6 @@ def delete_chatroom():
 
     return jsonify({"success": True})
 
-# Cache for message responses
-message_cache = {}
-
 @app.route('/messages', methods=['GET'])
 def get_messages():
     if 'username' not in session:
@@ -1098,36 +1306,103 @@ def get_messages():
     if room_id not in chatrooms:
         return jsonify([])
 
-    # Get client's cache parameter - use timestamp directly
-    client_cache_param = request.args.get('_')
+    # Paged history: ?before=<seq> pages back from a message, ?after=<seq>
+    # pages forward. Each page says where the next one starts.
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
+    if before is not None or after is not None:
+        limit = max(1, min(request.args.get('limit', 50, type=int), 100))
+        version = store.changes.version(room_id)
+        messages, next_cursor = store.page_messages(room_id, before=before, after=after, limit=limit)
+        return jsonify({"messages": messages, "next_cursor": next_cursor, "version": version})
+
+    # Delta polling: ?since=<version> returns only the messages added, edited
+    # or deleted after that version
+    since = request.args.get('since', type=int)
+    if since is not None:
+        return message_delta(room_id, since)
+
+    # The room version changes with every added, edited or deleted message,
+    # so it doubles as the ETag of the message list
+    version = store.changes.version(room_id)
 
-    # Get username for user-specific cache
-    username = session.get('username', 'anonymous')
+    # Return only the most recent 50 messages for faster transmission
+    response = jsonify(store.recent_messages(room_id, 50))
+    response.headers['X-Room-Version'] = str(version)
+    response.set_etag(f"{room_id}-{version}")
+    return response.make_conditional(request)
 
-    # Use room_id, username and timestamp for better caching
-    cache_key = f"{room_id}_{username}_{client_cache_param}"
-    messages = chatrooms[room_id]['messages']
+@app.route('/messages/wait', methods=['GET'])
+def wait_for_messages():
+    if 'username' not in session:
+        return jsonify({"error": "Not logged in"}), 401
 
-    # Only return actual message data if needed
-    message_count = len(messages)
+    room_id = request.args.get('room_id', session.get('current_chatroom', 'general'))
 
-    # If no new messages since last request, return 304 Not Modified
-    if cache_key in message_cache and message_count > 0:
-        if message_cache[cache_key] == message_count:
-            return "", 304
+    if room_id not in chatrooms:
+        return jsonify({"error": "Chatroom not found"}), 404
 
-    # Update cache with current message count
-    message_cache[cache_key] = message_count
+    # Long polling: hold the request until the room changes after ?since
+    # (or from now on) or the timeout runs out, then answer like a delta poll
+    since = request.args.get('since', type=int)
+    if since is None:
+        since = store.changes.version(room_id)
+    timeout = max(1, min(request.args.get('timeout', 25, type=int), 60))
+    store.changes.wait(room_id, since, timeout)
 
-    # More aggressive cache cleanup
-    if len(message_cache) > 500:
-        # Remove oldest 40% of entries
-        keys_to_remove = sorted(message_cache.keys())[:200]
-        for key in keys_to_remove:
-            message_cache.pop(key, None)
+    if room_id not in chatrooms:
+        return jsonify({"error": "Chatroom not found"}), 404
+    return message_delta(room_id, since)
+
+def message_delta(room_id, since):
+    version, changes = store.changes.since(room_id, since)
+    if changes is None:
+        # Too far behind or the room was cleared, start over
+        return jsonify({"version": version, "reset": True,
+                        "messages": store.recent_messages(room_id, 50)})
+    if since == version:
+        return "", 304
+    # Changes that cancelled out still move the client to the new version
+    changes['version'] = version
+    return jsonify(changes)
+
+def stream_topics(username):
+    room_ids = [room_id for room_id in users.get(username, {}).get('joined_chatrooms', [])
+                if room_id in chatrooms]
+    return [f"room:{room_id}" for room_id in room_ids] + [f"user:{username}", 'presence', 'polls']
+
+def rooms_changed(batch):
+    # Whether a batch of stream events has one of publish_membership_change
+    return any(event.startswith('event: rooms\n') for event in batch)
+
+@app.route('/stream')
+def stream():
+    if 'username' not in session:
+        return jsonify({"error": "Not logged in"}), 401
 
-    # Return only the most recent 50 messages for faster transmission
-    return jsonify(messages[-50:] if len(messages) > 50 else messages)
+    # One stream per tab: message changes of the user's rooms, the rooms
+    # they join or leave, presence and poll results. After a reconnect,
+    # catch up with /messages?since=<version>.
+    username = session['username']
+    subscriber = hub.subscribe(stream_topics(username))
+    keepalive = app.config['STREAM_KEEPALIVE']
+
+    def events():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                batch = subscriber.get(keepalive)
+                if batch is None:
+                    # Fell too far behind and was dropped
+                    return
+                if rooms_changed(batch):
+                    hub.update(subscriber, stream_topics(username))
+                yield ''.join(batch) if batch else ": keep-alive\n\n"
+        finally:
+            hub.unsubscribe(subscriber)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/send_file', methods=['POST'])
 def send_file():
@@ -1147,7 +1422,7 @@ def send_file():
     if room_id not in chatrooms:
         return jsonify({"error": "Chatroom does not exist"}), 404
 
-    if username not in chatrooms[room_id]['members']:
+    if not store.is_member(room_id, username):
         return jsonify({"error": "You are not a member of this chatroom"}), 403
 
     if 'file' not in request.files:
@@ -1159,26 +1434,33 @@ def send_file():
 
     if file and allowed_file(file.filename):
         filename = secure_filename(f"{username}_{int(time.time())}_{file.filename}")
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-
-        # Generate a unique message ID
-        message_id = f"{int(time.time())}-{random.randint(1000, 9999)}"
+        filename, digest = upload_store.add(file.stream, filename)
 
         message = {
-            'id': message_id,
             'user': username,
             'content': message_content,
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'profile_pic': users[username]['profile_pic'],
             'file_path': f"/static/uploads/{filename}",
             'file_name': file.filename,
-            'file_type': file.content_type
+            'file_type': file.content_type,
+            'file_hash': digest
         }
-
-        chatrooms[room_id]['messages'].append(message)
-        save_data()
-        return jsonify({"success": True})
+        is_image = (file.content_type or '').startswith('image/')
+        thumbnail = images.existing_thumbnail(digest) if is_image else None
+        if thumbnail:
+            message['thumb_path'] = f"/uploads/thumbs/{thumbnail}"
+
+        with store.room(room_id):
+            # The room may have been deleted in the meantime
+            if room_id not in chatrooms:
+                upload_store.release(filename, digest)
+                return jsonify({"error": "Chatroom does not exist"}), 404
+            store.append_message(room_id, message)
+        if is_image and not thumbnail:
+            # Added to the message once it is made
+            images.thumbnail(upload_store.object_path(digest), digest,
+                             lambda name: add_thumbnail(room_id, message['id'], digest, name))
+        return jsonify({"success": True, "message_id": message['id']})
 
     return jsonify({"error": "File type not allowed"}), 400
 
@@ -1205,7 +1487,7 @@ def send_message():
     if room_id not in chatrooms:
         return jsonify({"error": "Chatroom does not exist"}), 404
 
-    if username not in chatrooms[room_id]['members']:
+    if not store.is_member(room_id, username):
         return jsonify({"error": "You are not a member of this chatroom"}), 403
 
     if content and content.strip():
@@ -1228,15 +1510,10 @@ def send_message():
                     ping_target = None
 
 
-        # Generate a unique message ID
-        message_id = f"{int(time.time())}-{random.randint(1000, 9999)}"
-
         message = {
-            'id': message_id,
             'user': 'SYSTEM' if as_system else username,
             'content': content,
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'profile_pic': 'default.png' if as_system else users[username]['profile_pic'],
             'is_system': as_system
         }
 
@@ -1251,9 +1528,12 @@ def send_message():
             message['is_whisper'] = True
             message['whisper_content'] = whisper_content
 
-        chatrooms[room_id]['messages'].append(message)
-        save_data()
-        return jsonify({"success": True})
+        with store.room(room_id):
+            # The room may have been deleted in the meantime
+            if room_id not in chatrooms:
+                return jsonify({"error": "Chatroom does not exist"}), 404
+            store.append_message(room_id, message)
+        return jsonify({"success": True, "message_id": message['id']})
     return jsonify({"error": "Message cannot be empty"}), 400
 
 @app.route('/delete_message', methods=['POST'])
@@ -1270,19 +1550,22 @@ def delete_message():
 
     is_admin = users.get(username, {}).get('is_admin', False)
 
-    # Find and delete the message
-    for i, message in enumerate(chatrooms[room_id]['messages']):
-        if message['id'] == message_id:
-            # Only allow deletion if user is the message author or an admin
-            if message['user'] == username or is_admin:
-                # Completely remove the message
-                del chatrooms[room_id]['messages'][i]
-                save_data()
-                return jsonify({"success": True})
-            else:
-                return jsonify({"error": "You cannot delete other users' messages"}), 403
-
-    return jsonify({"error": "Message not found"}), 404
+    # Find and delete the message, with no other change to the room in between
+    with store.room(room_id):
+        if room_id not in chatrooms:
+            return jsonify({"error": "Invalid request"}), 400
+        position, message = store.find_message(room_id, message_id)
+        if message is None:
+            return jsonify({"error": "Message not found"}), 404
+
+        # Only allow deletion if user is the message author or an admin
+        if message['user'] == username or is_admin:
+            # Completely remove the message, and its file
+            store.delete_message(room_id, position)
+            release_files([message])
+            return jsonify({"success": True})
+        else:
+            return jsonify({"error": "You cannot delete other users' messages"}), 403
 
 @app.route('/clear_messages', methods=['POST'])
 def clear_messages():
@@ -1301,12 +1584,42 @@ def clear_messages():
     if not is_admin:
         return jsonify({"error": "You don't have permission to clear the chat"}), 403
 
-    # Clear all messages in the chatroom
-    chatrooms[room_id]['messages'] = []
-    save_data()
+    # Clear all messages in the chatroom, and then the files sent in it
+    with store.room(room_id):
+        if room_id not in chatrooms:
+            return jsonify({"error": "Chatroom does not exist"}), 404
+        files = store.room_files(room_id)
+        store.clear_messages(room_id)
+    release_files(files)
 
     return jsonify({"success": True})
 
+@app.route('/admin/room_retention', methods=['POST'])
+def set_room_retention():
+    if 'username' not in session:
+        return jsonify({"error": "Not logged in"}), 401
+
+    username = session['username']
+    if not users.get(username, {}).get('is_admin', False):
+        return jsonify({"error": "Not authorized"}), 403
+
+    room_id = request.form.get('room_id')
+    if room_id not in chatrooms:
+        return jsonify({"error": "Chatroom does not exist"}), 404
+
+    # Limits left empty fall back to the defaults, 0 keeps everything
+    policy = {}
+    for limit in RETENTION_LIMITS:
+        value = request.form.get(limit, '').strip()
+        if value:
+            if not value.isdigit():
+                return jsonify({"error": f"{limit} must be a whole number"}), 400
+            policy[limit] = int(value)
+
+    store.set_retention(room_id, policy)
+
+    return jsonify({"success": True, "retention": store.retention_policy(room_id)})
+
 @app.route('/update_display_name', methods=['POST'])
 def update_display_name():
     if 'username' not in session:
@@ -1317,7 +1630,7 @@ def update_display_name():
 
     if username in users:
         users[username]['display_name'] = display_name
-        save_data()
+        store.save_user(username, 'display_name')
         return jsonify({"success": True})
 
     return jsonify({"error": "User not found"}), 404
@@ -1329,9 +1642,13 @@ def update_status():
         status = request.form.get('status', 'online')
 
         if username in users:
-            users[username]['online_status'] = status
-            users[username]['last_active'] = datetime.now().timestamp()
-            save_data()
+            # Heartbeats only go to the presence tracker; the status is saved
+            # when it changes
+            heartbeat(username)
+            if users[username].get('online_status') != status:
+                users[username]['online_status'] = status
+                store.save_user(username, 'online_status')
+                broadcast('presence', 'status', {'user': username, 'status': status})
             return jsonify({"success": True})
     return jsonify({"success": False}), 401
 
@@ -1340,19 +1657,27 @@ def get_online_users():
     if 'username' not in session:
         return jsonify({"error": "Not logged in"}), 401
 
-    online_users = {}
-    current_time = datetime.now().timestamp()
-    # Consider users offline after 20 seconds of inactivity
-    timeout_period = 20  
-
-    for user_id, user_data in users.items():
-        last_active = user_data.get('last_active', 0)
-        if current_time - last_active < timeout_period:
-            online_users[user_id] = 'online'
-        else:
-            online_users[user_id] = 'offline'
-
-    return jsonify(online_users)
+    # ?since=<version> returns only the users who went online or offline
+    # after that version. Shared workers each expire users on their own
+    # clock, so their versions don't match and clients start over instead.
+    since = request.args.get('since', type=int)
+    if since is not None and not store.shared:
+        version, changes = presence.since(since)
+        if changes is not None:
+            if not changes:
+                return "", 304
+            return jsonify({"version": version, "changes": changes})
+
+    version, online = presence.online()
+    # list() copies the names in one go, while other requests may add users
+    online_users = {user_id: 'online' if user_id in online else 'offline' for user_id in list(users)}
+
+    if since is not None:
+        # Too far behind, start over
+        return jsonify({"version": version, "reset": True, "users": online_users})
+    response = jsonify(online_users)
+    response.headers['X-Presence-Version'] = str(version)
+    return response
 
 @app.route('/reset_rickroll', methods=['POST'])
 def reset_rickroll():
@@ -1360,7 +1685,7 @@ def reset_rickroll():
         username = session['username']
         if username in users:
             users[username]['is_rickrolled'] = False
-            save_data()
+            store.save_user(username, 'is_rickrolled')
             return jsonify({"success": True})
     return jsonify({"success": False}), 401
 
@@ -1380,15 +1705,14 @@ def set_real_name():
         # Set name status to done
         users[username]['name'] = 'done'
         # Add to the set of users who have set their real name
-        global real_names_set
-        real_names_set.add(username)
+        store.add_real_name(username)
         # Remove the flag from session
         session['needs_real_name'] = False
         # Set default display settings for real name
         users[username]['show_in_room'] = True
         users[username]['show_in_chat'] = False
         users[username]['show_in_profile'] = False
-        save_data()
+        store.save_user(username, 'real_name', 'name', 'show_in_room', 'show_in_chat', 'show_in_profile')
         print(f"Real name set for {username}: {real_name}")
         return jsonify({"success": True})
 
@@ -1412,11 +1736,9 @@ def remove_real_name():
     users[target_username]['name'] = 'ask'
 
     # Remove from the set of users who have set their real name
-    global real_names_set
-    if target_username in real_names_set:
-        real_names_set.remove(target_username)
+    store.discard_real_name(target_username)
 
-    save_data()
+    store.save_user(target_username, 'real_name', 'name')
     print(f"Real name removed for {target_username} by admin {admin_username}")
     return jsonify({"success": True})
 
@@ -1441,7 +1763,7 @@ def submit_feedback():
     feedback_id = f"{int(time.time())}-{random.randint(1000, 9999)}"
 
     # Add the feedback
-    feedback.append({
+    store.add_feedback({
         'id': feedback_id,
         'username': username,
         'content': feedback_content,
@@ -1449,7 +1771,6 @@ def submit_feedback():
         'read': False
     })
 
-    save_data()
 
     return jsonify({"success": True})
 
@@ -1489,7 +1810,7 @@ def toggle_feedback_read(feedback_id):
     for item in feedback:
         if item['id'] == feedback_id:
             item['read'] = not item['read']
-            save_data()
+            store.save_feedback(feedback_id)
             return jsonify({"success": True})
 
     return jsonify({"error": "Feedback not found"}), 404
@@ -1503,9 +1824,7 @@ def delete_feedback(feedback_id):
     if not users.get(username, {}).get('is_admin', False):
         return jsonify({"error": "Not authorized"}), 403
 
-    global feedback
-    feedback = [item for item in feedback if item['id'] != feedback_id]
-    save_data()
+    store.delete_feedback(feedback_id)
 
     return jsonify({"success": True})
 
@@ -1539,37 +1858,35 @@ def create_poll():
         'created_by': username,
         'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
         'active': True,
-        'votes': {option: [] for option in options}  # Store usernames who voted for each option
+        'ballots': {},  # Option indices each user voted for
+        'tally': [0] * len(options)  # Number of votes for each option
     }
 
     # Add poll to the polls dict
     polls[poll_id] = poll
+    store.save_poll(poll_id)
+    publish_poll(poll_id)
 
     # Add poll to polls chatroom
     if 'polls' not in chatrooms:
-        chatrooms['polls'] = {
+        store.create_room('polls', {
             'name': '📊 Polls',
-            'messages': [],
             'members': [],
             'is_polls_room': True,
             'polls': []
-        }
+        })
 
     # Create a message to announce the poll
-    message_id = f"{int(time.time())}-{random.randint(1000, 9999)}"
     poll_message = {
-        'id': message_id,
         'user': 'SYSTEM',
         'content': f"📊 New Poll: {question}",
         'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'profile_pic': 'default.png',
         'is_system': True,
         'is_poll': True,
         'poll_id': poll_id
     }
 
-    chatrooms['polls']['messages'].append(poll_message)
-    save_data()
+    store.append_message('polls', poll_message)
 
     return jsonify({"success": True, "poll_id": poll_id})
 
@@ -1596,10 +1913,8 @@ def vote_in_poll():
     # If we're just removing votes
     if remove_vote:
         # Remove all votes by this user
-        for option in poll['votes']:
-            if username in poll['votes'][option]:
-                poll['votes'][option].remove(username)
-        save_data()
+        store.cast_vote(poll_id, username, None)
+        publish_poll(poll_id)
         return jsonify({"success": True})
 
     # Otherwise process normal voting
@@ -1619,17 +1934,9 @@ def vote_in_poll():
     if not poll['allow_multiple'] and len(option_indices) > 1:
         return jsonify({"error": "Multiple votes are not allowed for this poll"}), 400
 
-    # Remove previous votes by this user
-    for option in poll['votes']:
-        if username in poll['votes'][option]:
-            poll['votes'][option].remove(username)
-
-    # Add new votes
-    for idx in option_indices:
-        option = poll['options'][idx]
-        poll['votes'][option].append(username)
-
-    save_data()
+    # Replace previous votes by this user
+    store.cast_vote(poll_id, username, option_indices)
+    publish_poll(poll_id)
 
     return jsonify({"success": True})
 
@@ -1653,14 +1960,12 @@ def close_poll():
         return jsonify({"error": "Poll not found"}), 404
 
     polls[poll_id]['active'] = False
-
-    # Create a message to announce the poll closure
-    message_id = f"{int(time.time())}-{random.randint(1000, 9999)}"
+    store.save_poll(poll_id, 'active')
+    publish_poll(poll_id)
 
     # Calculate results
-    results = {}
-    for option, voters in polls[poll_id]['votes'].items():
-        results[option] = len(voters)
+    poll = polls[poll_id]
+    results = dict(zip(poll['options'], poll['tally']))
 
     # Find winning option(s)
     if results:
@@ -1668,8 +1973,7 @@ def close_poll():
         winning_options = [option for option, votes in results.items() if votes == max_votes]
 
         result_message = f"📊 Poll Closed: \"{polls[poll_id]['question']}\"\n\nResults:\n"
-        for option in polls[poll_id]['options']:
-            vote_count = len(polls[poll_id]['votes'][option])
+        for option, vote_count in zip(poll['options'], poll['tally']):
             result_message += f"- {option}: {vote_count} vote(s)"
             if option in winning_options and max_votes > 0:
                 result_message += " 🏆"
@@ -1677,19 +1981,17 @@ def close_poll():
     else:
         result_message = f"📊 Poll Closed: \"{polls[poll_id]['question']}\"\n\nNo votes were cast."
 
+    # Create a message to announce the poll closure
     poll_closure = {
-        'id': message_id,
         'user': 'SYSTEM',
         'content': result_message,
         'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'profile_pic': 'default.png',
         'is_system': True,
         'is_poll_result': True,
         'poll_id': poll_id
     }
 
-    chatrooms['polls']['messages'].append(poll_closure)
-    save_data()
+    store.append_message('polls', poll_closure)
 
     return jsonify({"success": True})
 
@@ -1705,61 +2007,105 @@ def clear_all_polls():
         return jsonify({"error": "Only admins can clear all polls"}), 403
 
     # Clear all polls
-    global polls
-    polls = {}
+    store.clear_polls()
+    broadcast('polls', 'polls_cleared', {})
 
     # Create a system message to announce polls were cleared
-    message_id = f"{int(time.time())}-{random.randint(1000, 9999)}"
     poll_cleared_message = {
-        'id': message_id,
         'user': 'SYSTEM',
         'content': f"📊 All polls have been cleared by {username}",
         'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'profile_pic': 'default.png',
         'is_system': True
     }
 
     # Add message to polls chatroom
     if 'polls' in chatrooms:
-        chatrooms['polls']['messages'].append(poll_cleared_message)
-
-    save_data()
+        store.append_message('polls', poll_cleared_message)
 
     return jsonify({"success": True})
 
+def poll_summary(poll):
+    # Clone the poll data without the votes list to avoid exposing who voted for what
+    return {
+        'id': poll['id'],
+        'question': poll['question'],
+        'options': poll['options'],
+        'allow_multiple': poll['allow_multiple'],
+        'created_by': poll['created_by'],
+        'created_at': poll['created_at'],
+        'active': poll['active'],
+        'results': dict(zip(poll['options'], poll['tally']))
+    }
+
+def publish_poll(poll_id):
+    broadcast('polls', 'poll', poll_summary(polls[poll_id]))
+
+# Public results of all polls as (store.polls_version, summaries), rebuilt
+# only after a poll changed
+poll_results_cache = {'results': (None, {})}
+
+def poll_results():
+    version, results = poll_results_cache['results']
+    if version != store.polls_version:
+        version = store.polls_version
+        results = {poll_id: poll_summary(poll) for poll_id, poll in list(polls.items())}
+        poll_results_cache['results'] = (version, results)
+    return version, results
+
 @app.route('/get_polls')
 def get_polls():
     if 'username' not in session:
         return jsonify({"error": "Not logged in"}), 401
 
-    # Return all polls with their current results
-    poll_data = {}
-    for poll_id, poll in polls.items():
-        # Clone the poll data without the votes list to avoid exposing who voted for what
-        poll_info = {
-            'id': poll['id'],
-            'question': poll['question'],
-            'options': poll['options'],
-            'allow_multiple': poll['allow_multiple'],
-            'created_by': poll['created_by'],
-            'created_at': poll['created_at'],
-            'active': poll['active'],
-            'results': {option: len(voters) for option, voters in poll['votes'].items()},
-            'user_votes': {}
-        }
-
-        # Add info about which options the current user voted for
-        username = session['username']
-        for option, voters in poll['votes'].items():
-            poll_info['user_votes'][option] = username in voters
-
-        poll_data[poll_id] = poll_info
-
-    return jsonify(poll_data)
+    username = session['username']
+    version, results = poll_results()
 
-@app.route('/static/<path:path>')
-def send_static(path):
-    return send_from_directory('static', path)
+    # Nothing changed since the client's copy (which includes its own votes)
+    etag = f"polls-{version}"
+    # Compared weakly: the ETag is sent weak when the response is compressed
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        # Return all polls with their current results
+        poll_data = {}
+        for poll_id, poll_info in results.items():
+            # Add info about which options the current user voted for
+            ballot = polls.get(poll_id, {}).get('ballots', {}).get(username, ())
+            poll_data[poll_id] = dict(poll_info, user_votes={
+                option: i in ballot for i, option in enumerate(poll_info['options'])
+            })
+        response = jsonify(poll_data)
+    response.set_etag(etag)
+    response.vary.add('Cookie')
+    return response
+
+# Uploads are saved under names that are never reused: with the time of the
+# upload (user_1741962739.png) or a content hash. The defaults, classroom
+# files and the app's own assets are replaced in place.
+UNIQUE_NAME = re.compile(r'_\d{10}[._]|\.[0-9a-f]{12}\.|^[0-9a-f]{64}(\.|$)')
+
+def has_unique_name(filename):
+    return bool(UNIQUE_NAME.search(os.path.basename(filename)))
+
+@app.url_defaults
+def version_static_urls(endpoint, values):
+    # url_for('static', filename=...) gets the hash of the file's content,
+    # so the URL changes with the file and can be cached for good
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        digest = static_url_hash(os.path.join('static', values['filename']))
+        if digest:
+            values['v'] = digest
+
+@app.route('/static/<path:filename>', endpoint='static')
+def send_static(filename):
+    if filename.startswith('uploads/'):
+        immutable = not filename.startswith('uploads/classroom/') and has_unique_name(filename)
+    else:
+        # Immutable only when asked for with the current hash, so an old
+        # page asking for an old version doesn't keep the new one for good
+        immutable = request.args.get('v') is not None and \
+            request.args.get('v') == static_url_hash(os.path.join('static', filename))
+    return send_cached('static', filename, immutable=immutable)
 
 # Create default admin profile picture if it doesn't exist
 if not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], 'pfp', 'default.png')):
@@ -1790,21 +2136,23 @@ def edit_message():
 
     is_admin = users.get(username, {}).get('is_admin', False)
 
-    for i, message in enumerate(chatrooms[room_id]['messages']):
-        if message['id'] == message_id:
-            if message['user'] == username or is_admin:
-                # Update message content and add edited info
-                message['content'] = new_content
-                message['edited'] = True
-                message['edited_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                # Force cache invalidation by updating message ID
-                message['id'] = f"{int(time.time())}-{random.randint(1000, 9999)}"
-                save_data()
-                return jsonify({"success": True})
-            else:
-                return jsonify({"error": "You cannot edit other users' messages"}), 403
-
-    return jsonify({"error": "Message not found"}), 404
+    # No other change to the room between reading the message and saving it
+    with store.room(room_id):
+        if room_id not in chatrooms:
+            return jsonify({"error": "Chatroom not found"}), 404
+        position, message = store.find_message(room_id, message_id)
+        if message is None:
+            return jsonify({"error": "Message not found"}), 404
+
+        if message['user'] == username or is_admin:
+            # Update message content and add edited info
+            message['content'] = new_content
+            message['edited'] = True
+            message['edited_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            store.replace_message(room_id, position, message)
+            return jsonify({"success": True})
+        else:
+            return jsonify({"error": "You cannot edit other users' messages"}), 403
 
 if __name__ == '__main__':
     # Save data before starting
@@ -0,0 +1,599 @@
+"""Snapshot + append-only journal persistence for the chat state.
+
+The state is a plain dict of sections ('users', 'chatrooms', 'polls', ...).
+Instead of pickling all of it on every request, each mutation is appended to
+a journal file as a small (op, path, value) change. Journal files are numbered
+by generation; once the active one grows past a threshold it is sealed and a
+background thread folds the sealed files into a new snapshot.
+
+Request threads never touch the disk: append() only serializes the change and
+queues it. A dedicated writer thread coalesces queued records and writes and
+fsyncs them together, at most every flush_interval seconds or as soon as
+flush_records are pending. If the writer falls behind by more than max_loss
+seconds, appends block until it catches up, which bounds how much can be lost
+in a crash. A batch that fails to write (disk full, I/O error) stays queued
+and is retried, less and less often; flush() and appends waiting on the
+writer raise JournalWriteError instead of returning as if it was written.
+
+On startup the snapshot is loaded and every journal generation newer than the
+one recorded in the snapshot is replayed on top of it. Snapshots are written
+in the format of snapshot.py; journal records are pickled, and only ever read
+back by this class.
+
+A snapshot is written to a temporary file and renamed into place, one at a
+time. The one it replaces is kept (<snapshot>.prev) along with the journal
+files written since, so if the current snapshot turns out to be damaged,
+loading falls back to the previous one and replays more of the journal.
+The first snapshot written after a schema migration (see snapshot.migrate)
+moves the one from before it aside to <snapshot>.schema<N>; the previous
+snapshot is then no fallback, as the
+journal files that came after it are gone.
+
+One process at a time has the journal open: load() takes an exclusive lock
+on <snapshot>.lock (held until close()), so a second one, such as
+reset_admin.py while the server runs, can't write a snapshot or journal
+generation over the other's.
+"""
+import glob
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from snapshot import READ_ERRORS, SCHEMA_VERSION, convert, read_header, read_snapshot, write_snapshot
+
+# Every journal file starts with a magic string and its generation number
+LOG_MAGIC = b'NDJRNL1\n'
+LOG_HEADER = struct.Struct('<Q')
+# Each record is framed as (payload length, crc32 of payload)
+FRAME = struct.Struct('<II')
+# Seconds between retries of a failed write, doubling up to the maximum
+WRITE_RETRY = 0.1
+MAX_WRITE_RETRY = 5.0
+# Retries of a failed write when closing, before its records are given up
+CLOSE_WRITE_RETRIES = 5
+
+
+class JournalLocked(Exception):
+    """The journal is open in another process."""
+
+
+class JournalWriteError(Exception):
+    """Queued records could not be written (they stay queued)."""
+
+
+def apply_change(state, change):
+    """Apply a single journal change to the state dict."""
+    op, path, value = change
+    target = state
+    for key in path[:-1]:
+        target = target[key]
+    key = path[-1]
+
+    if op == 'set':
+        target[key] = value
+    elif op == 'del':
+        if isinstance(target, dict):
+            target.pop(key, None)
+        else:
+            del target[key]
+    elif op == 'append':
+        target[key].append(value)
+    elif op == 'remove':
+        if value in target[key]:
+            target[key].remove(value)
+    elif op == 'add':
+        target[key].add(value)
+    elif op == 'discard':
+        target[key].discard(value)
+    else:
+        raise ValueError(f"Unknown journal operation: {op}")
+
+
+class Journal:
+    def __init__(self, snapshot_path, compact_bytes=4 * 1024 * 1024,
+                 flush_interval=0.05, flush_records=256, max_loss=1.0):
+        self.snapshot_path = snapshot_path
+        self.compact_bytes = compact_bytes
+        self.flush_interval = flush_interval
+        self.flush_records = flush_records
+        self.max_loss = max_loss
+
+        # Guards the journal file (held by the writer while writing)
+        self._io_lock = threading.Lock()
+        # Guards the queue of pending records and the counters
+        self._cond = threading.Condition()
+        self._snapshot_lock = threading.Lock()
+        self._file = None
+        self._lock_file = None
+        self._generation = 0
+        self._snapshot_generation = 0
+        # Generation of the snapshot kept in <snapshot>.prev
+        self._previous_generation = 0
+        # Schema version of the loaded data (see snapshot.migrate)
+        self.schema = SCHEMA_VERSION
+        self._snapshot_schema = SCHEMA_VERSION
+        self._compacting = False
+        self._closed = False
+        self._writer = None
+
+        self._pending = []
+        self._pending_since = None
+        self._inflight_since = None
+        self._flush_requested = False
+        self._enqueued = 0
+        self._written = 0
+        # Failed writes so far, and the error of the last one
+        self._write_failures = 0
+        self._write_error = None
+        self._stats = {
+            'flushes': 0,
+            'records_written': 0,
+            'bytes_written': 0,
+            'max_queue_depth': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0,
+            'backpressure_waits': 0,
+            'write_errors': 0,
+        }
+
+    # ---- file helpers ----
+
+    def _log_path(self, generation):
+        return f"{self.snapshot_path}.{generation:06d}.log"
+
+    def _log_files(self):
+        """Return (generation, path) for every journal file, oldest first."""
+        files = []
+        for path in glob.glob(f"{glob.escape(self.snapshot_path)}.*.log"):
+            try:
+                generation = int(path[len(self.snapshot_path) + 1:-len('.log')])
+            except ValueError:
+                continue
+            files.append((generation, path))
+        return sorted(files)
+
+    def _lock(self):
+        # Without fcntl (Windows) nothing stops a second process
+        self._lock_file = open(f"{self.snapshot_path}.lock", 'a')
+        if fcntl is None:
+            return
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            self._lock_file = None
+            raise JournalLocked(f"{self.snapshot_path} is in use by another process")
+
+    def _previous_path(self):
+        return f"{self.snapshot_path}.prev"
+
+    def _backup_path(self):
+        # Where the snapshot from before a migration is kept. A schema 1
+        # snapshot was converted from the pickle convert kept, if it's there.
+        pickle_path = f"{self.snapshot_path}.pickle"
+        if self._snapshot_schema == 1 and os.path.exists(pickle_path):
+            return pickle_path
+        return f"{self.snapshot_path}.schema{self._snapshot_schema}"
+
+    def _convert_pickle(self):
+        # A pickle snapshot from before the snapshot format is the app's own
+        # file, so it is converted rather than refused (the pickle is kept as
+        # <snapshot>.pickle)
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                is_pickle = read_header(f) is None
+        except (OSError, *READ_ERRORS):
+            # Missing or damaged: left to _read_snapshot
+            return
+        if is_pickle:
+            convert(self.snapshot_path)
+
+    def _read_previous(self):
+        """Return (state, generation, schema) of the previous snapshot, or
+        None if there is none or the journal files after it are gone."""
+        previous_path = self._previous_path()
+        if not os.path.exists(previous_path):
+            return None
+        state, generation, schema = read_snapshot(previous_path)
+        later = [log_generation for log_generation, _ in self._log_files() if log_generation > generation]
+        if later and later[0] != generation + 1:
+            # From before a migration: its journal files were removed
+            print(f"Not loading {previous_path}: the journal files after it are gone")
+            return None
+        return state, generation, schema
+
+    def _read_snapshot(self):
+        """Return (state, generation, schema) of the current snapshot, or of
+        the previous one if the current one is missing or damaged."""
+        if not os.path.exists(self.snapshot_path):
+            # Stopped between the two renames of write_snapshot
+            return self._read_previous() or (None, 0, SCHEMA_VERSION)
+        try:
+            return read_snapshot(self.snapshot_path)
+        except READ_ERRORS as e:
+            result = self._read_previous()
+            if result is None:
+                raise
+            print(f"Snapshot {self.snapshot_path} is damaged ({e!r}), loading {self._previous_path()}")
+        # Set it aside, so it doesn't become the previous snapshot of the next one
+        os.replace(self.snapshot_path, f"{self.snapshot_path}.damaged")
+        return result
+
+    def _write_snapshot(self, state, generation, schema=SCHEMA_VERSION):
+        # One writer at a time, and never let an older compaction overwrite a
+        # newer checkpoint
+        with self._snapshot_lock:
+            if generation < self._snapshot_generation:
+                return False
+            # The journal after a snapshot has the shape of the data at the
+            # time, so a snapshot from before a migration is no fallback: it
+            # is kept aside instead, and the previous one is left alone
+            previous_path = self._previous_path()
+            if schema != self._snapshot_schema:
+                previous_path = None
+                if os.path.exists(self.snapshot_path):
+                    backup_path = self._backup_path()
+                    if not os.path.exists(backup_path):
+                        os.replace(self.snapshot_path, backup_path)
+                    print(f"The snapshot from before the migration is kept as {backup_path}")
+            write_snapshot(self.snapshot_path, state, generation, schema,
+                           previous_path=previous_path)
+            self._previous_generation = self._snapshot_generation
+            self._snapshot_generation = generation
+            self._snapshot_schema = schema
+
+        # Journal files folded into the previous snapshot are no longer
+        # needed; later ones are kept to fall back on it
+        for log_generation, path in self._log_files():
+            if log_generation <= self._previous_generation and log_generation != self._generation:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return True
+
+    def _replay(self, path, state, truncate=False):
+        """Replay a journal file into state; returns (generation, records)."""
+        count = 0
+        with open(path, 'r+b' if truncate else 'rb') as f:
+            header = f.read(len(LOG_MAGIC) + LOG_HEADER.size)
+            if len(header) < len(LOG_MAGIC) + LOG_HEADER.size or not header.startswith(LOG_MAGIC):
+                return None, 0
+            generation = LOG_HEADER.unpack(header[len(LOG_MAGIC):])[0]
+
+            good_offset = f.tell()
+            while True:
+                frame = f.read(FRAME.size)
+                if len(frame) < FRAME.size:
+                    break
+                length, checksum = FRAME.unpack(frame)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    print(f"Journal {path}: torn record at offset {good_offset}, ignoring the rest")
+                    break
+                for change in pickle.loads(payload):
+                    try:
+                        apply_change(state, change)
+                    except (KeyError, IndexError, TypeError, ValueError) as e:
+                        print(f"Journal {path}: skipping change {change[:2]}: {e!r}")
+                count += 1
+                good_offset = f.tell()
+
+            # Drop a partially written tail so new records follow a valid one
+            if truncate:
+                f.truncate(good_offset)
+        return generation, count
+
+    def _open_log(self, generation):
+        path = self._log_path(generation)
+        exists = os.path.exists(path)
+        self._file = open(path, 'ab')
+        if not exists or self._file.tell() == 0:
+            self._file.write(LOG_MAGIC + LOG_HEADER.pack(generation))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._generation = generation
+
+    # ---- public API ----
+
+    def load(self):
+        """Load the snapshot, replay newer journal files and open the journal.
+
+        Returns None if there is no saved data at all; raises JournalLocked
+        if another process has it open.
+        """
+        self._lock()
+        self._convert_pickle()
+        state, snapshot_generation, self.schema = self._read_snapshot()
+        self._snapshot_generation = snapshot_generation
+        self._snapshot_schema = self.schema
+        log_files = self._log_files()
+
+        if state is None and log_files:
+            state = {}
+
+        last_generation = snapshot_generation
+        pending = []
+        for generation, path in log_files:
+            if generation <= snapshot_generation:
+                # Already folded into the snapshot; removed with the next one
+                continue
+            is_last = path == log_files[-1][1]
+            header_generation, count = self._replay(path, state, truncate=is_last)
+            if header_generation is None:
+                continue
+            if count:
+                print(f"Replayed {count} journal records from {path}")
+            last_generation = generation
+            pending.append(generation)
+
+        with self._io_lock:
+            # Keep appending to the newest journal file, or start a new one
+            if pending:
+                self._open_log(pending[-1])
+            else:
+                self._open_log(last_generation + 1)
+
+        self._start_writer()
+
+        # Fold any sealed journals left over from before the restart
+        if len(pending) > 1:
+            self._start_compaction(pending[-2])
+
+        return state
+
+    def read(self):
+        """Return the saved state (snapshot plus journals) without opening the
+        journal for writing, or None if there is no saved data."""
+        state, snapshot_generation, _ = self._read_snapshot()
+        log_files = [(g, p) for g, p in self._log_files() if g > snapshot_generation]
+        if state is None and log_files:
+            state = {}
+        for generation, path in log_files:
+            self._replay(path, state)
+        return state
+
+    def append(self, *changes):
+        """Queue one record made of one or more changes for the writer."""
+        # Serialize now so later mutations of the values can't leak into it
+        payload = pickle.dumps(changes, protocol=pickle.HIGHEST_PROTOCOL)
+        record = FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._cond:
+            if self._closed:
+                return
+            now = time.monotonic()
+            if not self._pending:
+                self._pending_since = now
+            self._pending.append(record)
+            self._enqueued += 1
+            sequence = self._enqueued
+
+            depth = len(self._pending)
+            if depth > self._stats['max_queue_depth']:
+                self._stats['max_queue_depth'] = depth
+            if depth >= self.flush_records:
+                self._cond.notify_all()
+
+            # Bound the durability window if the writer has fallen behind
+            oldest = self._inflight_since or self._pending_since
+            if oldest is not None and now - oldest > self.max_loss:
+                self._stats['backpressure_waits'] += 1
+                self._flush_requested = True
+                self._cond.notify_all()
+                self._wait_written(sequence)
+
+    def flush(self):
+        """Block until everything queued so far is written and fsynced;
+        raises JournalWriteError if a write fails meanwhile."""
+        with self._cond:
+            sequence = self._enqueued
+            self._flush_requested = True
+            self._cond.notify_all()
+            self._wait_written(sequence)
+
+    def _wait_written(self, sequence):
+        # Called with the condition held
+        failures = self._write_failures
+        while self._written < sequence and self._writer_alive():
+            if self._write_failures != failures:
+                raise JournalWriteError(f"Could not write the journal: {self._write_error!r}")
+            self._cond.wait(self.max_loss)
+
+    def seal(self):
+        """Write out everything queued and start a new journal file; returns
+        the generation of the sealed one."""
+        self.flush()
+        with self._io_lock:
+            return self._rotate()
+
+    def checkpoint(self, state, sealed=None):
+        """Write a full snapshot of state and start a fresh journal.
+
+        state must not change while it is written. To snapshot live state,
+        pass a copy taken together with seal(), and seal()'s generation as
+        sealed, while nothing changes it.
+        """
+        if sealed is None:
+            sealed = self.seal()
+        self._write_snapshot(state, sealed)
+
+    def stats(self):
+        """Return writer counters (queue depth, flush latency, ...)."""
+        with self._cond:
+            stats = dict(self._stats)
+            stats['queue_depth'] = len(self._pending)
+            stats['generation'] = self._generation
+            stats['snapshot_generation'] = self._snapshot_generation
+        total_ms = stats.pop('total_flush_ms')
+        stats['avg_flush_ms'] = round(total_ms / stats['flushes'], 3) if stats['flushes'] else 0.0
+        return stats
+
+    def close(self):
+        """Flush whatever is still queued and stop the writer thread."""
+        try:
+            self.flush()
+        except JournalWriteError as e:
+            # The writer tries a few more times before giving up
+            print(e)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+        with self._io_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    # ---- background work ----
+
+    def _rotate(self):
+        """Seal the active journal file and open the next generation.
+
+        Must be called with the io lock held. Returns the sealed generation.
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        sealed = self._generation
+        self._open_log(sealed + 1)
+        return sealed
+
+    def _truncate(self, offset):
+        # Drop whatever part of a failed batch made it to the file, so the
+        # retry follows the last whole record (replay stops at a torn one)
+        path = self._file.name
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        try:
+            os.truncate(path, offset)
+        finally:
+            self._file = open(path, 'ab')
+
+    def _writer_alive(self):
+        return self._writer is not None and self._writer.is_alive()
+
+    def _start_writer(self):
+        if self._writer is not None:
+            return
+        self._writer = threading.Thread(target=self._write_loop, name='journal-writer', daemon=True)
+        self._writer.start()
+
+    def _write_loop(self):
+        failures = 0
+        while True:
+            with self._cond:
+                # Sleep until a batch is due: enough records, old enough, or asked for
+                while not (self._closed or self._flush_requested):
+                    if not self._pending:
+                        self._cond.wait()
+                        continue
+                    due_in = self.flush_interval - (time.monotonic() - self._pending_since)
+                    if due_in <= 0 or len(self._pending) >= self.flush_records:
+                        break
+                    self._cond.wait(due_in)
+
+                batch = self._pending
+                self._pending = []
+                self._inflight_since = self._pending_since
+                self._pending_since = None
+                self._flush_requested = False
+                closing = self._closed
+
+            if batch:
+                try:
+                    self._write_batch(batch)
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    delay = min(WRITE_RETRY * 2 ** (failures - 1), MAX_WRITE_RETRY)
+                    with self._cond:
+                        self._write_failures += 1
+                        self._write_error = e
+                        self._stats['write_errors'] += 1
+                        if closing and failures > CLOSE_WRITE_RETRIES:
+                            print(f"Error writing journal: {e!r}; giving up {len(self._pending) + len(batch)} records")
+                            self._cond.notify_all()
+                            break
+                        # None of it is written: it goes first in the next batch
+                        self._pending[:0] = batch
+                        self._pending_since = self._inflight_since
+                        self._inflight_since = None
+                        self._flush_requested = True
+                        self._cond.notify_all()
+                    print(f"Error writing journal: {e!r}; retrying in {delay:.1f}s")
+                    time.sleep(delay)
+                    continue
+
+            with self._cond:
+                self._written += len(batch)
+                self._inflight_since = None
+                self._cond.notify_all()
+                if closing and not self._pending:
+                    break
+
+    def _write_batch(self, batch):
+        data = b''.join(batch)
+        with self._io_lock:
+            start = time.monotonic()
+            offset = self._file.tell()
+            try:
+                self._file.write(data)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except OSError:
+                self._truncate(offset)
+                raise
+            elapsed_ms = (time.monotonic() - start) * 1000
+
+            if self._file.tell() >= self.compact_bytes and not self._compacting:
+                sealed = self._rotate()
+                self._start_compaction(sealed)
+
+        with self._cond:
+            self._stats['flushes'] += 1
+            self._stats['records_written'] += len(batch)
+            self._stats['bytes_written'] += len(data)
+            self._stats['last_flush_ms'] = round(elapsed_ms, 3)
+            self._stats['max_flush_ms'] = max(self._stats['max_flush_ms'], round(elapsed_ms, 3))
+            self._stats['total_flush_ms'] += elapsed_ms
+
+    def _start_compaction(self, upto_generation):
+        self._compacting = True
+        thread = threading.Thread(target=self._compact, args=(upto_generation,),
+                                  name='journal-compact', daemon=True)
+        thread.start()
+
+    def _compact(self, upto_generation):
+        try:
+            # Rebuild the state from disk so the live dicts are never touched
+            state, generation, schema = self._read_snapshot()
+            if state is None:
+                state = {}
+            for log_generation, path in self._log_files():
+                if generation < log_generation <= upto_generation:
+                    self._replay(path, state)
+            start = time.monotonic()
+            # Data that is not migrated yet keeps its schema version
+            if self._write_snapshot(state, upto_generation, schema):
+                print(f"Compacted journal up to generation {upto_generation} "
+                      f"in {time.monotonic() - start:.2f}s")
+        except Exception as e:
+            print(f"Error compacting journal: {e}")
+        finally:
+            self._compacting = False
@@ -0,0 +1,128 @@
+"""In-memory presence: who is online, kept out of the user store.
+
+A heartbeat only touches this tracker; nothing is written to disk. A user
+goes offline when no heartbeat came for `timeout` seconds. Deadlines sit in
+a time wheel of `slot`-second buckets, so expiring users only looks at the
+buckets that are due instead of at every user. Every online/offline change
+gets a version, and clients can ask for the changes since the version they
+last saw.
+"""
+
+import bisect
+import threading
+import time
+
+
+class Presence:
+    def __init__(self, timeout=20, slot=1.0, keep=1000):
+        self.timeout = timeout
+        self.slot = slot
+        self.keep = keep
+        self._lock = threading.Lock()
+        # username -> monotonic time at which the user goes offline
+        self._deadlines = {}
+        # bucket number -> usernames whose deadline falls in that bucket
+        self._wheel = {}
+        # Versions start from the clock so they keep growing across restarts
+        self._start = time.time_ns() // 1000
+        self._version = self._start
+        # (version, username, 'online' or 'offline') for every change newer than floor
+        self._floor = self._start
+        self._log = []
+        # Called as listener(username, status, version) after each change
+        self.listeners = []
+        self._ticker = None
+
+    def start(self):
+        """Expire users in the background too, so offline changes are not
+        only noticed on the next request."""
+        if self._ticker is None:
+            self._ticker = threading.Thread(target=self._tick, name='presence', daemon=True)
+            self._ticker.start()
+
+    def _tick(self):
+        while True:
+            time.sleep(self.slot)
+            self.expire()
+
+    def heartbeat(self, username):
+        """Keep a user online for another timeout; True if they just came online."""
+        now = time.monotonic()
+        changes = []
+        with self._lock:
+            self._expire(now, changes)
+            old = self._deadlines.get(username)
+            if old is None:
+                self._change(username, 'online', changes)
+            else:
+                self._unschedule(username, old)
+            deadline = now + self.timeout
+            self._deadlines[username] = deadline
+            self._wheel.setdefault(int(deadline // self.slot), set()).add(username)
+        self._notify(changes)
+        return old is None
+
+    def leave(self, username):
+        changes = []
+        with self._lock:
+            deadline = self._deadlines.pop(username, None)
+            if deadline is not None:
+                self._unschedule(username, deadline)
+                self._change(username, 'offline', changes)
+        self._notify(changes)
+
+    def expire(self):
+        changes = []
+        with self._lock:
+            self._expire(time.monotonic(), changes)
+        self._notify(changes)
+
+    def online(self):
+        """Return (version, set of online usernames)."""
+        self.expire()
+        with self._lock:
+            return self._version, set(self._deadlines)
+
+    def since(self, version):
+        """Return (current version, {username: status}) for the changes after
+        version, or (current version, None) if they are no longer known."""
+        self.expire()
+        with self._lock:
+            if version == self._version:
+                return self._version, {}
+            if version > self._version or version < self._floor:
+                return self._version, None
+            start = bisect.bisect_right(self._log, version, key=lambda change: change[0])
+            # Later changes of a user override earlier ones
+            return self._version, {username: status for _, username, status in self._log[start:]}
+
+    def _unschedule(self, username, deadline):
+        bucket = int(deadline // self.slot)
+        users = self._wheel.get(bucket)
+        if users is not None:
+            users.discard(username)
+            if not users:
+                del self._wheel[bucket]
+
+    def _expire(self, now, changes):
+        # Only buckets that are entirely in the past, so a user goes offline
+        # at most one slot late. The wheel holds about timeout / slot buckets.
+        current = int(now // self.slot)
+        for bucket in [bucket for bucket in self._wheel if bucket < current]:
+            for username in self._wheel.pop(bucket):
+                del self._deadlines[username]
+                self._change(username, 'offline', changes)
+
+    def _change(self, username, status, changes):
+        self._version += 1
+        self._log.append((self._version, username, status))
+        # Trim in batches so changes stay cheap
+        if len(self._log) > 2 * self.keep:
+            self._floor = self._log[-self.keep - 1][0]
+            del self._log[:-self.keep]
+        changes.append((username, status, self._version))
+
+    def _notify(self, changes):
+        for username, status, version in changes:
+            for listener in self.listeners:
+                listener(username, status, version)
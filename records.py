@@ -0,0 +1,95 @@
+"""Compact in-memory form of chat messages.
+
+Routes build and receive messages as plain dicts (that's what goes out as
+JSON), but MemoryStorage keeps thousands of them per room, where a dict with
+the same keys repeated in every message and a formatted timestamp string
+cost several times the message text itself. Message keeps the common fields
+in slots, the time as epoch seconds and the author's name interned; the
+rarer fields (files, pings, edits, ...) go into a small dict only for the
+messages that have them.
+
+A message doesn't keep the author's profile picture; it is looked up when
+the message is read (see Storage._profile_pic), so a new picture also shows
+on old messages.
+"""
+import sys
+from datetime import datetime
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def format_time(t):
+    return datetime.fromtimestamp(t).strftime(TIMESTAMP_FORMAT)
+
+
+def parse_time(timestamp):
+    """Return the epoch seconds of a timestamp string, or None if it can't
+    be turned back into the same string (bad format, DST overlap)."""
+    try:
+        t = int(datetime.strptime(timestamp, TIMESTAMP_FORMAT).timestamp())
+    except (TypeError, ValueError):
+        return None
+    return t if format_time(t) == timestamp else None
+
+
+class Message:
+    __slots__ = ('seq', 'user', 'content', 'time', 'is_system', 'deleted', 'legacy_id', 'extra')
+
+    def __init__(self, seq, user, content, time=None, is_system=False, deleted=False,
+                 legacy_id=None, extra=None):
+        self.seq = seq
+        self.user = sys.intern(user) if isinstance(user, str) else user
+        self.content = content
+        self.time = time
+        self.is_system = is_system
+        # A tombstone left in the hot tail by delete_message
+        self.deleted = deleted
+        # The id of a message from before ids were made from the room and seq
+        self.legacy_id = legacy_id
+        # Any other fields, or None
+        self.extra = extra
+
+    def __reduce__(self):
+        # Pickles as a plain tuple of the fields, without the slot names
+        return (Message, (self.seq, self.user, self.content, self.time, self.is_system,
+                          self.deleted, self.legacy_id, self.extra))
+
+    @classmethod
+    def tombstone(cls, message):
+        return cls(message.seq, None, None, deleted=True, legacy_id=message.legacy_id)
+
+    @classmethod
+    def from_dict(cls, room_id, message):
+        extra = {key: value for key, value in message.items()
+                 if key not in ('seq', 'id', 'user', 'content', 'timestamp', 'is_system', 'profile_pic')}
+        t = parse_time(message.get('timestamp'))
+        if t is None and 'timestamp' in message:
+            extra['timestamp'] = message['timestamp']
+        legacy_id = message.get('id')
+        if legacy_id == f"{room_id}-{message['seq']}":
+            legacy_id = None
+        return cls(message['seq'], message.get('user'), message.get('content'), t,
+                   message.get('is_system', False), legacy_id=legacy_id, extra=extra or None)
+
+    def message_id(self, room_id):
+        return self.legacy_id or f"{room_id}-{self.seq}"
+
+    @property
+    def timestamp(self):
+        if self.time is not None:
+            return format_time(self.time)
+        return (self.extra or {}).get('timestamp', '')
+
+    def to_dict(self, room_id, profile_pic):
+        message = {
+            'id': self.message_id(room_id),
+            'seq': self.seq,
+            'user': self.user,
+            'content': self.content,
+            'timestamp': self.timestamp,
+            'profile_pic': profile_pic,
+            'is_system': self.is_system
+        }
+        if self.extra:
+            message.update(self.extra)
+        return message
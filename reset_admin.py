@@ -1,10 +1,11 @@
 
-import pickle
 import os
 import random
 import string
 import argparse
 from werkzeug.security import generate_password_hash
+from persistence import JournalLocked
+from storage import open_storage
 
 # Parse command line arguments
 parser = argparse.ArgumentParser(description='Reset or create admin user with a specified username and password')
@@ -13,18 +14,26 @@ parser.add_argument('-p', '--password', help='Admin password (if not provided, a
 parser.add_argument('-ua', '--unadmin', help='Remove admin privileges from specified user')
 args = parser.parse_args()
 
-# Data storage
+# Data storage (same backend settings as main.py)
 data_file = 'chat_data.pkl'
+db_file = os.environ.get('CHAT_SQLITE_FILE', 'chat_data.db')
+# Shared workers (CHAT_SHARED=1) pick up the change while running
+shared = os.environ.get('CHAT_SHARED') == '1'
+backend = os.environ.get('CHAT_STORAGE', 'memory')
 
 # Load existing data
-if os.path.exists(data_file):
-    with open(data_file, 'rb') as f:
-        data = pickle.load(f)
-    users = data.get('users', {})
-    chatrooms = data.get('chatrooms', {})
-    invites = data.get('invites', {})
-    pending_users = data.get('pending_users', {})
-    feedback = data.get('feedback', [])
+if os.path.exists(data_file) or os.path.exists(db_file):
+    store = open_storage(backend, data_file=data_file, db_file=db_file,
+                         shared=shared)
+    try:
+        store.load()
+    except JournalLocked:
+        # The memory backend's files belong to the running app: a snapshot
+        # written here would lose the chat since it loaded them
+        print("The chat application is running. Stop it first, or use the sqlite backend "
+              "with CHAT_SHARED=1 to change users while it runs.")
+        exit(1)
+    users = store.users
 else:
     print("No data file found. Please run the main application first.")
     exit(1)
@@ -34,6 +43,7 @@ if args.unadmin:
     if args.unadmin in users:
         if users[args.unadmin].get('is_admin', False):
             users[args.unadmin]['is_admin'] = False
+            store.save_user(args.unadmin, 'is_admin')
             print(f"Admin privileges removed from user: {args.unadmin}")
         else:
             print(f"User {args.unadmin} is not an admin.")
@@ -50,6 +60,7 @@ else:
     if ADMIN_USERNAME in users:
         users[ADMIN_USERNAME]['password'] = generate_password_hash(admin_password)
         users[ADMIN_USERNAME]['is_admin'] = True
+        store.save_user(ADMIN_USERNAME, 'password', 'is_admin')
         print(f"Admin password reset. Username: {ADMIN_USERNAME}, Password: {admin_password}")
     else:
         users[ADMIN_USERNAME] = {
@@ -62,18 +73,14 @@ else:
             'name_font': 'Arial, sans-serif',
             'is_rickrolled': False
         }
+        store.save_user(ADMIN_USERNAME)
         print(f"Admin account created. Username: {ADMIN_USERNAME}, Password: {admin_password}")
 
 # Save data
-data = {
-    'users': users,
-    'chatrooms': chatrooms,
-    'invites': invites,
-    'pending_users': pending_users,
-    'feedback': feedback
-}
-with open(data_file, 'wb') as f:
-    pickle.dump(data, f)
+store.checkpoint()
+store.close()
 
 print("Data saved successfully.")
-print("\nIMPORTANT: You must restart the chat application for these changes to take effect.")
+# (the memory backend's files can't be changed while the app runs)
+if backend == 'sqlite' and not shared:
+    print("\nIMPORTANT: You must restart the chat application for these changes to take effect.")
@@ -0,0 +1,500 @@
+"""Snapshot file format for the journal (see persistence.py).
+
+A snapshot holds the chat state, a dict of sections ('users', 'chatrooms',
+'polls', ...), in a format that needs no pickle to read:
+
+    b'NDSNAP3\\n'
+    header length (4 bytes, little endian)
+    header: JSON {"schema": <schema version>, "generation": <journal generation>,
+                  "sections": {name: [offset, length, crc32], ...}}
+    one payload per section, at the offsets given in the header (counted
+    from the end of the header)
+
+Sections can be read on their own (read_snapshot(path, sections=[...])) and
+are checked against their CRC. Every section but chatrooms is a JSON
+document, with sets as lists.
+
+Messages make up nearly all of a snapshot, so the chatrooms section is a
+series of parts, each prefixed with its length (4 bytes, little endian):
+the rooms as JSON, without their messages, then one part per room's
+messages. Those of Message records are stored by column: seqs, times,
+author indices (into a list of the authors) and content lengths as arrays
+of little endian integers, a byte of flags per message, the contents as
+one UTF-8 string, and the few legacy ids and extra fields as JSON. Saving
+and loading them is a handful of C-level array and string operations
+rather than an object per field, which beats pickle both ways (see
+benchmark()). Message dicts (schema 1) are stored as a JSON list, and room
+patches (keyed by seq) as [seq, message] pairs in the rooms' JSON.
+
+The schema version says which shape the data has. When it is older than
+SCHEMA_VERSION, migrate() brings loaded data up to date; each step runs once,
+after which the store writes a snapshot with the new version.
+
+Snapshots of the previous version of this format (NDSNAP2, all sections
+JSON) are still read. Snapshots written before it are plain pickles, which
+are only loaded to convert them (as schema version 1, migrated when the
+store loads the result), since loading a pickle can run any code. The
+journal converts its own snapshot when it finds a pickle there, keeping it
+as <snapshot>.pickle; other files are converted with:
+
+    python snapshot.py convert chat_data.pkl
+"""
+import gc
+import itertools
+import json
+import os
+import pickle
+import struct
+import sys
+import zlib
+from array import array
+
+from records import Message
+
+MAGIC = b'NDSNAP3\n'
+# All sections JSON, chatrooms with its messages
+MAGIC_JSON = b'NDSNAP2\n'
+HEADER_LENGTH = struct.Struct('<I')
+PART_LENGTH = struct.Struct('<I')
+# The time column's stand-in for messages without a time
+NO_TIME = -2 ** 63
+# Flags byte of a message
+IS_SYSTEM = 1
+DELETED = 2
+# Kinds of messages part
+RECORDS = b'R'
+DICTS = b'D'
+
+# Version 1: pickled dicts with messages as dicts
+# Version 2: messages as Message records, polls with ballots and tallies
+SCHEMA_VERSION = 2
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class PickleSnapshot(Exception):
+    """The snapshot is a pickle, to convert first (see convert())."""
+
+
+# What reading a damaged or cut short snapshot can raise
+READ_ERRORS = (SnapshotError, ValueError, KeyError, TypeError, IndexError, EOFError, struct.error)
+
+
+# ---- encoding ----
+
+def _encode_message(message):
+    if isinstance(message, Message):
+        fields = list(message.__reduce__()[1])
+        # Leave out trailing fields that have their default value
+        while fields[-1] is None or fields[-1] is False:
+            fields.pop()
+        return fields
+    return message
+
+
+def _decode_message(message):
+    if isinstance(message, list):
+        return Message(*message)
+    return message
+
+
+def _json(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _int_array(typecode, data):
+    # Arrays are stored little endian
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def _array_bytes(typecode, values):
+    values = array(typecode, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def _pack_parts(parts):
+    return b''.join(PART_LENGTH.pack(len(part)) + part for part in parts)
+
+
+def _unpack_parts(data):
+    data = memoryview(data)
+    parts = []
+    offset = 0
+    while offset < len(data):
+        length = PART_LENGTH.unpack_from(data, offset)[0]
+        offset += PART_LENGTH.size
+        if offset + length > len(data):
+            raise SnapshotError("Message part cut short")
+        parts.append(data[offset:offset + length])
+        offset += length
+    return parts
+
+
+def _encode_records(messages):
+    # A list of Message records as columns; TypeError if they don't fit them
+    if not all(isinstance(message, Message) for message in messages):
+        raise TypeError("not all Message records")
+    authors = {}
+    author_indices = [authors.setdefault(message.user, len(authors)) for message in messages]
+    rare = {i: [message.legacy_id, message.extra] for i, message in enumerate(messages)
+            if message.legacy_id is not None or message.extra is not None}
+    contents = [message.content for message in messages]
+    # Tombstones have no content
+    no_content = [i for i, content in enumerate(contents) if content is None]
+    return [
+        RECORDS,
+        _json({'authors': list(authors), 'rare': rare, 'no_content': no_content}),
+        _array_bytes('q', [message.seq for message in messages]),
+        _array_bytes('q', [NO_TIME if message.time is None else message.time for message in messages]),
+        _array_bytes('i', author_indices),
+        bytes([(IS_SYSTEM if message.is_system else 0) | (DELETED if message.deleted else 0)
+               for message in messages]),
+        _array_bytes('q', [len(content or '') for content in contents]),
+        ''.join(content for content in contents if content is not None).encode('utf-8', 'surrogatepass'),
+    ]
+
+
+def _decode_records(parts):
+    info = json.loads(bytes(parts[1]))
+    seqs = _int_array('q', parts[2]).tolist()
+    times = _int_array('q', parts[3]).tolist()
+    if NO_TIME in times:
+        times = [None if t == NO_TIME else t for t in times]
+    authors = [sys.intern(author) if isinstance(author, str) else author for author in info['authors']]
+    users = [authors[i] for i in _int_array('i', parts[4])]
+    flags = bytes(parts[5])
+    text = bytes(parts[7]).decode('utf-8', 'surrogatepass')
+    ends = list(itertools.accumulate(_int_array('q', parts[6])))
+    contents = list(map(text.__getitem__, map(slice, [0] + ends[:-1], ends)))
+    for i in info['no_content']:
+        contents[i] = None
+    if not len(seqs) == len(times) == len(users) == len(flags) == len(contents):
+        raise SnapshotError("Message columns of different lengths")
+    columns = [seqs, users, contents, times]
+    if flags.count(0) != len(flags):
+        columns.append([bool(flag & IS_SYSTEM) for flag in flags])
+        columns.append([bool(flag & DELETED) for flag in flags])
+    # Nothing made here can be garbage, and a collection every few hundred
+    # records would take most of the time
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        messages = list(map(Message, *columns))
+    finally:
+        if collecting:
+            gc.enable()
+    for i, (legacy_id, extra) in info['rare'].items():
+        message = messages[int(i)]
+        message.legacy_id = legacy_id
+        message.extra = extra
+    return messages
+
+
+def _encode_messages(messages):
+    try:
+        return _pack_parts(_encode_records(messages))
+    except (TypeError, OverflowError, UnicodeError):
+        # Message dicts (schema 1), or records with fields of other types
+        return _pack_parts([DICTS, _json([_encode_message(message) for message in messages])])
+
+
+def _decode_messages(data):
+    parts = _unpack_parts(data)
+    if bytes(parts[0]) == RECORDS:
+        return _decode_records(parts)
+    return [_decode_message(message) for message in json.loads(bytes(parts[1]))]
+
+
+def _encode_rooms(rooms):
+    # The rooms as JSON, each with the index of its messages part instead
+    # of its messages, followed by the messages parts
+    rooms = dict(rooms)
+    parts = [None]
+    for room_id, room in rooms.items():
+        room = rooms[room_id] = dict(room)
+        if 'messages' in room:
+            parts.append(_encode_messages(room['messages']))
+            room['messages'] = len(parts) - 1
+        if 'patches' in room:
+            room['patches'] = [[seq, _encode_message(patch)] for seq, patch in room['patches'].items()]
+    parts[0] = _json(rooms)
+    return _pack_parts(parts)
+
+
+def _decode_rooms(data):
+    parts = _unpack_parts(data)
+    rooms = json.loads(bytes(parts[0]))
+    for room in rooms.values():
+        if 'messages' in room:
+            room['messages'] = _decode_messages(parts[room['messages']])
+        if 'patches' in room:
+            room['patches'] = {seq: _decode_message(patch) for seq, patch in room['patches']}
+    return rooms
+
+
+def _decode_json_room(room):
+    # A room of an NDSNAP2 snapshot
+    if 'messages' in room:
+        room['messages'] = [_decode_message(message) for message in room['messages']]
+    if 'patches' in room:
+        room['patches'] = {seq: _decode_message(patch) for seq, patch in room['patches']}
+    return room
+
+
+def encode_section(name, value):
+    if name == 'chatrooms':
+        return _encode_rooms(value)
+    if isinstance(value, set):
+        value = sorted(value)
+    return _json(value)
+
+
+def decode_section(name, data, magic=MAGIC):
+    if name == 'chatrooms':
+        if magic == MAGIC:
+            return _decode_rooms(data)
+        return {room_id: _decode_json_room(room) for room_id, room in json.loads(data).items()}
+    value = json.loads(data)
+    if name == 'real_names_set' and value is not None:
+        value = set(value)
+    return value
+
+
+# ---- files ----
+
+def write_snapshot(path, state, generation, schema=SCHEMA_VERSION, previous_path=None):
+    """Write state to path: to a temporary file first, fsynced, then renamed
+    over path, so path always holds a complete snapshot (or none). With
+    previous_path, the snapshot being replaced is kept there."""
+    sections = {}
+    payloads = []
+    offset = 0
+    for name, value in state.items():
+        payload = encode_section(name, value)
+        sections[name] = [offset, len(payload), zlib.crc32(payload)]
+        payloads.append(payload)
+        offset += len(payload)
+    header = json.dumps({'schema': schema, 'generation': generation, 'sections': sections}).encode('utf-8')
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+        for payload in payloads:
+            f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    if previous_path and os.path.exists(path):
+        os.replace(path, previous_path)
+    os.replace(tmp_path, path)
+    fsync_dir(path)
+
+
+def fsync_dir(path):
+    # Makes the renames of files in the directory durable
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_header(f):
+    """Return the header of an open snapshot file, or None for a pickle."""
+    magic = f.read(len(MAGIC))
+    if magic not in (MAGIC, MAGIC_JSON):
+        if magic[:1] == b'\x80':
+            return None
+        raise SnapshotError(f"{f.name} is not a snapshot file")
+    length = HEADER_LENGTH.unpack(f.read(HEADER_LENGTH.size))[0]
+    header = json.loads(f.read(length))
+    header['start'] = f.tell()
+    header['magic'] = magic
+    return header
+
+
+def read_pickle(path):
+    """Return (state, generation, schema) of a pickle snapshot. Only for
+    files of our own: loading a pickle can run any code."""
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    generation = state.pop('_log_generation', 0)
+    return state, generation, 1
+
+
+def read_snapshot(path, sections=None):
+    """Return (state, generation, schema) of a snapshot file, with only the
+    named sections if sections is given. Raises PickleSnapshot for a pickle."""
+    with open(path, 'rb') as f:
+        header = read_header(f)
+        if header is None:
+            raise PickleSnapshot(f"{path} is a pickle snapshot from an older version; "
+                                 f"convert it with: python snapshot.py convert {path}")
+
+        state = {}
+        for name, (offset, length, checksum) in header['sections'].items():
+            if sections is not None and name not in sections:
+                continue
+            f.seek(header['start'] + offset)
+            payload = f.read(length)
+            if len(payload) != length or zlib.crc32(payload) != checksum:
+                raise SnapshotError(f"{path}: section {name} is damaged")
+            state[name] = decode_section(name, payload, header['magic'])
+        return state, header['generation'], header['schema']
+
+
+# ---- migrations ----
+
+def _migrate_1(state):
+    """Messages become Message records and polls keep ballots and tallies."""
+    if state.get('real_names_set') is None and 'users' in state:
+        # Users who already have real names set
+        state['real_names_set'] = {username for username, user in state['users'].items()
+                                   if user.get('real_name', '')}
+
+    for room_id, room in state.get('chatrooms', {}).items():
+        if 'last_seq' not in room:
+            # Number the messages of rooms saved before messages had a seq
+            for seq, message in enumerate(room.get('messages', []), start=1):
+                message['seq'] = seq
+            room['last_seq'] = len(room.get('messages', []))
+        room['messages'] = [to_record(room_id, message) for message in room.get('messages', [])]
+        room['patches'] = {seq: patch and to_record(room_id, patch)
+                           for seq, patch in room.get('patches', {}).items()}
+
+    for poll in state.get('polls', {}).values():
+        upgrade_poll(poll)
+
+
+def to_record(room_id, message):
+    """Return a Message for a message dict saved before Message records."""
+    if isinstance(message, Message):
+        return message
+    if message.get('deleted'):
+        return Message.tombstone(Message.from_dict(room_id, message))
+    return Message.from_dict(room_id, message)
+
+
+def upgrade_poll(poll):
+    """Turn the voter lists of a poll saved before ballots into ballots
+    (username -> option indices) and a tally; False if already done."""
+    if 'votes' not in poll:
+        return False
+    votes = poll.pop('votes', {})
+    poll['ballots'] = {}
+    for i, option in enumerate(poll['options']):
+        for username in votes.get(option, []):
+            poll['ballots'].setdefault(username, []).append(i)
+    poll['tally'] = [0] * len(poll['options'])
+    for ballot in poll['ballots'].values():
+        for i in ballot:
+            poll['tally'][i] += 1
+    return True
+
+
+# Migration from each schema version to the next
+MIGRATIONS = {1: _migrate_1}
+
+
+def migrate(state, schema):
+    """Bring state from schema up to SCHEMA_VERSION; returns True if it changed."""
+    if schema > SCHEMA_VERSION:
+        raise SnapshotError(f"Data has schema version {schema}, newer than this code ({SCHEMA_VERSION})")
+    for version in range(schema, SCHEMA_VERSION):
+        MIGRATIONS[version](state)
+    return schema < SCHEMA_VERSION
+
+
+# ---- command line ----
+
+def convert(path):
+    """Rewrite a pickle snapshot in this format; the pickle is kept as path.pickle."""
+    with open(path, 'rb') as f:
+        if read_header(f) is not None:
+            print(f"{path} is already in the snapshot format")
+            return
+    state, generation, schema = read_pickle(path)
+    os.replace(path, f"{path}.pickle")
+    # Still schema 1; the data is migrated when the store loads it
+    write_snapshot(path, state, generation, schema=schema)
+    print(f"Converted {path} (the pickle is kept as {path}.pickle)")
+
+
+def info(path):
+    with open(path, 'rb') as f:
+        header = read_header(f)
+    if header is None:
+        print(f"{path}: pickle snapshot (schema 1)")
+        return
+    print(f"{path}: schema {header['schema']}, journal generation {header['generation']}")
+    for name, (offset, length, checksum) in header['sections'].items():
+        print(f"  {name:<16} {length:>12} bytes")
+
+
+def benchmark(messages=1_000_000, rooms=100, path='snapshot-benchmark.tmp'):
+    """Compare saving and loading a state with this format and with pickle."""
+    import time
+    state = {
+        'users': {f"user{i}": {'profile_pic': 'default.png', 'joined_chatrooms': ['general']}
+                  for i in range(1000)},
+        'chatrooms': {},
+        'real_names_set': set(),
+        'polls': {}
+    }
+    per_room = messages // rooms
+    for r in range(rooms):
+        state['chatrooms'][f"room{r}"] = {
+            'name': f"Room {r}", 'members': [], 'last_seq': per_room, 'segments': [],
+            'patches': {}, 'archive': [],
+            'messages': [Message(seq, f"user{seq % 1000}", f"message number {seq}", 1760000000 + seq)
+                         for seq in range(1, per_room + 1)]
+        }
+
+    def timed(action):
+        start = time.perf_counter()
+        action()
+        return time.perf_counter() - start
+
+    def pickle_save():
+        with open(path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def pickle_load():
+        with open(path, 'rb') as f:
+            pickle.load(f)
+
+    results = []
+    for name, save, load in (('pickle', pickle_save, pickle_load),
+                             ('snapshot', lambda: write_snapshot(path, state, 1), lambda: read_snapshot(path))):
+        save_time = timed(save)
+        size = os.path.getsize(path)
+        load_time = timed(load)
+        lazy_time = timed(lambda: read_snapshot(path, sections=['users'])) if name == 'snapshot' else None
+        results.append((name, save_time, load_time, lazy_time, size))
+    os.remove(path)
+
+    print(f"{messages} messages in {rooms} rooms")
+    for name, save_time, load_time, lazy_time, size in results:
+        line = f"  {name:<9} save {save_time:6.2f}s  load {load_time:6.2f}s  {size / 1e6:7.1f} MB"
+        if lazy_time is not None:
+            line += f"  (users section only: {lazy_time:.3f}s)"
+        print(line)
+
+
+if __name__ == '__main__':
+    commands = {'convert': convert, 'info': info}
+    if len(sys.argv) == 3 and sys.argv[1] in commands:
+        commands[sys.argv[1]](sys.argv[2])
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'benchmark':
+        benchmark(*(int(arg) for arg in sys.argv[2:]))
+    else:
+        print("Usage: python snapshot.py convert|info <snapshot file>\n"
+              "       python snapshot.py benchmark [messages] [rooms]")
+        sys.exit(1)
@@ -0,0 +1,181 @@
+"""Sending files from disk with caching headers (static assets and uploads).
+
+Every file is sent with an ETag and Last-Modified (from its size and
+modification time, so nothing is read to make them), and a browser that has
+it revalidates with a 304 instead of downloading it again. A file whose URL
+changes with its content is sent as immutable for a year, so a browser
+doesn't even ask: uploads get unique names, and static_url_hash() gives the
+hash of a static asset to put in its URL.
+
+A compressible file is sent as its .br or .gz sibling when there is one
+that is up to date and the browser takes it. They are made with
+
+    python static_files.py compress static
+
+(.br files only with the brotli package installed).
+
+Range requests (seeking in a song) are answered from the file itself. An
+open-ended range of an audio or video file gets at most RANGE_CHUNK bytes,
+so each seek doesn't start sending the whole rest of the file; players ask
+for more as they need it.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import stat
+import sys
+
+from flask import Response, abort, request
+from werkzeug.http import parse_range_header
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+RANGE_CHUNK = 1024 * 1024
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml',
+                      'image/svg+xml')
+# Precompressed siblings, in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# path -> ((mtime, size), hash) of static assets, for static_url_hash()
+_hashes = {}
+
+
+def static_url_hash(path):
+    """Return a short hash of a file's content (read again only when the
+    file changes), or None if there is no such file."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _hashes.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(256 * 1024), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()[:12]
+    _hashes[path] = (key, digest)
+    return digest
+
+
+def _precompressed(path, st):
+    # The best sibling the browser takes, as (encoding, path, stat), or None
+    for encoding, suffix in ENCODINGS:
+        if not request.accept_encodings[encoding]:
+            continue
+        try:
+            sibling = os.stat(path + suffix)
+        except OSError:
+            continue
+        # One older than the file is left from a previous version of it
+        if sibling.st_mtime_ns >= st.st_mtime_ns:
+            return encoding, path + suffix, sibling
+    return None
+
+
+def _capped_range(environ, size):
+    ranges = parse_range_header(environ.get('HTTP_RANGE'))
+    if ranges is None or len(ranges.ranges) != 1:
+        return environ
+    start, stop = ranges.ranges[0]
+    if stop is None and start >= 0 and size - start > RANGE_CHUNK:
+        return dict(environ, HTTP_RANGE=f"bytes={start}-{start + RANGE_CHUNK - 1}")
+    return environ
+
+
+def send_cached(directory, filename, immutable=False):
+    """Send directory/filename for the current request; immutable when the
+    file never changes under its URL, otherwise browsers revalidate it."""
+    path = safe_join(directory, filename)
+    if path is None:
+        abort(404)
+    try:
+        st = os.stat(path)
+    except OSError:
+        abort(404)
+    if not stat.S_ISREG(st.st_mode):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    compressible = mimetype.startswith(COMPRESSIBLE_TYPES)
+    send_path, send_st, encoding = path, st, None
+    # Ranges are of the file as stored, so a range request gets the file itself
+    if compressible and 'HTTP_RANGE' not in request.environ:
+        found = _precompressed(path, st)
+        if found:
+            encoding, send_path, send_st = found
+
+    response = Response(wrap_file(request.environ, open(send_path, 'rb')),
+                        mimetype=mimetype, direct_passthrough=True)
+    response.content_length = send_st.st_size
+    response.last_modified = st.st_mtime
+    etag = f"{st.st_size:x}-{st.st_mtime_ns:x}"
+    response.set_etag(f"{etag}-{encoding}" if encoding else etag)
+    if encoding:
+        response.content_encoding = encoding
+    if compressible:
+        response.vary.add('Accept-Encoding')
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+
+    environ = request.environ
+    if not encoding and mimetype.startswith(('audio/', 'video/')):
+        environ = _capped_range(environ, send_st.st_size)
+    return response.make_conditional(environ, accept_ranges=True, complete_length=send_st.st_size)
+
+
+# ---- command line ----
+
+def compress(directory):
+    """Write .gz (and .br) siblings of the compressible files under directory
+    that don't have up to date ones."""
+    written = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.endswith(('.gz', '.br')):
+                continue
+            mimetype = mimetypes.guess_type(name)[0] or ''
+            if not mimetype.startswith(COMPRESSIBLE_TYPES):
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            mtime = os.stat(path).st_mtime_ns
+            siblings = [('.gz', lambda: gzip.compress(data, 9, mtime=0))]
+            if brotli is not None:
+                siblings.append(('.br', lambda: brotli.compress(data, quality=11)))
+            for suffix, make in siblings:
+                target = path + suffix
+                if os.path.exists(target) and os.stat(target).st_mtime_ns >= mtime:
+                    continue
+                compressed = make()
+                if len(compressed) >= len(data):
+                    # Not worth sending instead of the file
+                    continue
+                with open(target, 'wb') as f:
+                    f.write(compressed)
+                written += 1
+    print(f"Wrote {written} compressed files under {directory}"
+          + ("" if brotli is not None else " (no .br files: the brotli package isn't installed)"))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == 'compress':
+        compress(sys.argv[2])
+    else:
+        print("Usage: python static_files.py compress <directory>")
+        sys.exit(1)
@@ -0,0 +1,2004 @@
+"""Storage backends for the chat data.
+
+Small documents (users, room metadata, invites, polls, feedback) are kept in
+dicts that routes read directly; after changing one, a route calls the
+matching save_* method so the backend can persist it. Messages, room
+membership and poll votes only go through methods, so a backend is free to
+keep them out of memory or store them apart.
+
+Every message gets a per-room sequence number ('seq') that only ever grows,
+which is also what clients page history with, and an id made from the room
+and seq ('<room_id>-<seq>'), so ids never collide and lead straight to the
+message. Each room also has a version
+that changes whenever one of its messages is added, edited or deleted; the
+recent changes are kept in memory (RoomChanges) so pollers can ask for just
+what changed since the version they last saw.
+
+MemoryStorage keeps the small documents and the latest messages of each room
+(the hot tail) in memory, as compact Message records (records.py), and
+persists them with the journal from persistence.py. Older messages are sealed into segment files on disk and
+loaded on demand. SQLiteStorage keeps messages in an SQLite database (WAL
+mode) and only loads the small tables at startup, so memory use and startup
+time don't grow with the chat history.
+
+Several worker processes can share one SQLite database (shared=True). Each
+keeps its own copy of the small tables, so every change is also written to
+the events table, and every worker follows that table to reload what other
+workers changed and to record message changes. Event ids are the same for
+all workers, so they are what room versions are made of in that mode.
+
+Rooms can have a retention policy (a maximum number of messages, age in days
+or size in bytes; see retention_policy). Messages outside of it are moved,
+a block at a time, to a compressed append-only archive: an archive file per
+room for MemoryStorage, the archive table for SQLiteStorage. Archived
+messages can still be paged to, but they can no longer be edited or deleted.
+
+Routes run on many threads at once. Changes to the messages or members of a
+room hold that room's lock (Storage.room), so they apply one at a time and
+in the order they are journaled; other changes only share Storage.lock,
+which structural changes (rooms and users coming and going) and checkpoints
+take for themselves. MemoryStorage snapshots a copy of the state, made while
+nothing changes it, and writes it out after letting requests go on.
+"""
+import bisect
+import functools
+import itertools
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from locking import KeyedLocks, RWLock
+from persistence import Journal, JournalWriteError
+from records import Message, parse_time
+from snapshot import migrate, to_record, upgrade_poll
+
+
+# Room flags that have an index of the rooms carrying them
+ROOM_FLAGS = ('is_rickroll_room', 'is_polls_room', 'is_permanent')
+
+# Limits a retention policy can set; 0 or a missing limit keeps everything
+RETENTION_LIMITS = ('max_messages', 'max_age_days', 'max_bytes')
+
+
+def _copy_document(value):
+    # A copy that is safe to make while routes change the original: each
+    # dict, list or set is copied in one step (atomic under the GIL) before
+    # its items are. Message records are never changed, only replaced.
+    if isinstance(value, dict):
+        return {key: _copy_document(item) for key, item in dict(value).items()}
+    if isinstance(value, list):
+        return [_copy_document(item) for item in list(value)]
+    if isinstance(value, set):
+        return set(value)
+    return value
+
+
+# How storage methods lock (see Storage.lock)
+
+def _structural(method):
+    """For methods that add or remove rooms or users, or change a list the
+    journal addresses by index: nothing else changes the store while they run."""
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock.write():
+            return method(self, *args, **kwargs)
+    return locked
+
+
+def _room_change(method):
+    """For methods that change the messages or members of the room given as
+    their first argument."""
+    @functools.wraps(method)
+    def locked(self, room_id, *args, **kwargs):
+        with self.room(room_id):
+            return method(self, room_id, *args, **kwargs)
+    return locked
+
+
+def _change(method):
+    """For methods that save any other change."""
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock.read():
+            return method(self, *args, **kwargs)
+    return locked
+
+
+class RoomChanges:
+    def __init__(self, keep=500, start=None):
+        self.keep = keep
+        self._lock = threading.Lock()
+        # Versions start from the clock so they keep growing across restarts
+        # (shared workers use the ids of the events instead, see SQLiteStorage)
+        self._start = time.time_ns() // 1000 if start is None else start
+        self._clock = self._start
+        # room_id -> {'version', 'floor', 'log', 'changed'}; the log holds
+        # (version, kind, seq, message) for every change newer than floor and
+        # 'changed' wakes up the requests waiting on the room
+        self._rooms = {}
+        # Called as listener(room_id, version, kind, seq, message) after each
+        # change, outside the lock; kind is 'add', 'edit', 'delete' or 'clear'
+        self.listeners = []
+
+    def _room(self, room_id):
+        room = self._rooms.get(room_id)
+        if room is None:
+            room = self._rooms[room_id] = {'version': self._start, 'floor': self._start, 'log': [],
+                                           'changed': threading.Condition(self._lock)}
+        return room
+
+    def version(self, room_id):
+        with self._lock:
+            room = self._rooms.get(room_id)
+            return room['version'] if room else self._start
+
+    def record(self, room_id, kind, seq, message=None, version=None):
+        """Record an 'add', 'edit' or 'delete' of a message; returns the new
+        version (the given one, which must be newer than any before it)."""
+        with self._lock:
+            self._clock = self._clock + 1 if version is None else version
+            room = self._room(room_id)
+            room['version'] = self._clock
+            log = room['log']
+            log.append((self._clock, kind, seq, message))
+            # Trim in batches so appends stay cheap
+            if len(log) > 2 * self.keep:
+                room['floor'] = log[-self.keep - 1][0]
+                del log[:-self.keep]
+            room['changed'].notify_all()
+            version = self._clock
+        self._notify(room_id, version, kind, seq, message)
+        return version
+
+    def reset(self, room_id, version=None):
+        """Forget the changes of a room whose history was cleared."""
+        with self._lock:
+            self._clock = self._clock + 1 if version is None else version
+            room = self._room(room_id)
+            room['version'] = room['floor'] = self._clock
+            room['log'] = []
+            room['changed'].notify_all()
+            version = self._clock
+        self._notify(room_id, version, 'clear', None, None)
+        return version
+
+    def _notify(self, room_id, version, kind, seq, message):
+        for listener in self.listeners:
+            listener(room_id, version, kind, seq, message)
+
+    def forget(self, room_id):
+        with self._lock:
+            room = self._rooms.pop(room_id, None)
+            if room:
+                room['changed'].notify_all()
+
+    def wait(self, room_id, version, timeout):
+        """Block until the room moves past version, is deleted or timeout seconds pass."""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            room = self._room(room_id)
+            while self._rooms.get(room_id) is room and room['version'] == version:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                room['changed'].wait(remaining)
+
+    def since(self, room_id, version):
+        """Return (current version, changes) for everything after version.
+
+        changes holds 'added' and 'edited' messages and 'deleted' seqs, or
+        is None if the changes are no longer known and the client has to
+        reload the room.
+        """
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None:
+                current, floor, log = self._start, self._start, []
+            else:
+                current, floor, log = room['version'], room['floor'], room['log']
+            if version == current:
+                return current, {'added': [], 'edited': [], 'deleted': []}
+            if version > current or version < floor:
+                return current, None
+            start = bisect.bisect_right(log, version, key=lambda change: change[0])
+            changes = log[start:]
+
+        # Only the latest state of each message matters
+        added, edited, deleted = {}, {}, set()
+        for _, kind, seq, message in changes:
+            if kind == 'add':
+                added[seq] = message
+            elif kind == 'edit':
+                if seq in added:
+                    added[seq] = message
+                else:
+                    edited[seq] = message
+            elif kind == 'delete':
+                if added.pop(seq, None) is None:
+                    edited.pop(seq, None)
+                    deleted.add(seq)
+        return current, {
+            'added': [added[seq] for seq in sorted(added)],
+            'edited': [edited[seq] for seq in sorted(edited)],
+            'deleted': sorted(deleted)
+        }
+
+
+class Storage:
+    def __init__(self, retention=None):
+        self.users = {}
+        self.chatrooms = {}
+        self.invites = {}
+        self.pending_users = {}
+        self.feedback = []
+        self.real_names_set = set()
+        self.polls = {}
+        # True when there was no saved data to load
+        self.is_new = False
+        # True when other worker processes share the stored data
+        self.shared = False
+        # Called as listener(topic, data) for events other workers publish
+        self.listeners = []
+        # Called as listener(room_id, username, joined) when a user joins or
+        # leaves a room
+        self.member_listeners = []
+        # Recent message changes of every room, for delta polling
+        self.changes = RoomChanges()
+        # Set indexes of room['members'] and user['joined_chatrooms'], built
+        # on first use
+        self._members = {}
+        self._joined = {}
+        # join_code -> room_id, and flag -> room_ids (a dict, to keep the
+        # rooms in creation order)
+        self._join_codes = {}
+        self._flagged = {flag: {} for flag in ROOM_FLAGS}
+        # Held shared by every change and exclusively by structural changes
+        # and checkpoints; changes to a room also hold the room's lock
+        self.lock = RWLock()
+        self._room_locks = KeyedLocks()
+        # Versions are drawn from one counter (next() on it is atomic), so
+        # changes on different threads never end up with the same version
+        self._versions = itertools.count(time.time_ns() // 1000)
+        # Changes with every poll change, for caching poll results
+        self.polls_version = next(self._versions)
+        self._vote_lock = threading.Lock()
+        # Change with every saved change to a user, and to a room's metadata
+        # or members, for caching what is rendered from them
+        self.users_version = self.polls_version
+        self.rooms_version = self.polls_version
+        # Default retention policy of rooms that don't set their own limits
+        self.retention = dict(retention or {})
+
+    @contextmanager
+    def room(self, room_id):
+        """Hold off other changes to a room's messages and members, e.g. to
+        look up a message and change it in one go."""
+        with self.lock.read(), self._room_locks(room_id):
+            yield
+
+    def _bump(self, name):
+        # After a change to the polls, users or rooms (name): a new
+        # polls_version, users_version or rooms_version
+        setattr(self, f"{name}_version", next(self._versions))
+
+    def follow(self):
+        """Start applying the changes of other workers (shared stores only)."""
+
+    # Every backend implements the methods below
+
+    def load(self):
+        raise NotImplementedError
+
+    def checkpoint(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+    def save_user(self, username, *fields):
+        raise NotImplementedError
+
+    def delete_user(self, username):
+        raise NotImplementedError
+
+    def save_pending_user(self, username):
+        raise NotImplementedError
+
+    def delete_pending_user(self, username):
+        raise NotImplementedError
+
+    def save_invite(self, invite_code):
+        raise NotImplementedError
+
+    def delete_invite(self, invite_code):
+        raise NotImplementedError
+
+    def add_real_name(self, username):
+        raise NotImplementedError
+
+    def discard_real_name(self, username):
+        raise NotImplementedError
+
+    def add_feedback(self, item):
+        raise NotImplementedError
+
+    def save_feedback(self, feedback_id):
+        raise NotImplementedError
+
+    def delete_feedback(self, feedback_id):
+        raise NotImplementedError
+
+    def save_poll(self, poll_id, *fields):
+        raise NotImplementedError
+
+    def clear_polls(self):
+        raise NotImplementedError
+
+    def _save_ballot(self, poll_id, username):
+        raise NotImplementedError
+
+    def create_room(self, room_id, room):
+        raise NotImplementedError
+
+    def save_room(self, room_id, *fields):
+        """Persist changed fields of a room (all of them without fields);
+        not for fields that are indexed (join code, flags)."""
+        raise NotImplementedError
+
+    def delete_room(self, room_id):
+        raise NotImplementedError
+
+    def append_message(self, room_id, message):
+        """Add a message to a room, setting its 'seq' and 'id'."""
+        raise NotImplementedError
+
+    def page_messages(self, room_id, before=None, after=None, limit=50):
+        """Return (messages, next_cursor) for one page of a room's history.
+
+        Messages are oldest first. With after, the page holds the oldest
+        messages with a seq greater than it; otherwise it holds the newest
+        messages with a seq smaller than before (or the newest overall).
+        next_cursor is the seq to pass on to get the next page in the same
+        direction, or None when there is nothing more.
+        """
+        raise NotImplementedError
+
+    def message_count(self, room_id):
+        raise NotImplementedError
+
+    def find_message(self, room_id, message_id):
+        """Return (seq, message), or (None, None) if there is no such message."""
+        raise NotImplementedError
+
+    def replace_message(self, room_id, seq, message):
+        raise NotImplementedError
+
+    def delete_message(self, room_id, seq):
+        raise NotImplementedError
+
+    def clear_messages(self, room_id):
+        raise NotImplementedError
+
+    def room_files(self, room_id):
+        """Return the files attached to the messages of a room, oldest first,
+        as dicts with 'file_path' and 'file_hash'. Kept in a list of their
+        own, so this doesn't read the room's history."""
+        raise NotImplementedError
+
+    def apply_retention(self, room_id):
+        """Archive the oldest messages of a room while they are outside of
+        its retention policy."""
+        raise NotImplementedError
+
+    def _save_member(self, room_id, username, added):
+        raise NotImplementedError
+
+    # Membership is kept on both sides, in room['members'] and in
+    # user['joined_chatrooms'] (in join order, for the templates), and
+    # add_member/remove_member keep the two in step
+
+    @_room_change
+    def add_member(self, room_id, username):
+        members = self._room_members(room_id)
+        if username not in members:
+            members.add(username)
+            self.chatrooms[room_id]['members'].append(username)
+            self._save_member(room_id, username, True)
+        if username in self.users:
+            joined = self._user_rooms(username)
+            if room_id not in joined:
+                joined.add(room_id)
+                self.users[username].setdefault('joined_chatrooms', []).append(room_id)
+                self.save_user(username, 'joined_chatrooms')
+                for listener in self.member_listeners:
+                    listener(room_id, username, True)
+
+    @_room_change
+    def remove_member(self, room_id, username):
+        members = self._room_members(room_id)
+        if username in members:
+            members.discard(username)
+            self.chatrooms[room_id]['members'].remove(username)
+            self._save_member(room_id, username, False)
+        if username in self.users:
+            joined = self._user_rooms(username)
+            if room_id in joined:
+                joined.discard(room_id)
+                self.users[username]['joined_chatrooms'].remove(room_id)
+                self.save_user(username, 'joined_chatrooms')
+                for listener in self.member_listeners:
+                    listener(room_id, username, False)
+
+    def is_member(self, room_id, username):
+        return username in self._room_members(room_id)
+
+    def has_joined(self, username, room_id):
+        return room_id in self._user_rooms(username)
+
+    def _room_members(self, room_id):
+        members = self._members.get(room_id)
+        if members is None:
+            members = self._members[room_id] = set(self.chatrooms[room_id]['members'])
+        return members
+
+    def _user_rooms(self, username):
+        joined = self._joined.get(username)
+        if joined is None:
+            joined = self._joined[username] = set(self.users[username].get('joined_chatrooms', []))
+        return joined
+
+    def _leave_room(self, room_id):
+        # Before a room is deleted
+        for username in list(self._room_members(room_id)):
+            self.remove_member(room_id, username)
+        self._members.pop(room_id, None)
+
+    def _leave_all_rooms(self, username):
+        # Before a user is deleted
+        for room_id in list(self._user_rooms(username)):
+            if room_id in self.chatrooms:
+                self.remove_member(room_id, username)
+        self._joined.pop(username, None)
+
+    def _repair_membership(self):
+        # Data saved before add_member kept both sides could have a
+        # membership on one side only
+        for room_id, room in self.chatrooms.items():
+            for username in list(room['members']):
+                if username in self.users:
+                    self.add_member(room_id, username)
+        for username, user in self.users.items():
+            for room_id in list(user.get('joined_chatrooms', [])):
+                if room_id in self.chatrooms:
+                    self.add_member(room_id, username)
+
+    # Each poll keeps 'ballots' (username -> sorted option indices) and a
+    # 'tally' with the vote count of each option, updated vote by vote
+
+    @_change
+    def cast_vote(self, poll_id, username, options):
+        """Replace username's vote in a poll with the given option indices;
+        no options takes the vote back."""
+        with self._vote_lock:
+            poll = self.polls[poll_id]
+            ballots, tally = poll['ballots'], poll['tally']
+            for i in ballots.pop(username, ()):
+                tally[i] -= 1
+            if options:
+                ballots[username] = sorted(set(options))
+                for i in ballots[username]:
+                    tally[i] += 1
+            self._save_ballot(poll_id, username)
+            self._bump('polls')
+
+    # Room lookups by join code and flag, kept up to date by create_room and
+    # delete_room and rebuilt on load
+
+    def room_by_join_code(self, join_code):
+        return self._join_codes.get(join_code)
+
+    def rooms_with_flag(self, flag):
+        return list(self._flagged[flag])
+
+    def _index_room(self, room_id):
+        room = self.chatrooms[room_id]
+        if room.get('join_code'):
+            self._join_codes[room['join_code']] = room_id
+        for flag in ROOM_FLAGS:
+            if room.get(flag):
+                self._flagged[flag][room_id] = True
+
+    def _unindex_room(self, room_id):
+        room = self.chatrooms[room_id]
+        if self._join_codes.get(room.get('join_code')) == room_id:
+            del self._join_codes[room['join_code']]
+        for rooms in self._flagged.values():
+            rooms.pop(room_id, None)
+
+    def _index_rooms(self):
+        self._join_codes.clear()
+        for rooms in self._flagged.values():
+            rooms.clear()
+        for room_id in self.chatrooms:
+            self._index_room(room_id)
+
+    # Retention
+
+    def retention_policy(self, room_id):
+        """Return the limits that apply to a room: its own over the defaults."""
+        policy = dict(self.retention)
+        policy.update(self.chatrooms[room_id].get('retention') or {})
+        return {limit: value for limit, value in policy.items() if value}
+
+    @_room_change
+    def set_retention(self, room_id, policy):
+        """Set a room's own limits (a limit of 0 keeps everything, a missing
+        one falls back to the default) and apply them."""
+        self.chatrooms[room_id]['retention'] = policy
+        self.save_room(room_id, 'retention')
+        self.apply_retention(room_id)
+
+    @staticmethod
+    def _is_expired(policy, live_count, live_bytes, block_count, block_newest):
+        # Whether the oldest block of a room's live history, block_count
+        # messages with block_newest the time (epoch seconds, None if not
+        # known) of the newest one, is outside of the policy. Blocks are only
+        # archived whole.
+        if policy.get('max_messages') and live_count - block_count >= policy['max_messages']:
+            return True
+        if policy.get('max_bytes') and live_bytes > policy['max_bytes']:
+            return True
+        if policy.get('max_age_days') and block_newest is not None:
+            if block_newest < time.time() - policy['max_age_days'] * 86400:
+                return True
+        return False
+
+    # Shared helpers
+
+    @staticmethod
+    def _message_id(room_id, seq):
+        return f"{room_id}-{seq}"
+
+    @staticmethod
+    def _seq_from_id(room_id, message_id):
+        # None for ids minted before ids were made from the seq
+        prefix, _, seq = message_id.rpartition('-')
+        if prefix == room_id and seq.isdigit():
+            return int(seq)
+        return None
+
+    def recent_messages(self, room_id, limit=50):
+        return self.page_messages(room_id, limit=limit)[0]
+
+    def _profile_pic(self, username, is_system=False):
+        # Messages don't keep a copy of their author's picture; it is looked
+        # up whenever they are read
+        if is_system:
+            return 'default.png'
+        return self.users.get(username, {}).get('profile_pic', 'default.png')
+
+    def _find_feedback(self, feedback_id):
+        for i, item in enumerate(self.feedback):
+            if item['id'] == feedback_id:
+                return i
+        return None
+
+
+class MemoryStorage(Storage):
+    def __init__(self, data_file, history_dir='chat_history', hot_messages=200,
+                 segment_messages=500, cached_segments=16, retention=None, **journal_options):
+        super().__init__(retention)
+        self.journal = Journal(data_file, **journal_options)
+        self.history_dir = history_dir
+        # Each room keeps between hot_messages and hot_messages + segment_messages
+        # messages in memory; older ones are sealed into segment files
+        self.hot_messages = hot_messages
+        self.segment_messages = segment_messages
+        self.cached_segments = cached_segments
+        self._segment_cache = OrderedDict()
+        self._segment_lock = threading.Lock()
+        # room_id -> {message id: seq} for messages with ids from before ids
+        # were made from the seq, built on the first lookup of such an id
+        self._legacy_ids = {}
+
+    def _state(self):
+        return {
+            'users': self.users,
+            'chatrooms': self.chatrooms,
+            'invites': self.invites,
+            'pending_users': self.pending_users,
+            'feedback': self.feedback,
+            'real_names_set': self.real_names_set,
+            'polls': self.polls
+        }
+
+    # Record a single change in the journal, e.g.
+    # self._log('append', 'chatrooms', room_id, 'messages', value=message)
+    def _log(self, op, *path, value=None):
+        self.journal.append((op, path, value))
+
+    def load(self):
+        data = self.journal.load()
+        self.is_new = data is None
+        if data is not None:
+            # Data saved by older versions is brought up to date once, and
+            # saved again right away
+            migrated = migrate(data, self.journal.schema)
+
+            self.users = data.get('users', {})
+            self.chatrooms = data.get('chatrooms', {})
+            self.invites = data.get('invites', {})
+            self.pending_users = data.get('pending_users', {})
+            self.feedback = data.get('feedback', [])
+            self.real_names_set = data.get('real_names_set', set())
+            self.polls = data.get('polls', {})
+            # Rooms saved before rooms listed their files
+            unlisted = [room_id for room_id, room in self.chatrooms.items() if 'files' not in room]
+            for room in self.chatrooms.values():
+                self._init_room(room)
+            if migrated:
+                self.checkpoint()
+
+            for room_id in self.chatrooms:
+                self._seal_old_messages(room_id)
+            self._remove_unused_segments()
+            for room_id in unlisted:
+                self._list_files(room_id)
+            for room_id in self.chatrooms:
+                self.apply_retention(room_id)
+            self._index_rooms()
+            self._repair_membership()
+        else:
+            # Give the journal a snapshot to apply changes to
+            self.checkpoint()
+
+    def checkpoint(self):
+        # The copy and the journal generation it replaces are taken while
+        # nothing changes the state; writing it out doesn't hold anyone up
+        with self.lock.write():
+            sealed = self.journal.seal()
+            state = self._copy_state()
+        self.journal.checkpoint(state, sealed)
+
+    def _copy_state(self):
+        return _copy_document(self._state())
+
+    def close(self):
+        self.journal.close()
+
+    def stats(self):
+        stats = self.journal.stats()
+        stats['backend'] = 'memory'
+        return stats
+
+    @_change
+    def save_user(self, username, *fields):
+        if fields:
+            for field in fields:
+                self._log('set', 'users', username, field, value=self.users[username][field])
+        else:
+            self._joined.pop(username, None)
+            self._log('set', 'users', username, value=self.users[username])
+        self._bump('users')
+
+    @_structural
+    def delete_user(self, username):
+        self._leave_all_rooms(username)
+        del self.users[username]
+        self._log('del', 'users', username)
+        self._bump('users')
+
+    @_change
+    def save_pending_user(self, username):
+        self._log('set', 'pending_users', username, value=self.pending_users[username])
+
+    @_change
+    def delete_pending_user(self, username):
+        del self.pending_users[username]
+        self._log('del', 'pending_users', username)
+
+    @_change
+    def save_invite(self, invite_code):
+        self._log('set', 'invites', invite_code, value=self.invites[invite_code])
+
+    @_change
+    def delete_invite(self, invite_code):
+        del self.invites[invite_code]
+        self._log('del', 'invites', invite_code)
+
+    @_change
+    def add_real_name(self, username):
+        self.real_names_set.add(username)
+        self._log('add', 'real_names_set', value=username)
+
+    @_change
+    def discard_real_name(self, username):
+        self.real_names_set.discard(username)
+        self._log('discard', 'real_names_set', value=username)
+
+    # Feedback is journaled by position in the list, so its changes must
+    # reach the journal in the order they were made to the list
+
+    @_structural
+    def add_feedback(self, item):
+        self.feedback.append(item)
+        self._log('append', 'feedback', value=item)
+
+    @_structural
+    def save_feedback(self, feedback_id):
+        i = self._find_feedback(feedback_id)
+        if i is not None:
+            self._log('set', 'feedback', i, value=self.feedback[i])
+
+    @_structural
+    def delete_feedback(self, feedback_id):
+        i = self._find_feedback(feedback_id)
+        if i is not None:
+            del self.feedback[i]
+            self._log('del', 'feedback', i)
+
+    @_change
+    def save_poll(self, poll_id, *fields):
+        if fields:
+            for field in fields:
+                self._log('set', 'polls', poll_id, field, value=self.polls[poll_id][field])
+        else:
+            self._log('set', 'polls', poll_id, value=self.polls[poll_id])
+        self._bump('polls')
+
+    @_structural
+    def clear_polls(self):
+        self.polls.clear()
+        self._log('set', 'polls', value={})
+        self._bump('polls')
+
+    def _save_ballot(self, poll_id, username):
+        poll = self.polls[poll_id]
+        if username in poll['ballots']:
+            self._log('set', 'polls', poll_id, 'ballots', username, value=poll['ballots'][username])
+        else:
+            self._log('del', 'polls', poll_id, 'ballots', username)
+        self._log('set', 'polls', poll_id, 'tally', value=poll['tally'])
+
+    @staticmethod
+    def _init_room(room):
+        room.setdefault('members', [])
+        # Hot tail of the history; older messages are listed in 'segments'
+        room.setdefault('messages', [])
+        room.setdefault('last_seq', 0)
+        # [first_seq, last_seq, count, file name] for each sealed segment
+        room.setdefault('segments', [])
+        # Edits (message) and deletions (None) of sealed messages, by seq
+        room.setdefault('patches', {})
+        # [first_seq, last_seq, count, file name, offset, length] for each
+        # compressed block of archived messages, all older than the segments
+        room.setdefault('archive', [])
+        # [seq, file path, file hash] of each message with a file attached,
+        # by seq
+        room.setdefault('files', [])
+
+    @_structural
+    def create_room(self, room_id, room):
+        self._init_room(room)
+        if room_id in self.chatrooms:
+            self._unindex_room(room_id)
+        self.chatrooms[room_id] = room
+        self._members.pop(room_id, None)
+        self._index_room(room_id)
+        self._log('set', 'chatrooms', room_id, value=room)
+        self._bump('rooms')
+
+    @_change
+    def save_room(self, room_id, *fields):
+        room = self.chatrooms[room_id]
+        if fields:
+            for field in fields:
+                self._log('set', 'chatrooms', room_id, field, value=room[field])
+        else:
+            self._log('set', 'chatrooms', room_id, value=room)
+        self._bump('rooms')
+
+    @_structural
+    def delete_room(self, room_id):
+        self._leave_room(room_id)
+        self._unindex_room(room_id)
+        room = self.chatrooms.pop(room_id)
+        self._legacy_ids.pop(room_id, None)
+        self._room_locks.discard(room_id)
+        self.changes.forget(room_id)
+        self._log('del', 'chatrooms', room_id)
+        self._drop_files(room_id, self._history_files(room))
+        self._bump('rooms')
+
+    def _save_member(self, room_id, username, added):
+        self._log('append' if added else 'remove', 'chatrooms', room_id, 'members', value=username)
+        self._bump('rooms')
+
+    @_room_change
+    def append_message(self, room_id, message):
+        room = self.chatrooms[room_id]
+        room['last_seq'] += 1
+        message['seq'] = room['last_seq']
+        message['id'] = self._message_id(room_id, message['seq'])
+        record = Message.from_dict(room_id, message)
+        room['messages'].append(record)
+        self._log('set', 'chatrooms', room_id, 'last_seq', value=room['last_seq'])
+        self._log('append', 'chatrooms', room_id, 'messages', value=record)
+        if message.get('file_path'):
+            entry = [record.seq, message['file_path'], message.get('file_hash')]
+            room['files'].append(entry)
+            self._log('append', 'chatrooms', room_id, 'files', value=entry)
+        self.changes.record(room_id, 'add', record.seq, self._to_dict(room_id, record))
+        self._seal_old_messages(room_id)
+        if record.seq % self.segment_messages == 0:
+            self.apply_retention(room_id)
+
+    def _to_dict(self, room_id, message):
+        return message.to_dict(room_id, self._profile_pic(message.user, message.is_system))
+
+    def page_messages(self, room_id, before=None, after=None, limit=50):
+        if after is not None:
+            messages = []
+            for message in self._iter_forward(room_id, after):
+                messages.append(message)
+                if len(messages) > limit:
+                    break
+            more = len(messages) > limit
+            messages = messages[:limit]
+        else:
+            messages = []
+            for message in self._iter_backward(room_id, before):
+                messages.append(message)
+                if len(messages) > limit:
+                    break
+            more = len(messages) > limit
+            messages = messages[:limit][::-1]
+        next_cursor = None
+        if more and messages:
+            next_cursor = messages[-1].seq if after is not None else messages[0].seq
+        return [self._to_dict(room_id, message) for message in messages], next_cursor
+
+    @_room_change
+    def message_count(self, room_id):
+        room = self.chatrooms[room_id]
+        archived = sum(block[2] for block in room['archive'])
+        return archived + self._live_count(room)
+
+    @staticmethod
+    def _live_count(room):
+        # Messages that aren't archived
+        sealed = sum(segment[2] for segment in room['segments'])
+        deleted = sum(1 for patch in room['patches'].values() if patch is None)
+        hot = sum(1 for message in room['messages'] if not message.deleted)
+        return sealed - deleted + hot
+
+    def find_message(self, room_id, message_id):
+        seq = self._seq_from_id(room_id, message_id)
+        if seq is None:
+            seq = self._legacy_index(room_id).get(message_id)
+        message = self._get_message(room_id, seq) if seq is not None else None
+        if message is None or message.message_id(room_id) != message_id:
+            return None, None
+        return seq, self._to_dict(room_id, message)
+
+    def _legacy_index(self, room_id):
+        index = self._legacy_ids.get(room_id)
+        if index is None:
+            index = self._legacy_ids[room_id] = {
+                message.legacy_id: message.seq for message in self._iter_forward(room_id, 0)
+                if message.legacy_id and self._seq_from_id(room_id, message.legacy_id) is None
+            }
+        return index
+
+    def _get_message(self, room_id, seq):
+        room = self.chatrooms[room_id]
+        i = self._hot_index(room, seq)
+        if i is not None:
+            message = room['messages'][i]
+            return None if message.deleted else message
+        if room['archive'] and seq <= room['archive'][-1][1]:
+            # Archived messages can't be changed
+            return None
+        if seq in room['patches']:
+            return room['patches'][seq]
+        j = bisect.bisect_right(room['segments'], seq, key=lambda segment: segment[0]) - 1
+        if j < 0 or room['segments'][j][1] < seq:
+            return None
+        messages = self._load_segment(room_id, room['segments'][j][3])
+        k = bisect.bisect_left(messages, seq, key=lambda message: message.seq)
+        if k < len(messages) and messages[k].seq == seq:
+            return messages[k]
+        return None
+
+    @_room_change
+    def replace_message(self, room_id, seq, message):
+        room = self.chatrooms[room_id]
+        record = Message.from_dict(room_id, dict(message, seq=seq))
+        i = self._hot_index(room, seq)
+        if i is not None:
+            room['messages'][i] = record
+            self._log('set', 'chatrooms', room_id, 'messages', i, value=record)
+        else:
+            room['patches'][seq] = record
+            self._log('set', 'chatrooms', room_id, 'patches', seq, value=record)
+        self.changes.record(room_id, 'edit', seq, self._to_dict(room_id, record))
+
+    @_room_change
+    def delete_message(self, room_id, seq):
+        room = self.chatrooms[room_id]
+        i = self._hot_index(room, seq)
+        if i is not None:
+            # A tombstone keeps the positions of the hot tail valid; it is
+            # dropped when the tail is sealed
+            tombstone = Message.tombstone(room['messages'][i])
+            room['messages'][i] = tombstone
+            self._log('set', 'chatrooms', room_id, 'messages', i, value=tombstone)
+        else:
+            room['patches'][seq] = None
+            self._log('set', 'chatrooms', room_id, 'patches', seq, value=None)
+        files = room['files']
+        i = bisect.bisect_left(files, seq, key=lambda entry: entry[0])
+        if i < len(files) and files[i][0] == seq:
+            self._log('remove', 'chatrooms', room_id, 'files', value=files.pop(i))
+        self.changes.record(room_id, 'delete', seq)
+
+    @_room_change
+    def clear_messages(self, room_id):
+        # Only the lists change here; the files are dropped in the background
+        room = self.chatrooms[room_id]
+        files = self._history_files(room)
+        room['messages'] = []
+        room['segments'] = []
+        room['patches'] = {}
+        room['archive'] = []
+        room['files'] = []
+        self._legacy_ids.pop(room_id, None)
+        self._log('set', 'chatrooms', room_id, 'messages', value=[])
+        self._log('set', 'chatrooms', room_id, 'segments', value=[])
+        self._log('set', 'chatrooms', room_id, 'patches', value={})
+        self._log('set', 'chatrooms', room_id, 'archive', value=[])
+        self._log('set', 'chatrooms', room_id, 'files', value=[])
+        self.changes.reset(room_id)
+        self._drop_files(room_id, files)
+
+    def room_files(self, room_id):
+        return [{'file_path': path, 'file_hash': digest} for _, path, digest in self.chatrooms[room_id]['files']]
+
+    def _list_files(self, room_id):
+        # Fill in the files of a room from its history, once
+        files = []
+        for message in self._iter_forward(room_id, 0):
+            extra = message.extra or {}
+            if extra.get('file_path'):
+                files.append([message.seq, extra['file_path'], extra.get('file_hash')])
+        self.chatrooms[room_id]['files'] = files
+        self._log('set', 'chatrooms', room_id, 'files', value=files)
+
+    @_room_change
+    def apply_retention(self, room_id):
+        policy = self.retention_policy(room_id)
+        if not policy:
+            return
+        room = self.chatrooms[room_id]
+        while room['segments']:
+            first_seq, last_seq, count, name = room['segments'][0]
+            messages = self._load_segment(room_id, name)
+            newest = messages[-1].time if messages else None
+            live_bytes = 0
+            if policy.get('max_bytes'):
+                for segment in room['segments']:
+                    try:
+                        live_bytes += os.path.getsize(self._segment_path(room_id, segment[3]))
+                    except OSError:
+                        pass
+            if not self._is_expired(policy, self._live_count(room), live_bytes, count, newest):
+                return
+            self._archive_segment(room_id)
+
+        # Everything sealed is archived and the hot tail can still be over
+        # the limits: its oldest messages go the same way, sealed first
+        while True:
+            size = self._expired_tail(room, policy)
+            if not size:
+                return
+            if self._seal_block(room_id, size):
+                self._archive_segment(room_id)
+
+    def _expired_tail(self, room, policy):
+        # How many of the oldest hot messages (at most a segment's worth) are
+        # outside of the policy. max_bytes counts segment files only, so it
+        # doesn't apply here.
+        hot = room['messages']
+        live = [i for i, message in enumerate(hot) if not message.deleted]
+        end = 0
+        if policy.get('max_messages'):
+            excess = min(self._live_count(room) - policy['max_messages'], len(live))
+            if excess > 0:
+                end = live[excess - 1] + 1
+        if policy.get('max_age_days'):
+            cutoff = time.time() - policy['max_age_days'] * 86400
+            for i in live:
+                if hot[i].time is None or hot[i].time >= cutoff:
+                    break
+                end = max(end, i + 1)
+        return min(end, self.segment_messages)
+
+    # ---- history segments ----
+
+    @staticmethod
+    def _hot_index(room, seq):
+        hot = room['messages']
+        i = bisect.bisect_left(hot, seq, key=lambda message: message.seq)
+        if i < len(hot) and hot[i].seq == seq:
+            return i
+        return None
+
+    def _segment_path(self, room_id, name):
+        return os.path.join(self.history_dir, room_id, name)
+
+    def _load_segment(self, room_id, name):
+        key = (room_id, name)
+        with self._segment_lock:
+            if key in self._segment_cache:
+                self._segment_cache.move_to_end(key)
+                return self._segment_cache[key]
+        try:
+            with open(self._segment_path(room_id, name), 'rb') as f:
+                # Segments sealed before Message records hold dicts
+                messages = [to_record(room_id, message) for message in pickle.load(f)]
+        except OSError as e:
+            print(f"Error loading history segment {name} of {room_id}: {e}")
+            messages = []
+        self._cache_segment(key, messages)
+        return messages
+
+    def _load_archive_block(self, room_id, block):
+        first_seq, last_seq, count, name, offset, length = block
+        key = (room_id, name, offset)
+        with self._segment_lock:
+            if key in self._segment_cache:
+                self._segment_cache.move_to_end(key)
+                return self._segment_cache[key]
+        try:
+            with open(self._segment_path(room_id, name), 'rb') as f:
+                f.seek(offset)
+                messages = [to_record(room_id, message)
+                            for message in pickle.loads(zlib.decompress(f.read(length)))]
+        except (OSError, zlib.error) as e:
+            print(f"Error loading archived messages {first_seq}-{last_seq} of {room_id}: {e}")
+            messages = []
+        self._cache_segment(key, messages)
+        return messages
+
+    def _cache_segment(self, key, messages):
+        with self._segment_lock:
+            self._segment_cache[key] = messages
+            while len(self._segment_cache) > self.cached_segments:
+                self._segment_cache.popitem(last=False)
+
+    def _iter_sealed(self, room_id, segments, reverse):
+        # Yields sealed messages with edits and deletions applied
+        patches = self.chatrooms[room_id]['patches']
+        for first_seq, last_seq, count, name in segments:
+            messages = self._load_segment(room_id, name)
+            for message in (reversed(messages) if reverse else messages):
+                if message.seq in patches:
+                    message = patches[message.seq]
+                    if message is None:
+                        continue
+                yield message
+
+    def _iter_archive(self, room_id, blocks, reverse):
+        for block in blocks:
+            messages = self._load_archive_block(room_id, block)
+            yield from (reversed(messages) if reverse else messages)
+
+    def _iter_backward(self, room_id, before):
+        """Yield the room's messages newest first, starting below before."""
+        room = self.chatrooms[room_id]
+        hot = room['messages']
+        end = len(hot) if before is None else bisect.bisect_left(hot, before, key=lambda m: m.seq)
+        for i in range(end - 1, -1, -1):
+            if not hot[i].deleted:
+                yield hot[i]
+        segments = [s for s in reversed(room['segments']) if before is None or s[0] < before]
+        for message in self._iter_sealed(room_id, segments, reverse=True):
+            if before is None or message.seq < before:
+                yield message
+        blocks = [b for b in reversed(room['archive']) if before is None or b[0] < before]
+        for message in self._iter_archive(room_id, blocks, reverse=True):
+            if before is None or message.seq < before:
+                yield message
+
+    def _iter_forward(self, room_id, after):
+        """Yield the room's messages oldest first, starting above after."""
+        room = self.chatrooms[room_id]
+        blocks = [b for b in room['archive'] if b[1] > after]
+        for message in self._iter_archive(room_id, blocks, reverse=False):
+            if message.seq > after:
+                yield message
+        segments = [s for s in room['segments'] if s[1] > after]
+        for message in self._iter_sealed(room_id, segments, reverse=False):
+            if message.seq > after:
+                yield message
+        hot = room['messages']
+        for i in range(bisect.bisect_right(hot, after, key=lambda m: m.seq), len(hot)):
+            if not hot[i].deleted:
+                yield hot[i]
+
+    def _seal_old_messages(self, room_id):
+        """Move the oldest messages of a room to a segment file once its hot
+        tail has grown by a full segment."""
+        room = self.chatrooms[room_id]
+        while len(room['messages']) >= self.hot_messages + self.segment_messages:
+            self._seal_block(room_id, self.segment_messages)
+
+    def _seal_block(self, room_id, size):
+        """Move the oldest size messages of a room's hot tail to a segment
+        file; False if they were all deleted and there was nothing to seal."""
+        room = self.chatrooms[room_id]
+        oldest = room['messages'][:size]
+        sealed = [message for message in oldest if not message.deleted]
+        if sealed:
+            first_seq, last_seq = oldest[0].seq, oldest[-1].seq
+            name = f"{first_seq:09d}-{last_seq:09d}.seg"
+
+            # The segment must be on disk before the journal stops listing its messages
+            os.makedirs(os.path.join(self.history_dir, room_id), exist_ok=True)
+            path = self._segment_path(room_id, name)
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump(sealed, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+
+            room['segments'].append([first_seq, last_seq, len(sealed), name])
+            self._log('set', 'chatrooms', room_id, 'segments', value=room['segments'])
+
+        room['messages'] = room['messages'][size:]
+        self._log('set', 'chatrooms', room_id, 'messages', value=room['messages'])
+        return bool(sealed)
+
+    def _archive_segment(self, room_id):
+        """Move the oldest segment of a room, with its edits and deletions
+        applied, into the room's archive file as one compressed block."""
+        room = self.chatrooms[room_id]
+        first_seq, last_seq, count, name = room['segments'][0]
+        patches = room['patches']
+        messages = list(self._iter_sealed(room_id, [room['segments'][0]], reverse=False))
+
+        if messages:
+            # Blocks are appended to the room's current archive file; whatever
+            # follows the last indexed block was left by a crash mid-write
+            if room['archive']:
+                archive_name = room['archive'][-1][3]
+                offset = room['archive'][-1][4] + room['archive'][-1][5]
+            else:
+                archive_name, offset = f"{first_seq:09d}.arc", 0
+            data = zlib.compress(pickle.dumps(messages, protocol=pickle.HIGHEST_PROTOCOL))
+            os.makedirs(os.path.join(self.history_dir, room_id), exist_ok=True)
+            with open(self._segment_path(room_id, archive_name), 'ab') as f:
+                f.truncate(offset)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            room['archive'].append([first_seq, last_seq, len(messages), archive_name, offset, len(data)])
+            self._log('set', 'chatrooms', room_id, 'archive', value=room['archive'])
+
+        room['segments'] = room['segments'][1:]
+        self._log('set', 'chatrooms', room_id, 'segments', value=room['segments'])
+        for seq in [seq for seq in patches if seq <= last_seq]:
+            del patches[seq]
+            self._log('del', 'chatrooms', room_id, 'patches', seq)
+        self._drop_files(room_id, [name])
+
+    @staticmethod
+    def _history_files(room):
+        return {segment[3] for segment in room['segments']} | {block[3] for block in room['archive']}
+
+    def _drop_files(self, room_id, names):
+        """Remove history files of a room in the background, once the
+        journal has stopped listing them (_remove_unused_segments catches
+        any left over)."""
+        names = set(names)
+        if not names:
+            return
+        with self._segment_lock:
+            for key in [key for key in self._segment_cache if key[0] == room_id and key[1] in names]:
+                del self._segment_cache[key]
+
+        def drop():
+            try:
+                self.journal.flush()
+            except JournalWriteError:
+                # Still listed as far as the disk knows; _remove_unused_segments
+                # removes them once they aren't
+                return
+            for name in names:
+                try:
+                    os.remove(self._segment_path(room_id, name))
+                except OSError:
+                    pass
+
+        threading.Thread(target=drop, name='drop-history', daemon=True).start()
+
+    def _remove_unused_segments(self):
+        # Files of deleted rooms or cleared history are no longer listed anywhere
+        if not os.path.isdir(self.history_dir):
+            return
+        for room_id in os.listdir(self.history_dir):
+            room_dir = os.path.join(self.history_dir, room_id)
+            used = set()
+            if room_id in self.chatrooms:
+                used = self._history_files(self.chatrooms[room_id])
+            for name in os.listdir(room_dir):
+                if name not in used:
+                    os.remove(os.path.join(room_dir, name))
+            if not used:
+                os.rmdir(room_dir)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS pending_users (username TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS invites (code TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS polls (poll_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS poll_votes (
+    poll_id TEXT NOT NULL,
+    username TEXT NOT NULL,
+    options TEXT NOT NULL,
+    PRIMARY KEY (poll_id, username)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS feedback (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS real_names (username TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS rooms (
+    room_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    last_seq INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS members (
+    room_id TEXT NOT NULL,
+    username TEXT NOT NULL,
+    UNIQUE (room_id, username)
+);
+CREATE INDEX IF NOT EXISTS members_by_user ON members (username);
+CREATE TABLE IF NOT EXISTS messages (
+    room_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (room_id, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS messages_by_id ON messages (room_id, id);
+CREATE TABLE IF NOT EXISTS archive (
+    room_id TEXT NOT NULL,
+    first_seq INTEGER NOT NULL,
+    last_seq INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (room_id, first_seq)
+);
+CREATE TABLE IF NOT EXISTS files (
+    room_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    hash TEXT,
+    PRIMARY KEY (room_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    origin INTEGER NOT NULL,
+    topic TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created REAL NOT NULL
+);
+"""
+
+# Event topics (tables) that have a version of their own: polls_version,
+# users_version and rooms_version
+VERSIONED_TOPICS = ('polls', 'users', 'rooms')
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, db_file, import_from=None, import_history_dir='chat_history',
+                 archive_messages=500, retention=None, shared=False, follow_interval=0.05,
+                 keep_events=600):
+        super().__init__(retention)
+        self.db_file = db_file
+        self.import_from = import_from
+        self.import_history_dir = import_history_dir
+        # Messages per compressed archive block; retention is checked every
+        # time a room's seq reaches a multiple of this
+        self.archive_messages = archive_messages
+        self._local = threading.local()
+        # Message counts per room, filled in on first use
+        self._counts = {}
+        # Shared mode: the events table is read every follow_interval seconds
+        # (by follow()) and events older than keep_events seconds are removed
+        self.shared = shared
+        self.follow_interval = follow_interval
+        self.keep_events = keep_events
+        self._last_event = 0
+        self._follower = None
+        # Set by changes, so the follower reads their events back right away
+        self._wake = threading.Event()
+        # Shared mode: topic -> id of the last event of it applied, and topic
+        # -> the newest event id when this worker changed it, until the
+        # follower has read that far (see _bump)
+        self._topic_events = {}
+        self._unread = {}
+        self._version_lock = threading.Lock()
+        # A process forked after loading (gunicorn --preload) needs its own
+        # connections
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._local = threading.local()
+        self._follower = None
+
+    @property
+    def _db(self):
+        # sqlite3 connections can't be shared between Flask's request threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, isolation_level=None, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        else:
+            db.execute('COMMIT')
+
+    def _put(self, table, key_column, key, value):
+        self._db.execute(
+            f"INSERT INTO {table} ({key_column}, data) VALUES (?, ?) "
+            f"ON CONFLICT ({key_column}) DO UPDATE SET data = excluded.data",
+            (key, json.dumps(value))
+        )
+        self._event(self._db, table, key)
+
+    def _delete(self, table, key_column, key):
+        self._db.execute(f"DELETE FROM {table} WHERE {key_column} = ?", (key,))
+        self._event(self._db, table, key)
+
+    def _load_table(self, table, key_column):
+        rows = self._db.execute(f"SELECT {key_column}, data FROM {table} ORDER BY rowid")
+        return {key: json.loads(data) for key, data in rows}
+
+    def load(self):
+        is_new = not os.path.exists(self.db_file)
+        self._db.executescript(SCHEMA)
+        self._migrate()
+
+        # One-time import of an existing pickle/journal data file
+        if is_new and self.import_from and os.path.exists(self.import_from):
+            self._import()
+            is_new = False
+        self.is_new = is_new
+
+        if self.shared:
+            # Events from here on are applied on top of the tables loaded below
+            self._last_event = self._db.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+            self.changes = RoomChanges(start=self._last_event)
+            self._topic_events = dict.fromkeys(VERSIONED_TOPICS, self._last_event)
+            self.polls_version = self.users_version = self.rooms_version = self._last_event
+
+        # Only the small tables are loaded; messages stay on disk
+        self.users = self._load_table('users', 'username')
+        self.pending_users = self._load_table('pending_users', 'username')
+        self.invites = self._load_table('invites', 'code')
+        self.polls = self._load_table('polls', 'poll_id')
+        upgraded = [poll_id for poll_id, poll in self.polls.items() if upgrade_poll(poll)]
+        for poll in self.polls.values():
+            poll.setdefault('ballots', {})
+        for poll_id, username, options in self._db.execute("SELECT poll_id, username, options FROM poll_votes"):
+            if poll_id in self.polls:
+                self.polls[poll_id]['ballots'][username] = json.loads(options)
+        if upgraded:
+            with self._transaction():
+                for poll_id in upgraded:
+                    self._put_poll(poll_id, self.polls[poll_id])
+        self.feedback = list(self._load_table('feedback', 'id').values())
+        self.real_names_set = {row[0] for row in self._db.execute("SELECT username FROM real_names")}
+        self.chatrooms = self._load_table('rooms', 'room_id')
+        for room in self.chatrooms.values():
+            room['members'] = []
+        for room_id, username in self._db.execute("SELECT room_id, username FROM members ORDER BY rowid"):
+            if room_id in self.chatrooms:
+                self.chatrooms[room_id]['members'].append(username)
+        self._index_rooms()
+        self._repair_membership()
+        for room_id in self.chatrooms:
+            self.apply_retention(room_id)
+
+    def _migrate(self):
+        # Databases created before rooms tracked their last message seq
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(rooms)")]
+        if 'last_seq' not in columns:
+            with self._transaction() as db:
+                db.execute("ALTER TABLE rooms ADD COLUMN last_seq INTEGER NOT NULL DEFAULT 0")
+                db.execute("UPDATE rooms SET last_seq = (SELECT COALESCE(MAX(seq), 0) FROM messages "
+                           "WHERE messages.room_id = rooms.room_id)")
+        # Databases created before the files table: list the files of the
+        # messages there are (once, marked by user_version)
+        if self._db.execute('PRAGMA user_version').fetchone()[0] < 1:
+            with self._transaction() as db:
+                files = []
+                for room_id, seq, data in db.execute(
+                        "SELECT room_id, seq, data FROM messages WHERE data LIKE '%\"file_path\"%'"):
+                    files.append(dict(json.loads(data), room_id=room_id, seq=seq))
+                for room_id, data in db.execute("SELECT room_id, data FROM archive"):
+                    files.extend(dict(message, room_id=room_id)
+                                 for message in json.loads(zlib.decompress(data)) if message.get('file_path'))
+                self._insert_files(db, files)
+                db.execute('PRAGMA user_version = 1')
+
+    @staticmethod
+    def _insert_files(db, messages):
+        # List the files of messages (dicts with room_id and seq) that have one
+        db.executemany("INSERT OR REPLACE INTO files (room_id, seq, path, hash) VALUES (?, ?, ?, ?)",
+                       ((message['room_id'], message['seq'], message['file_path'], message.get('file_hash'))
+                        for message in messages if message.get('file_path')))
+
+    def _import(self):
+        print(f"Importing {self.import_from} into {self.db_file}")
+        source = MemoryStorage(self.import_from, history_dir=self.import_history_dir)
+        source.load()
+        with self._transaction() as db:
+            for username, user in source.users.items():
+                self._put('users', 'username', username, user)
+            for username, user in source.pending_users.items():
+                self._put('pending_users', 'username', username, user)
+            for code, invite in source.invites.items():
+                self._put('invites', 'code', code, invite)
+            for poll_id, poll in source.polls.items():
+                self._put_poll(poll_id, poll)
+            for item in source.feedback:
+                self._put('feedback', 'id', item['id'], item)
+            db.executemany("INSERT OR IGNORE INTO real_names (username) VALUES (?)",
+                           ((username,) for username in source.real_names_set))
+            for room_id, room in source.chatrooms.items():
+                self._put('rooms', 'room_id', room_id, self._room_data(room))
+                db.execute("UPDATE rooms SET last_seq = ? WHERE room_id = ?", (room['last_seq'], room_id))
+                db.executemany("INSERT OR IGNORE INTO members (room_id, username) VALUES (?, ?)",
+                               ((room_id, username) for username in room['members']))
+                cursor = 0
+                while cursor is not None:
+                    messages, cursor = source.page_messages(room_id, after=cursor, limit=1000)
+                    db.executemany(
+                        "INSERT INTO messages (room_id, seq, id, data) VALUES (?, ?, ?, ?)",
+                        ((room_id, message['seq'], message['id'], json.dumps(self._stored(message)))
+                         for message in messages)
+                    )
+                    self._insert_files(db, (dict(message, room_id=room_id) for message in messages))
+        source.close()
+
+    def _put_poll(self, poll_id, poll):
+        self._put('polls', 'poll_id', poll_id, self._poll_data(poll))
+        self._db.execute("DELETE FROM poll_votes WHERE poll_id = ?", (poll_id,))
+        self._db.executemany("INSERT INTO poll_votes (poll_id, username, options) VALUES (?, ?, ?)",
+                             ((poll_id, username, json.dumps(options))
+                              for username, options in poll['ballots'].items()))
+
+    @staticmethod
+    def _poll_data(poll):
+        # Ballots live in their own table
+        return {key: value for key, value in poll.items() if key != 'ballots'}
+
+    @staticmethod
+    def _room_data(room):
+        # Members and messages live in their own tables
+        return {key: value for key, value in room.items()
+                if key not in ('members', 'messages', 'last_seq', 'segments', 'patches', 'archive', 'files')}
+
+    def _message(self, seq, data):
+        message = json.loads(data)
+        message['seq'] = seq
+        return self._with_profile_pic(message)
+
+    def _with_profile_pic(self, message):
+        message['profile_pic'] = self._profile_pic(message.get('user'), message.get('is_system', False))
+        return message
+
+    @staticmethod
+    def _stored(message):
+        # Pictures are looked up when messages are read
+        return {key: value for key, value in message.items() if key != 'profile_pic'}
+
+    def checkpoint(self):
+        self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def stats(self):
+        page_count = self._db.execute('PRAGMA page_count').fetchone()[0]
+        page_size = self._db.execute('PRAGMA page_size').fetchone()[0]
+        stats = {'backend': 'sqlite', 'database_bytes': page_count * page_size}
+        if self.shared:
+            stats['last_event'] = self._last_event
+        return stats
+
+    # ---- shared mode ----
+
+    def publish(self, topic, data):
+        """Send an event to the listeners of the other workers."""
+        self._event(self._db, topic, data)
+
+    def _message_event(self, db, room_id, kind, seq):
+        # In shared mode, message changes are only recorded (in every worker,
+        # this one too) when the event is read back, so a room's version is
+        # the same whichever worker is asked
+        self._event(db, 'message', {'room_id': room_id, 'kind': kind, 'seq': seq})
+
+    def _event(self, db, topic, data):
+        # Changes are written as events too when other workers need to know;
+        # the topic of a change is the table and its data the key
+        if self.shared:
+            db.execute("INSERT INTO events (origin, topic, data, created) VALUES (?, ?, ?, ?)",
+                       (os.getpid(), topic, json.dumps(data), time.time()))
+
+    def _bump(self, name):
+        # In shared mode a version is the id of the last event of its topic,
+        # so it means the same in every worker (a counter of this worker's
+        # wouldn't). Until the follower has read back the event of this
+        # change, only this worker has it: the version is one no other
+        # worker can have.
+        if not self.shared:
+            super()._bump(name)
+            return
+        newest = self._db.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+        with self._version_lock:
+            self._unread[name] = max(newest, self._unread.get(name, 0))
+            setattr(self, f"{name}_version", f"{os.getpid()}-{next(self._versions)}")
+        self._wake.set()
+
+    def _update_versions(self):
+        with self._version_lock:
+            for name in VERSIONED_TOPICS:
+                if self._unread.get(name, 0) > self._last_event:
+                    continue
+                self._unread.pop(name, None)
+                setattr(self, f"{name}_version", self._topic_events[name])
+
+    def follow(self):
+        """Start applying the events of other workers in the background."""
+        if self.shared and self._follower is None:
+            self._follower = threading.Thread(target=self._follow_loop, name='follow-events', daemon=True)
+            self._follower.start()
+
+    def _follow_loop(self):
+        next_trim = 0
+        while True:
+            self._wake.wait(self.follow_interval)
+            self._wake.clear()
+            try:
+                rows = self._db.execute("SELECT id, origin, topic, data FROM events WHERE id > ? ORDER BY id LIMIT 1000",
+                                        (self._last_event,)).fetchall()
+                for event_id, origin, topic, data in rows:
+                    try:
+                        self._apply_event(event_id, origin == os.getpid(), topic, json.loads(data))
+                    except Exception as e:
+                        print(f"Error applying event {event_id} ({topic}): {e!r}")
+                    self._last_event = event_id
+                if rows or self._unread:
+                    self._update_versions()
+                if time.monotonic() >= next_trim:
+                    # Workers that start later load the tables instead
+                    self._db.execute("DELETE FROM events WHERE created < ?", (time.time() - self.keep_events,))
+                    next_trim = time.monotonic() + 60
+            except sqlite3.Error as e:
+                print(f"Error reading events: {e!r}")
+
+    def _apply_event(self, event_id, own, topic, data):
+        if topic == 'message':
+            self._apply_message_event(event_id, own, **data)
+            return
+        reload = getattr(self, f"_reload_{topic}", None)
+        if reload is not None:
+            if not own:
+                # Own changes are already done in this worker
+                with self.lock.write():
+                    reload(data)
+            if topic in VERSIONED_TOPICS:
+                self._topic_events[topic] = event_id
+        elif not own:
+            for listener in self.listeners:
+                listener(topic, data)
+
+    def _apply_message_event(self, event_id, own, room_id, kind, seq):
+        if room_id not in self.chatrooms:
+            return
+        if not own:
+            self._counts.pop(room_id, None)
+        if kind == 'clear':
+            self.changes.reset(room_id, version=event_id)
+            return
+        message = None
+        if kind != 'delete':
+            row = self._db.execute("SELECT seq, data FROM messages WHERE room_id = ? AND seq = ?",
+                                   (room_id, seq)).fetchone()
+            if row is None:
+                # Deleted or archived since; its own event follows
+                kind = 'delete'
+            else:
+                message = self._message(*row)
+        self.changes.record(room_id, kind, seq, message, version=event_id)
+
+    def _reload_document(self, documents, table, key_column, key):
+        row = self._db.execute(f"SELECT data FROM {table} WHERE {key_column} = ?", (key,)).fetchone()
+        if row:
+            documents[key] = json.loads(row[0])
+        else:
+            documents.pop(key, None)
+
+    def _reload_users(self, username):
+        self._reload_document(self.users, 'users', 'username', username)
+        self._joined.pop(username, None)
+
+    def _reload_pending_users(self, username):
+        self._reload_document(self.pending_users, 'pending_users', 'username', username)
+
+    def _reload_invites(self, invite_code):
+        self._reload_document(self.invites, 'invites', 'code', invite_code)
+
+    def _reload_real_names(self, username):
+        if self._db.execute("SELECT 1 FROM real_names WHERE username = ?", (username,)).fetchone():
+            self.real_names_set.add(username)
+        else:
+            self.real_names_set.discard(username)
+
+    def _reload_feedback(self, feedback_id):
+        self.feedback[:] = self._load_table('feedback', 'id').values()
+
+    def _reload_polls(self, poll_id):
+        if poll_id is None:
+            # All polls were cleared
+            self.polls.clear()
+        else:
+            self._reload_document(self.polls, 'polls', 'poll_id', poll_id)
+            if poll_id in self.polls:
+                self.polls[poll_id]['ballots'] = {
+                    username: json.loads(options) for username, options in self._db.execute(
+                        "SELECT username, options FROM poll_votes WHERE poll_id = ?", (poll_id,))
+                }
+
+    def _reload_rooms(self, room_id):
+        row = self._db.execute("SELECT data FROM rooms WHERE room_id = ?", (room_id,)).fetchone()
+        if room_id in self.chatrooms:
+            self._unindex_room(room_id)
+        self._members.pop(room_id, None)
+        self._counts.pop(room_id, None)
+        if row:
+            room = json.loads(row[0])
+            room['members'] = [username for (username,) in self._db.execute(
+                "SELECT username FROM members WHERE room_id = ? ORDER BY rowid", (room_id,))]
+            self.chatrooms[room_id] = room
+            self._index_room(room_id)
+        elif room_id in self.chatrooms:
+            del self.chatrooms[room_id]
+            self._room_locks.discard(room_id)
+            self.changes.forget(room_id)
+
+    @_change
+    def save_user(self, username, *fields):
+        if not fields:
+            self._joined.pop(username, None)
+        self._put('users', 'username', username, self.users[username])
+        self._bump('users')
+
+    @_structural
+    def delete_user(self, username):
+        self._leave_all_rooms(username)
+        del self.users[username]
+        self._delete('users', 'username', username)
+        self._bump('users')
+
+    @_change
+    def save_pending_user(self, username):
+        self._put('pending_users', 'username', username, self.pending_users[username])
+
+    @_change
+    def delete_pending_user(self, username):
+        del self.pending_users[username]
+        self._delete('pending_users', 'username', username)
+
+    @_change
+    def save_invite(self, invite_code):
+        self._put('invites', 'code', invite_code, self.invites[invite_code])
+
+    @_change
+    def delete_invite(self, invite_code):
+        del self.invites[invite_code]
+        self._delete('invites', 'code', invite_code)
+
+    @_change
+    def add_real_name(self, username):
+        self.real_names_set.add(username)
+        self._db.execute("INSERT OR IGNORE INTO real_names (username) VALUES (?)", (username,))
+        self._event(self._db, 'real_names', username)
+
+    @_change
+    def discard_real_name(self, username):
+        self.real_names_set.discard(username)
+        self._delete('real_names', 'username', username)
+
+    @_change
+    def add_feedback(self, item):
+        self.feedback.append(item)
+        self._put('feedback', 'id', item['id'], item)
+
+    @_change
+    def save_feedback(self, feedback_id):
+        i = self._find_feedback(feedback_id)
+        if i is not None:
+            self._put('feedback', 'id', feedback_id, self.feedback[i])
+
+    @_change
+    def delete_feedback(self, feedback_id):
+        i = self._find_feedback(feedback_id)
+        if i is not None:
+            del self.feedback[i]
+            self._delete('feedback', 'id', feedback_id)
+
+    @_change
+    def save_poll(self, poll_id, *fields):
+        poll = self.polls[poll_id]
+        if fields:
+            self._put('polls', 'poll_id', poll_id, self._poll_data(poll))
+        else:
+            with self._transaction():
+                self._put_poll(poll_id, poll)
+        self._bump('polls')
+
+    @_structural
+    def clear_polls(self):
+        self.polls.clear()
+        with self._transaction() as db:
+            db.execute("DELETE FROM polls")
+            db.execute("DELETE FROM poll_votes")
+            self._event(db, 'polls', None)
+        self._bump('polls')
+
+    def _save_ballot(self, poll_id, username):
+        poll = self.polls[poll_id]
+        with self._transaction() as db:
+            if username in poll['ballots']:
+                db.execute("INSERT INTO poll_votes (poll_id, username, options) VALUES (?, ?, ?) "
+                           "ON CONFLICT (poll_id, username) DO UPDATE SET options = excluded.options",
+                           (poll_id, username, json.dumps(poll['ballots'][username])))
+            else:
+                db.execute("DELETE FROM poll_votes WHERE poll_id = ? AND username = ?", (poll_id, username))
+            if self.shared:
+                # Other workers take votes too: count the ballots that are saved
+                poll['tally'] = [0] * len(poll['options'])
+                for (options,) in db.execute("SELECT options FROM poll_votes WHERE poll_id = ?", (poll_id,)):
+                    for i in json.loads(options):
+                        poll['tally'][i] += 1
+            self._put('polls', 'poll_id', poll_id, self._poll_data(poll))
+
+    @_structural
+    def create_room(self, room_id, room):
+        room.setdefault('members', [])
+        room.pop('messages', None)
+        if room_id in self.chatrooms:
+            self._unindex_room(room_id)
+        self.chatrooms[room_id] = room
+        self._members.pop(room_id, None)
+        self._index_room(room_id)
+        self._counts[room_id] = 0
+        with self._transaction() as db:
+            self._put('rooms', 'room_id', room_id, self._room_data(room))
+            db.executemany("INSERT OR IGNORE INTO members (room_id, username) VALUES (?, ?)",
+                           ((room_id, username) for username in room['members']))
+        self._bump('rooms')
+
+    @_change
+    def save_room(self, room_id, *fields):
+        self._put('rooms', 'room_id', room_id, self._room_data(self.chatrooms[room_id]))
+        self._bump('rooms')
+
+    @_structural
+    def delete_room(self, room_id):
+        self._leave_room(room_id)
+        self._unindex_room(room_id)
+        del self.chatrooms[room_id]
+        self._counts.pop(room_id, None)
+        self._room_locks.discard(room_id)
+        self.changes.forget(room_id)
+        with self._transaction() as db:
+            db.execute("DELETE FROM rooms WHERE room_id = ?", (room_id,))
+            db.execute("DELETE FROM members WHERE room_id = ?", (room_id,))
+            db.execute("DELETE FROM messages WHERE room_id = ?", (room_id,))
+            db.execute("DELETE FROM archive WHERE room_id = ?", (room_id,))
+            db.execute("DELETE FROM files WHERE room_id = ?", (room_id,))
+            self._event(db, 'rooms', room_id)
+        self._bump('rooms')
+
+    def _save_member(self, room_id, username, added):
+        if added:
+            self._db.execute("INSERT OR IGNORE INTO members (room_id, username) VALUES (?, ?)",
+                             (room_id, username))
+        else:
+            self._db.execute("DELETE FROM members WHERE room_id = ? AND username = ?", (room_id, username))
+        self._event(self._db, 'rooms', room_id)
+        self._bump('rooms')
+
+    @_room_change
+    def append_message(self, room_id, message):
+        with self._transaction() as db:
+            db.execute("UPDATE rooms SET last_seq = last_seq + 1 WHERE room_id = ?", (room_id,))
+            message['seq'] = db.execute("SELECT last_seq FROM rooms WHERE room_id = ?",
+                                        (room_id,)).fetchone()[0]
+            message['id'] = self._message_id(room_id, message['seq'])
+            db.execute("INSERT INTO messages (room_id, seq, id, data) VALUES (?, ?, ?, ?)",
+                       (room_id, message['seq'], message['id'], json.dumps(self._stored(message))))
+            self._insert_files(db, [dict(message, room_id=room_id)])
+            self._message_event(db, room_id, 'add', message['seq'])
+        if room_id in self._counts:
+            self._counts[room_id] += 1
+        if not self.shared:
+            self.changes.record(room_id, 'add', message['seq'], self._with_profile_pic(dict(message)))
+        if message['seq'] % self.archive_messages == 0:
+            self.apply_retention(room_id)
+
+    def page_messages(self, room_id, before=None, after=None, limit=50):
+        # Fetch one extra message to know whether there is another page.
+        # Archived messages are all older than the ones in messages.
+        if after is not None:
+            messages = list(itertools.islice(self._iter_archive(room_id, after=after), limit + 1))
+            if len(messages) <= limit:
+                rows = self._db.execute(
+                    "SELECT seq, data FROM messages WHERE room_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                    (room_id, after, limit + 1 - len(messages))
+                )
+                messages += [self._message(seq, data) for seq, data in rows]
+            more = len(messages) > limit
+            messages = messages[:limit]
+        else:
+            rows = self._db.execute(
+                "SELECT seq, data FROM messages WHERE room_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                (room_id, before if before is not None else 2 ** 62, limit + 1)
+            )
+            messages = [self._message(seq, data) for seq, data in rows]
+            if len(messages) <= limit:
+                messages += itertools.islice(self._iter_archive(room_id, before=before), limit + 1 - len(messages))
+            more = len(messages) > limit
+            messages = messages[:limit][::-1]
+        next_cursor = None
+        if more:
+            next_cursor = messages[-1]['seq'] if after is not None else messages[0]['seq']
+        return messages, next_cursor
+
+    def _iter_archive(self, room_id, before=None, after=None):
+        # Archived messages oldest first above after, or else newest first below before
+        if after is not None:
+            blocks = self._db.execute(
+                "SELECT data FROM archive WHERE room_id = ? AND last_seq > ? ORDER BY first_seq",
+                (room_id, after)
+            ).fetchall()
+        else:
+            blocks = self._db.execute(
+                "SELECT data FROM archive WHERE room_id = ? AND first_seq < ? ORDER BY first_seq DESC",
+                (room_id, before if before is not None else 2 ** 62)
+            ).fetchall()
+        for (data,) in blocks:
+            messages = [self._with_profile_pic(message) for message in json.loads(zlib.decompress(data))]
+            if after is not None:
+                yield from (message for message in messages if message['seq'] > after)
+            else:
+                yield from (message for message in reversed(messages)
+                            if before is None or message['seq'] < before)
+
+    def message_count(self, room_id):
+        if room_id not in self._counts:
+            self._counts[room_id] = self._db.execute(
+                "SELECT (SELECT COUNT(*) FROM messages WHERE room_id = ?) + "
+                "(SELECT COALESCE(SUM(count), 0) FROM archive WHERE room_id = ?)", (room_id, room_id)
+            ).fetchone()[0]
+        return self._counts[room_id]
+
+    def find_message(self, room_id, message_id):
+        row = self._db.execute(
+            "SELECT seq, data FROM messages WHERE room_id = ? AND id = ?", (room_id, message_id)
+        ).fetchone()
+        if row is None:
+            return None, None
+        return row[0], self._message(*row)
+
+    @_room_change
+    def replace_message(self, room_id, seq, message):
+        with self._transaction() as db:
+            db.execute("UPDATE messages SET id = ?, data = ? WHERE room_id = ? AND seq = ?",
+                       (message['id'], json.dumps(self._stored(message)), room_id, seq))
+            self._message_event(db, room_id, 'edit', seq)
+        if not self.shared:
+            self.changes.record(room_id, 'edit', seq, self._with_profile_pic(dict(message)))
+
+    @_room_change
+    def delete_message(self, room_id, seq):
+        with self._transaction() as db:
+            db.execute("DELETE FROM messages WHERE room_id = ? AND seq = ?", (room_id, seq))
+            db.execute("DELETE FROM files WHERE room_id = ? AND seq = ?", (room_id, seq))
+            self._message_event(db, room_id, 'delete', seq)
+        if room_id in self._counts:
+            self._counts[room_id] -= 1
+        if not self.shared:
+            self.changes.record(room_id, 'delete', seq)
+
+    @_room_change
+    def clear_messages(self, room_id):
+        with self._transaction() as db:
+            db.execute("DELETE FROM messages WHERE room_id = ?", (room_id,))
+            db.execute("DELETE FROM archive WHERE room_id = ?", (room_id,))
+            db.execute("DELETE FROM files WHERE room_id = ?", (room_id,))
+            self._message_event(db, room_id, 'clear', None)
+        self._counts[room_id] = 0
+        if not self.shared:
+            self.changes.reset(room_id)
+
+    def room_files(self, room_id):
+        return [{'file_path': path, 'file_hash': digest} for path, digest in self._db.execute(
+            "SELECT path, hash FROM files WHERE room_id = ? ORDER BY seq", (room_id,))]
+
+    @_room_change
+    def apply_retention(self, room_id):
+        policy = self.retention_policy(room_id)
+        if not policy:
+            return
+        while True:
+            with self._transaction() as db:
+                rows = db.execute("SELECT seq, data FROM messages WHERE room_id = ? ORDER BY seq LIMIT ?",
+                                  (room_id, self.archive_messages)).fetchall()
+                # Only full blocks are archived
+                if len(rows) < self.archive_messages:
+                    return
+                live_count, live_bytes = db.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM messages WHERE room_id = ?",
+                    (room_id,)
+                ).fetchone()
+                messages = [self._stored(dict(json.loads(data), seq=seq)) for seq, data in rows]
+                if not self._is_expired(policy, live_count, live_bytes, len(messages),
+                                        parse_time(messages[-1].get('timestamp'))):
+                    return
+                db.execute("INSERT INTO archive (room_id, first_seq, last_seq, count, data) VALUES (?, ?, ?, ?, ?)",
+                           (room_id, rows[0][0], rows[-1][0], len(rows),
+                            zlib.compress(json.dumps(messages).encode())))
+                db.execute("DELETE FROM messages WHERE room_id = ? AND seq <= ?", (room_id, rows[-1][0]))
+
+
+def open_storage(backend, data_file='chat_data.pkl', db_file='chat_data.db',
+                 history_dir='chat_history', retention=None, shared=False, **journal_options):
+    """Create the storage backend named by backend ('memory' or 'sqlite');
+    shared for one that several worker processes use at once."""
+    if backend == 'memory':
+        if shared:
+            raise ValueError("The memory backend can't be shared by several workers; use sqlite")
+        return MemoryStorage(data_file, history_dir=history_dir, retention=retention, **journal_options)
+    if backend == 'sqlite':
+        # An existing data file is imported the first time the database is created
+        return SQLiteStorage(db_file, import_from=data_file, import_history_dir=history_dir,
+                             retention=retention, shared=shared)
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -0,0 +1,147 @@
+"""Content-addressed storage for files sent in chat (see /send_file).
+
+Every distinct file content is stored once, as an object named after its
+SHA-256 under objects/ab/cd/<hash> in the uploads folder. The name a message
+links to (/static/uploads/<name>) is a hard link to that object, so posting
+the same file again adds a name but no data, and the object's link count is
+its reference count: the object goes when its last name is released.
+
+Uploads are read in chunks while they are hashed. When the content is
+already stored, nothing is written at all; otherwise it goes to a temporary
+file that is renamed into place.
+"""
+
+import hashlib
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+
+OBJECTS_DIR = 'objects'
+
+# mkstemp makes files only their owner can read; stored files get the mode
+# any other file the app writes would (read once, os.umask can only be read by
+# setting it)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+FILE_MODE = 0o666 & ~_UMASK
+
+
+class UploadStore:
+    def __init__(self, root, chunk_size=256 * 1024):
+        self.root = root
+        self.objects = os.path.join(root, OBJECTS_DIR)
+        self.chunk_size = chunk_size
+        # Linking a name to an object and dropping an object's last name
+        # mustn't interleave
+        self._lock = threading.Lock()
+        os.makedirs(self.objects, exist_ok=True)
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest[2:4], digest)
+
+    def add(self, stream, name):
+        """Store the file read from stream under name (a safe file name);
+        returns (name, digest), with name changed if it was taken."""
+        tmp = None
+        try:
+            if stream.seekable():
+                # Werkzeug has the upload in memory or a spooled file: hash it
+                # first and only write it out if the content is new
+                digest = self._hash(stream)
+                stream.seek(0)
+            else:
+                tmp, digest = self._spool(stream)
+            path = self.object_path(digest)
+            if tmp is None and not os.path.exists(path):
+                tmp, _ = self._spool(stream)
+            with self._lock:
+                if not os.path.exists(path):
+                    if tmp is None:
+                        # Its last name was released since we looked
+                        stream.seek(0)
+                        tmp, _ = self._spool(stream)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.replace(tmp, path)
+                    tmp = None
+                name = self._link(path, name)
+        finally:
+            if tmp is not None:
+                os.remove(tmp)
+        return name, digest
+
+    def release(self, name, digest=None):
+        """Drop a stored name, and its object if no other name links to it;
+        True if the object went. Files stored before objects (no digest) are
+        just removed."""
+        if not name or os.path.basename(name) != name or name == OBJECTS_DIR:
+            return False
+        with self._lock:
+            try:
+                os.remove(os.path.join(self.root, name))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Could not remove upload {name}: {e}")
+                return False
+            if digest:
+                path = self.object_path(digest)
+                try:
+                    if os.stat(path).st_nlink == 1:
+                        os.remove(path)
+                        return True
+                except FileNotFoundError:
+                    pass
+        return False
+
+    def stats(self):
+        objects = 0
+        size = 0
+        names = 0
+        for directory, _, files in os.walk(self.objects):
+            for file in files:
+                st = os.stat(os.path.join(directory, file))
+                objects += 1
+                size += st.st_size
+                names += st.st_nlink - 1
+        return {'upload_objects': objects, 'upload_bytes': size, 'upload_names': names}
+
+    def _hash(self, stream):
+        sha = hashlib.sha256()
+        for chunk in iter(lambda: stream.read(self.chunk_size), b''):
+            sha.update(chunk)
+        return sha.hexdigest()
+
+    def _spool(self, stream):
+        # Copy stream to a temporary file next to the objects, hashing it on the way
+        sha = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=self.objects, prefix='.upload-')
+        try:
+            os.chmod(tmp, FILE_MODE)
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: stream.read(self.chunk_size), b''):
+                    sha.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return tmp, sha.hexdigest()
+
+    def _link(self, path, name):
+        base, ext = os.path.splitext(name)
+        for n in itertools.count(1):
+            target = os.path.join(self.root, name)
+            try:
+                os.link(path, target)
+                return name
+            except FileExistsError:
+                name = f"{base}-{n}{ext}"
+            except OSError:
+                # No hard links on this file system: store a copy instead
+                try:
+                    with open(path, 'rb') as src, open(target, 'xb') as dst:
+                        shutil.copyfileobj(src, dst, self.chunk_size)
+                    return name
+                except FileExistsError:
+                    name = f"{base}-{n}{ext}"